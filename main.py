@@ -1,4 +1,5 @@
 import argparse
+from contextlib import ExitStack
 from datetime import datetime
 import gzip
 import json
@@ -9,7 +10,7 @@ import socket
 import struct
 import sys
 import subprocess
-from threading import Thread
+from threading import Event, Thread
 import time
 from urllib.parse import urlparse
 import logging.handlers
@@ -17,9 +18,28 @@ import msgpack
 from persistent_queue import PersistentQueue
 import pkg_resources
 import yaml
-import paho.mqtt.client as paho
 import time
 
+from utils.adaptive import AdaptiveSampler
+from utils.aqi import AqiEngine
+from utils.brokers import BrokerPool, PublishTimeout, brokers_from_config
+from utils.calibration import Calibration
+from utils.clock import SampleClock
+from utils.checkpoint import AckCheckpoint, SequenceCounter
+from utils.compactor import Compactor
+from utils import dead_letter
+from utils.deadband import Deadband
+from utils.health import SensorHealth
+from utils.device_info import get_device_info
+from utils.lanes import Lanes, TokenBucket, split_bandwidth
+from utils.local_api import LastValueCache, LocalApi
+from utils.queue_reader import block_of
+from utils.quota import DiskQuota
+from utils.retention import Retention
+from utils.schema import SchemaRegistry
+from utils.sntp import ClockSync, SntpClient
+from utils.time_index import IndexedQueue
+
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s:%(threadName)s:%(levelname)s:'
                            '%(name)s:%(message)s',
@@ -34,8 +54,12 @@ RUNNING = True
 
 
 # Read data from the sensor
-def read_data(output_sensors, input_sensors, queue):
-    sequence_number = 0
+def read_data(output_sensors, input_sensors, queue, clock, retention=None,
+              schemas=None, quota=None, deadband=None, sampler=None,
+              aqi=None, calibration=None, cache=None, health=None):
+    # Keeps counting across restarts so (boot_id, sequence) identifies a sample
+    sequence = SequenceCounter()
+    device = get_device_info()
 
     for sensor in input_sensors:
         sensor.status("Starting sensors")
@@ -47,33 +71,77 @@ def read_data(output_sensors, input_sensors, queue):
     while RUNNING:
         try:
             # Sleep
-            for _ in range(60):
-                if not RUNNING:
-                    break
-                time.sleep(1)
-
-            now = time.time()
-            sequence_number += 1
-            data = {"sample_time": int(now * 1e6),
-                    "data": {"sequence": sequence_number,
+            interval = sampler.interval if sampler is not None else 60
+            while interval > 0 and RUNNING:
+                time.sleep(min(interval, 1))
+                interval -= 1
+
+            sample_time, clock_metadata = clock.stamp()
+            data = {"sample_time": sample_time,
+                    "data": {"sequence": sequence.next(),
                              "queue_length": len(queue) + 1},
-                    "metadata": {"firmware": get_firmware_version()}}
+                    "metadata": {"firmware": device.firmware}}
+            data['metadata'].update(clock_metadata)
+            if quota is not None:
+                data['data']['store_bytes'] = quota.usage()
+                data['data']['thinning'] = quota.thinning
 
             LOGGER.info("Getting new data from sensors")
             for sensor in output_sensors:
-                data['data'].update(sensor.read())
+                values = sensor.read()
+                if schemas is not None:
+                    schemas.observe(sensor.name, values)
+                data['data'].update(values)
+
+            if health is not None:
+                data['data'].update(health.fields())
+
+            # Calibrated values go next to the raw ones
+            if calibration is not None:
+                calibration.apply(data['data'])
+
+            if sampler is not None:
+                data['metadata']['sample_interval'] = sampler.interval
+                sampler.update(data['data'])
+
+            if aqi is not None:
+                aqi.update(data)
+
+            # Only what changed is sent; everything else still gets the
+            # full sample
+            reported = data if deadband is None else deadband.filter(data)
 
             # Save data for later
-            LOGGER.debug("Pushing %s into queue", data)
-            queue.push(data)
+            LOGGER.debug("Pushing %s into queue", reported)
+            try:
+                queue.push(reported)
+            except OSError:
+                if quota is None:
+                    raise
+                # Most likely the disk is full; make room and try once more,
+                # if any was made
+                LOGGER.exception("Unable to push sample, making room")
+                if quota.enforce() <= 0:
+                    raise
+                queue.push(reported)
+
+            if quota is not None:
+                quota.check()
+
+            # For other processes on the device
+            if cache is not None:
+                cache.update(data)
 
             # Write data to input sensors
             for sensor in input_sensors:
                 sensor.data(data)
 
-            # Every 10 minutes, update time
-            if sequence_number % 10 == 0:
-                Thread(target=update_clock).start()
+            # Keep a local copy after the queue has sent it
+            if retention is not None:
+                try:
+                    retention.add(data)
+                except Exception:
+                    LOGGER.exception("Unable to save sample to history")
 
         except KeyboardInterrupt:
             break
@@ -90,21 +158,47 @@ def read_data(output_sensors, input_sensors, queue):
     LOGGER.debug("Exiting read loop")
 
 
-def get_firmware_version():
-    return subprocess.check_output(["git", "describe"]).strip().decode()
+def restart_wifi(status, network_ready):
+    # Turn off WiFi
+    status("Turning off WiFi")
+    try:
+        subprocess.run("iwconfig 2> /dev/null | grep -o '^[[:alnum:]]\+' | while read x; do ifdown $x; done",
+             shell=True)
+    except Exception:
+        LOGGER.exception("Exception while turning off WiFi")
 
+    # Wait for 15 seconds
+    for i in reversed(range(15)):
+        status("Waiting ({})".format(i))
+        time.sleep(1)
 
-def update_clock():
+    # Turn on WiFi
+    status("Turning on WiFi")
     try:
-        LOGGER.debug("Trying to update clock")
-        subprocess.run("ntpdate -b -s -u pool.ntp.org", shell=True, check=True, timeout=45)
-        LOGGER.debug("Updated to current time")
-    except (subprocess.TimeoutExpired, subprocess.CalledProcessError):
-        LOGGER.warning("Unable to update time")
+        subprocess.run("iwconfig 2> /dev/null | grep -o '^[[:alnum:]]\+' | while read x; do ifup $x; done",
+             shell=True)
+    except Exception:
+        LOGGER.exception("Exception while turning on WiFi")
+
+    # Wait for 5 seconds
+    for i in reversed(range(5)):
+        status("Waiting ({})".format(i))
+        time.sleep(1)
 
+    network_ready.set()
 
-def load_sensors(config_file):
+
+def sync_clock(clock_sync, network_ready):
+    network_ready.wait()
+
+    # Samples taken before the first successful sync are marked as
+    # unsynchronized and corrected before they are published
+    clock_sync.start()
+
+
+def load_sensors(config_file, worker_cfg=None):
     import importlib
+    worker_cfg = worker_cfg or {}
     sensors = load_sensor_files(config_file)
     input_sensors = []
     output_sensors = []
@@ -124,6 +218,30 @@ def load_sensors(config_file):
                               'dependency %s', sensor, req)
                 continue
 
+        # Only output sensors run in a worker. Input sensors say so in their
+        # module, so they aren't set up (GPIO and all) in a worker first
+        if worker_cfg.get('enabled', False) and \
+                getattr(module, 'TYPE', 'output') == 'output':
+            from utils.sensor_worker import SensorWorker
+
+            LOGGER.info("Setting up %s in a worker process", sensor)
+            worker = SensorWorker(sensor, config,
+                                  timeout=worker_cfg.get('timeout', 30))
+            if worker.type == 'output':
+                output_sensors.append(worker)
+                continue
+
+            worker.stop()
+            if worker.type is None and not worker_cfg.get('fallback', False):
+                LOGGER.error("%s worker failed to start, skipping...", sensor)
+                continue
+            elif worker.type is None:
+                LOGGER.warning("%s worker failed to start, running it in this "
+                               "process instead", sensor)
+            else:
+                LOGGER.warning("%s is an %s sensor, set TYPE in its module",
+                               sensor, worker.type)
+
         LOGGER.info("Setting up %s", sensor)
         sensor = module.setup_sensor(config)
 
@@ -200,19 +318,188 @@ def install_package(package):
         return False
 
 
-def on_connect(cli, ud, flag, rc):
-    if rc==0:
-        LOGGER.info("connected OK rc:" + str(rc))
+def prepare_sample(data, clock):
+    """Turns a sample from the queue into what is sent to the server."""
+    data = decode_dict(data)
+    return clock.correct(data)
+
+
+def correct_values(clock, schema, values):
+    """clock.correct() for a sample that has been laid out by a schema."""
+    synced = values[schema.paths[('metadata', 'clock_synced')]]
+    if synced is not False:
+        return
+
+    sample_time = clock.corrected_time(
+        values[schema.paths[('metadata', 'monotonic_time')]],
+        decode_dict(values[schema.paths[('metadata', 'boot_id')]]))
+    if sample_time is None:
+        return
+
+    values[schema.paths[('sample_time',)]] = sample_time
+    values[schema.paths[('metadata', 'clock_synced')]] = True
+    values[schema.paths[('metadata', 'clock_corrected')]] = True
+
+
+def publish_mqtt(mqtt_cfg, queue, bad_queue, clock, network_ready,
+                 input_sensors, schemas=None, lanes=None):
+    # Connect to the broker(s)
+    brokers = BrokerPool(brokers_from_config(mqtt_cfg),
+                         mode=mqtt_cfg.get('mode', 'failover'),
+                         probe_interval=mqtt_cfg.get('probe_interval', 60),
+                         failover_after=mqtt_cfg.get('failover_after', 30),
+                         publish_timeout=mqtt_cfg.get('publish_timeout', 30),
+                         max_queued=mqtt_cfg.get('max_queued', 10000))
+    brokers.start(network_ready)
+
+    base_topic = "epifi/v1/{}".format(mqtt_cfg['uname'])
+    block_topic = base_topic + "/block"
+    schema_version = None
+    suffix = "/compact" if schemas is not None else ""
+
+    batch_size = mqtt_cfg.get('batch_size', 50)
+    dead_letters = dead_letter.DeadLetterStore(bad_queue)
+
+    def encode(data, sample_topic):
+        """Returns the topic and payload to publish a queue item with."""
+        nonlocal schema_version
+        block = block_of(data)
+
+        if block is not None:
+            # Compacted backlog goes out as a single message
+            return block_topic, bytes(block)
+        elif schemas is None:
+            data = prepare_sample(data, clock)
+            return sample_topic, json.dumps(data)
+
+        # Laid out straight from the queue's dict, without decoding
+        data = schemas.encode(
+            data, lambda schema, values: correct_values(clock, schema, values))
+
+        if schemas.schema.version != schema_version:
+            # Published once per version; retained so new
+            # subscribers can decode the records
+            schema = schemas.schema
+            brokers.retain("epifi/v1/{}/schema".format(mqtt_cfg['uname']),
+                           json.dumps(schema.as_dict()))
+            schema_version = schema.version
+
+        return sample_topic, data
+
+    def publish(topic, data, bucket, timeout=None):
+        if bucket is not None:
+            bucket.consume(len(data))
+
+        brokers.publish(topic, data, timeout)
+
+    def drain(queue, topic, bucket=None, checkpoint_file='ack.checkpoint',
+              sending=None, timeout=None):
+        """Continuously get data from a queue and publish it to the broker."""
+        checkpoint = AckCheckpoint(checkpoint_file)
+        checkpoint.recover(queue)
+
+        while True:
+            stage = dead_letter.QUEUE
+            try:
+                if not brokers.wait_connected(timeout=0):
+                    LOGGER.info("Waiting for connection to broker")
+                    while not brokers.wait_connected(timeout=1):
+                        pass
+
+                LOGGER.info("Waiting for data in queue")
+                queue.peek(blocking=True)
+
+                with sending() if sending is not None else ExitStack():
+                    batch = queue.peek(min(len(queue), batch_size))
+                    if not isinstance(batch, list):
+                        batch = [batch]
+
+                    acked = 0
+                    try:
+                        for data in batch:
+                            stage = dead_letter.ENCODE
+                            item_topic, payload = encode(data, topic)
+                            stage = dead_letter.PUBLISH
+                            publish(item_topic, payload, bucket, timeout)
+                            stage = dead_letter.QUEUE
+                            acked += 1
+                    finally:
+                        # One checkpoint and flush for everything that was
+                        # acknowledged, even if the batch was cut short
+                        if acked:
+                            LOGGER.info("Deleting %d items from queue", acked)
+                            checkpoint.confirm(queue, batch[acked - 1], acked)
+
+                for sensor in input_sensors:
+                    sensor.transmitted_data(len(lanes if lanes is not None else queue))
+
+            except KeyboardInterrupt:
+                break
+
+            except PublishTimeout:
+                # Nothing is wrong with the sample. Letting go of the batch
+                # lets older live samples move to the backlog in the meantime
+                LOGGER.warning("No broker acknowledged within %s s, trying again",
+                               timeout)
+
+            except msgpack.exceptions.UnpackValueError as e:
+                LOGGER.exception("Unable to unpack data")
+                break
+
+            except Exception as e:
+                bad_data=queue.peek()
+                LOGGER.error("Exception- %s occurred while listening to data %s", e,str(bad_data))
+                LOGGER.info("Pushing data into bad queue")
+                dead_letters.add(bad_data, e, stage, topic)
+                queue.delete()
+                queue.flush()
+
+    if lanes is None:
+        drain(queue, base_topic + suffix)
     else:
-        LOGGER.error("Bad connection: Returned code=%s",rc)
+        # Newest samples go out right away; the backlog drains alongside on
+        # its own share of the bandwidth
+        lanes_cfg = mqtt_cfg.get('lanes') or {}
+        live_rate, backfill_rate = split_bandwidth(lanes_cfg.get('max_bandwidth'),
+                                                   lanes_cfg.get('live_share', 0.5))
+        backfill_topic = base_topic
+        if lanes_cfg.get('backfill_topic', True):
+            backfill_topic += "/backfill"
+
+        # The live lane gives up on a batch after publish_timeout so the
+        # samples behind it can be moved to the backlog
+        Thread(target=drain, args=(lanes.live, base_topic + suffix,
+                                   TokenBucket(live_rate), 'live.checkpoint',
+                                   lanes.sending,
+                                   mqtt_cfg.get('publish_timeout', 30)),
+               name="LiveLaneThread", daemon=True).start()
+        drain(lanes.backlog, backfill_topic + suffix, TokenBucket(backfill_rate))
 
+    LOGGER.debug("Shutting down client")
+    brokers.stop()
 
-def on_publish(client, userdata, mid):
-    LOGGER.info("Publish successful: Mid- "+str(mid))
 
+def serve_coap(coap_cfg, queue, clock, output_sensors):
+    from utils.coap_server import CoapServer
 
-def on_disconnect(cli, ud, rc):
-    LOGGER.info("Disconnected: rc-" + str(rc))
+    device = get_device_info()
+    server = CoapServer(queue,
+                        lambda data: prepare_sample(data, clock),
+                        name=device.hostname,
+                        sensor_type=coap_cfg.get('type', '-'.join(
+                            sensor.name for sensor in output_sensors)),
+                        port=coap_cfg.get('port', 5683),
+                        block_size=coap_cfg.get('block_size', 1024),
+                        multicast=coap_cfg.get('multicast', True))
+    server.start()
+
+    try:
+        while RUNNING:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
 
 
 def main(config_file):
@@ -224,17 +511,42 @@ def main(config_file):
         LOGGER.error("Error loading config file")
         exit()
 
-    mqtt_cfg = cfg['mqtt']
+    transport = cfg.get('transport', 'mqtt')
+    mqtt_cfg = cfg.get('mqtt') or {}
+    ntp_cfg = cfg.get('ntp') or {}
+    retention_cfg = cfg.get('retention') or {}
+    compaction_cfg = cfg.get('compaction') or {}
+    quota_cfg = cfg.get('quota') or {}
+    deadband_cfg = cfg.get('deadband') or {}
+    adaptive_cfg = cfg.get('adaptive') or {}
+    aqi_cfg = cfg.get('aqi') or {}
+    calibration_cfg = cfg.get('calibration') or {}
+    local_api_cfg = cfg.get('local_api') or {}
+    health_cfg = cfg.get('health') or {}
 
     # Load MQTT username and password
-    try:
-        mqtt_cfg['uname'] = os.environ['MQTT_USERNAME']
-        mqtt_cfg['password'] = os.environ['MQTT_PASSWORD']
-    except KeyError:
-        LOGGER.error("MQTT_USERNAME or MQTT_PASSWORD have not been defined")
-        exit()
-
-    input_sensors, output_sensors = load_sensors(config_file)
+    if transport == 'mqtt':
+        try:
+            mqtt_cfg['uname'] = os.environ['MQTT_USERNAME']
+            mqtt_cfg['password'] = os.environ['MQTT_PASSWORD']
+        except KeyError:
+            LOGGER.error("MQTT_USERNAME or MQTT_PASSWORD have not been defined")
+            exit()
+
+    # Firmware version and network information are computed once and only
+    # refreshed when they change or on SIGHUP
+    device = get_device_info()
+    device.start()
+    signal.signal(signal.SIGHUP, device.request_refresh)
+
+    input_sensors, output_sensors = load_sensors(config_file, cfg.get('workers'))
+
+    # Sensors that keep failing are left alone for a while
+    health = SensorHealth(failures=health_cfg.get('failures', 3),
+                          initial=health_cfg.get('initial', 60),
+                          maximum=health_cfg.get('maximum', 3600))
+    input_sensors = [health.supervise(sensor) for sensor in input_sensors]
+    output_sensors = [health.supervise(sensor) for sensor in output_sensors]
 
     for sensor in input_sensors:
         sensor.start()
@@ -243,125 +555,139 @@ def main(config_file):
         for sensor in input_sensors:
             sensor.status(message)
 
-    # Turn off WiFi
-    status("Turning off WiFi")
-    try:
-        subprocess.run("iwconfig 2> /dev/null | grep -o '^[[:alnum:]]\+' | while read x; do ifdown $x; done",
-             shell=True)
-    except Exception:
-        LOGGER.exception("Exception while turning off WiFi")
-
-    # Wait for 15 seconds
-    for i in reversed(range(15)):
-        status("Waiting ({})".format(i))
-        time.sleep(1)
-
-    # Turn on WiFi
-    status("Turning on WiFi")
-    try:
-        subprocess.run("iwconfig 2> /dev/null | grep -o '^[[:alnum:]]\+' | while read x; do ifup $x; done",
-             shell=True)
-    except Exception:
-        LOGGER.exception("Exception while turning on WiFi")
-
-    # Wait for 5 seconds
-    for i in reversed(range(5)):
-        status("Waiting ({})".format(i))
-        time.sleep(1)
-
-    try:
-        status("Updating clock")
-        subprocess.run("ntpdate -b -s -u pool.ntp.org", shell=True, check=True, timeout=120)
-        LOGGER.debug("Updated to current time")
-    except (subprocess.TimeoutExpired, subprocess.CalledProcessError):
-        LOGGER.warning("Unable to update time")
-
+    # Open the queue first so sampling can start right away; the network,
+    # clock and broker come up in the background
     status("Loading queue")
     LOGGER.info("Loading persistent queue")
-    queue = PersistentQueue('sensor.queue',
-                            dumps=msgpack.packb,
-                            loads=msgpack.unpackb)
+    queue = IndexedQueue('sensor.queue',
+                         dumps=msgpack.packb,
+                         loads=msgpack.unpackb)
     bad_queue = PersistentQueue('sensor.bad_queue',
                                 dumps=msgpack.packb,
                                 loads=msgpack.unpackb)
 
     # Start reading from sensors
-    sensor_thread = Thread(target=read_data, args=(output_sensors, input_sensors, queue))
-    sensor_thread.start()
-
-    # Create mqtt client
-    client = paho.Client()
-    client.username_pw_set(username=mqtt_cfg['uname'], password=mqtt_cfg['password'])
-    # Define callabcks
-    client.on_connect=on_connect
-    client.on_publish = on_publish
-    client.on_disconnect=on_disconnect
-    # Reconnect interval on disconnect
-    client.reconnect_delay_set(3)
-
-    if 'ca_certs' in mqtt_cfg:
-        client.tls_set(ca_certs=mqtt_cfg['ca_certs'])
-
-    # Establish client connection
-    while True:
-        try:
-            LOGGER.info("Trying to connect to borker")
-            client.connect(mqtt_cfg['server'], mqtt_cfg['port'])
-            LOGGER.info("Client connected successfully to broker")
-            break
-        except:
-            LOGGER.exception("Connection failure...trying to reconnect...")
-            time.sleep(15)
-    client.loop_start()
-
-    # Continuously get data from queue and publish to broker
-    while True:
+    clock = SampleClock()
+
+    retention = None
+    if retention_cfg.get('enabled', False):
+        retention = Retention(retention_cfg.get('path', 'history'),
+                              raw_days=retention_cfg.get('raw_days', 7),
+                              rollups=retention_cfg.get('rollups'),
+                              max_bytes=int(retention_cfg.get('max_megabytes', 64) * 1024 * 1024),
+                              clock=clock)
+    schemas = None
+    if transport == 'mqtt' and mqtt_cfg.get('encoding', 'json') == 'compact':
+        schemas = SchemaRegistry()
+
+    calibration = None
+    if calibration_cfg.get('enabled', False):
+        calibration = Calibration(calibration_cfg.get('fields'))
+
+    # The CoAP server acknowledges samples by count, so blocks would confuse it
+    compactor = None
+    if transport == 'mqtt' and compaction_cfg.get('enabled', False):
+        compactor = Compactor(queue, clock,
+                              max_age=compaction_cfg.get('max_age', 3600),
+                              block_size=compaction_cfg.get('block_size', 256),
+                              interval=compaction_cfg.get('interval', 600),
+                              skip=mqtt_cfg.get('batch_size', 50),
+                              calibration=calibration)
+        compactor.start()
+
+    # With lanes, new samples go to a small live queue first
+    lanes = None
+    lanes_cfg = mqtt_cfg.get('lanes') or {}
+    if transport == 'mqtt' and lanes_cfg.get('enabled', False):
+        live_queue = PersistentQueue('live.queue',
+                                     dumps=msgpack.packb,
+                                     loads=msgpack.unpackb)
+        lanes = Lanes(live_queue, queue, live_size=lanes_cfg.get('live_size', 10))
+
+    # Thinning rewrites the queue, so like compaction it is MQTT only
+    quota = None
+    if transport == 'mqtt' and quota_cfg.get('enabled', False):
+        quota = DiskQuota(queue, bad_queue,
+                          int(quota_cfg.get('max_megabytes', 256) * 1024 * 1024),
+                          thin_at=quota_cfg.get('thin_at', 0.8),
+                          target=quota_cfg.get('target', 0.7),
+                          bad_queue_share=quota_cfg.get('bad_queue_share', 0.1),
+                          clock=clock,
+                          skip=mqtt_cfg.get('batch_size', 50),
+                          extra_files=['live.queue'] if lanes is not None else [],
+                          min_free=int(quota_cfg.get('min_free_megabytes', 16) * 1024 * 1024))
+
+    deadband = None
+    if deadband_cfg.get('enabled', False):
+        deadband = Deadband(deadband_cfg.get('fields'),
+                            keyframe_interval=deadband_cfg.get('keyframe_interval', 3600))
+
+    sampler = None
+    if adaptive_cfg.get('enabled', False):
+        # No faster than the slowest sensor can produce new readings
+        fast_interval = max([adaptive_cfg.get('fast_interval', 10)] +
+                            [getattr(sensor, 'min_interval', 0) for sensor in output_sensors])
+        sampler = AdaptiveSampler(adaptive_cfg.get('fields') or {},
+                                  base_interval=adaptive_cfg.get('base_interval', 60),
+                                  fast_interval=fast_interval,
+                                  hold=adaptive_cfg.get('hold', 600))
+
+    aqi = None
+    if aqi_cfg.get('enabled', False):
+        aqi = AqiEngine(aqi_cfg.get('field', 'pm25'), scale=aqi_cfg.get('scale', 1.0))
+
+    cache = None
+    local_api = None
+    if local_api_cfg.get('enabled', False):
+        cache = LastValueCache(history=local_api_cfg.get('history', 360))
         try:
-            LOGGER.info("Waiting for data in queue")
-            data = queue.peek(blocking=True)
-            data = decode_dict(data)
-            data = json.dumps(data)
-            info = client.publish("epifi/v1/{}".format(mqtt_cfg['uname']), data, qos=1)
-            info.wait_for_publish()
-
-            while info.rc != 0:
-                time.sleep(10)
-                info=client.publish("epifi/v1/{}".format(mqtt_cfg['uname']), data, qos=1)
-                info.wait_for_publish()
-
-            LOGGER.info("Deleting data from queue")
-            queue.delete()
-            queue.flush()
-
-            for sensor in input_sensors:
-                sensor.transmitted_data(len(queue))
-
-        except KeyboardInterrupt:
-            global RUNNING
-            RUNNING = False
-            for sensor in output_sensors + input_sensors:
-                LOGGER.debug("Stopping %s", sensor.name)
-                sensor.stop()
-            break
+            local_api = LocalApi(cache, host=local_api_cfg.get('host', '127.0.0.1'),
+                                 port=local_api_cfg.get('port', 8090),
+                                 socket_path=local_api_cfg.get('socket'))
+            local_api.start()
+        except OSError:
+            LOGGER.exception("Unable to start the local API")
+
+    sensor_thread = Thread(target=read_data, args=(output_sensors, input_sensors,
+                                                   lanes if lanes is not None else queue,
+                                                   clock, retention, schemas, quota,
+                                                   deadband, sampler, aqi,
+                                                   calibration, cache, health))
+    sensor_thread.start()
 
-        except msgpack.exceptions.UnpackValueError as e:
-            LOGGER.exception("Unable to unpack data")
-            break
+    network_ready = Event()
+    Thread(target=restart_wifi, args=(status, network_ready),
+           name="NetworkThread", daemon=True).start()
+    clock_sync = ClockSync(clock,
+                           SntpClient(ntp_cfg.get('servers', ['pool.ntp.org']),
+                                      timeout=ntp_cfg.get('timeout', 5)),
+                           interval=ntp_cfg.get('interval', 600))
+    Thread(target=sync_clock, args=(clock_sync, network_ready),
+           name="ClockThread", daemon=True).start()
 
-        except Exception as e:
-            bad_data=queue.peek()
-            LOGGER.error("Exception- %s occurred while listening to data %s", e,str(bad_data))
-            LOGGER.info("Pushing data into bad queue")
-            error_msg={"message":(str(e)), "data":(str(data))}
-            bad_queue.push(error_msg)
-            queue.delete()
-            queue.flush()
-
-    LOGGER.debug("Waiting for sensor thread")
-    sensor_thread.join()
-    LOGGER.debug("Shutting down client")
-    client.loop_stop()
-    LOGGER.debug("Quitting...")
+    try:
+        if transport == 'coap':
+            serve_coap(cfg.get('coap') or {}, queue, clock, output_sensors)
+        else:
+            publish_mqtt(mqtt_cfg, queue, bad_queue, clock, network_ready,
+                         input_sensors, schemas, lanes)
+    finally:
+        global RUNNING
+        RUNNING = False
+        clock_sync.stop()
+        if compactor is not None:
+            compactor.stop()
+        if local_api is not None:
+            local_api.stop()
+        for sensor in output_sensors + input_sensors:
+            LOGGER.debug("Stopping %s", sensor.name)
+            sensor.stop()
+
+        LOGGER.debug("Waiting for sensor thread")
+        sensor_thread.join()
+        if retention is not None:
+            retention.close()
+        LOGGER.debug("Quitting...")
 
 
 if __name__ == '__main__':
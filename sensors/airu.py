@@ -21,6 +21,10 @@ class AirStation:
 
         self.type = 'output'
         self.name = 'airu'
+        self.fields = ['humidity', 'temperature', 'pm1', 'pm25', 'pm10']
+        # The PMS3003 reports about once a second, but the DHT22 can only be
+        # read every 2 seconds
+        self.min_interval = 2
 
         # Turn off LEDs
         subprocess.call('echo none > /sys/class/leds/beaglebone\:green\:usr0/trigger', shell=True)
@@ -107,9 +111,8 @@ class AirStation:
         humidity = round(humidity, 2) if humidity is not None else None
         temperature = round(temperature, 2) if temperature is not None else None
 
+        # A bad frame is left as None; the next read flushes and gets a new one
         pm1, pm25, pm10 = self.get_pm()
-        if pm1 is None:  # If one value is None, they are all
-            pm1, pm25, pm10 = self.get_pm()  # Try one more time
 
         data = {'humidity': humidity,
                 'temperature': temperature,
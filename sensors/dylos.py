@@ -20,6 +20,9 @@ class Dylos:
     def __init__(self, port='/dev/ttyO1', baudrate=9600, timeout=TIMEOUT):
         self.type = 'output'
         self.name = 'dylos'
+        self.fields = ['pm_small', 'pm_large']
+        # The Dylos only reports once a minute
+        self.min_interval = 60
 
         self.running = True
         self.queue = Queue()
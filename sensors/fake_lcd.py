@@ -7,6 +7,9 @@ import time
 
 LOGGER = logging.getLogger(__name__)
 
+# Never run in a worker process
+TYPE = 'input'
+
 
 def setup_sensor(config):
     return LCDWriter(display_aq=config['display_air_quality'])
@@ -27,6 +30,7 @@ class LCDWriter:
         self.pm1 = 0
         self.pm25 = 0
         self.pm10 = 0
+        self.aqi = None
         self.update_air_time = None
 
         self.queue_size = 0
@@ -48,11 +52,12 @@ class LCDWriter:
         data = data['data']
 
         self.update_air_time = datetime.now()
-        self.queue_size = data['queue_length'][0]
+        self.queue_size = data['queue_length']
 
         self.pm1 = data.get('pm1', 0)
         self.pm25 = data.get('pm25', 0)
         self.pm10 = data.get('pm10', 0)
+        self.aqi = data.get('aqi')
         self.address = data.get('ip_address', '').split('.')[-1]
 
         self.display_data()
@@ -72,6 +77,8 @@ class LCDWriter:
             part_1 = 'bad' if self.pm1 is None else self.pm1
             part_2 = 'bad' if self.pm25 is None else self.pm25
             part_3 = 'bad' if self.pm10 is None else self.pm10
+            if self.aqi is not None:
+                part_3 = 'A{}'.format(self.aqi)
         else:
             valid_data = 'not ok' if self.pm1 is None or self.pm25 is None or self.pm10 is None else 'ok'
             part_1 = ''
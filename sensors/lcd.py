@@ -7,8 +7,21 @@ import time
 import Adafruit_BBIO.GPIO as GPIO
 import Adafruit_BBIO.PWM as PWM
 
+from utils.aqi import category
+
 LOGGER = logging.getLogger(__name__)
 
+# Never run in a worker process
+TYPE = 'input'
+
+# Backlight for each AQI category, as close to the EPA colours as the presets get
+BACKLIGHT = {'good': 'set_green',
+             'moderate': 'set_yellow',
+             'unhealthy_for_sensitive_groups': 'set_orange',
+             'unhealthy': 'set_red',
+             'very_unhealthy': 'set_purple',
+             'hazardous': 'set_violet'}
+
 
 # To properly clock LCD I had to use exotic microsecond range sleep function
 def usleep(sleep_time):
@@ -169,6 +182,8 @@ class LCDWriter:
 
         self.small = 0
         self.large = 0
+        self.aqi = None
+        self.backlight = None
         self.update_air_time = None
 
         self.queue_size = 0
@@ -178,13 +193,17 @@ class LCDWriter:
 
 
     def start(self):
+        self.lcd = None
         try:
-            self.lcd = LCDDriver()
-            self.lcd.setup()
+            self.connect()
         except Exception as exp:
             LOGGER.error("Error occurred while setting up LCD screen: %s ", exp)
             LOGGER.error("Probably means it is not connected.")
-            self.lcd = None
+
+    def connect(self):
+        lcd = LCDDriver()
+        lcd.setup()
+        self.lcd = lcd
 
     def stop(self):
         pass
@@ -199,10 +218,27 @@ class LCDWriter:
 
         self.small = data.get('pm_small', 0)
         self.large = data.get('pm_large', 0)
+        self.aqi = data.get('aqi')
         self.address = data.get('ip_address', '').split('.')[-1]
 
+        self.set_backlight()
         self.display_data()
 
+    def set_backlight(self):
+        """Colours the backlight by AQI category, only when the category changes."""
+        if self.aqi is None or self.lcd is None:
+            return
+
+        backlight = BACKLIGHT[category(self.aqi)]
+        if backlight == self.backlight:
+            return
+
+        try:
+            getattr(self.lcd, backlight)()
+            self.backlight = backlight
+        except Exception as exp:
+            LOGGER.error("An exception occurred while setting the backlight: %s", exp)
+
     def transmitted_data(self, queue_length):
         self.update_queue_time = datetime.now()
         self.queue_size = queue_length
@@ -217,6 +253,8 @@ class LCDWriter:
         if self.display_aq:
             part_1 = 'bad' if self.small is None else self.small
             part_2 = 'bad' if self.large is None else self.large
+            if self.aqi is not None:
+                part_2 = 'A{}'.format(self.aqi)
         else:
             valid_data = 'not ok' if self.small is None or self.large is None else 'ok'
             part_1 = ''
@@ -242,15 +280,14 @@ class LCDWriter:
             LOGGER.debug("Line 1: %s", self.line1)
             LOGGER.debug("Line 2: %s", self.line2)
 
+            # Failures are left to the health supervisor, which stops
+            # calling this while the LCD isn't there
             if self.lcd is None:
-                LOGGER.warning("LCD is not connected")
-            else:
-                try:
-                    self.lcd.lcdcommand('00000001')  # Reset
-                    self.lcd.lcdprint(self.line1)
-                    self.lcd.lcdcommand('11000000')  # Move cursor down
-                    self.lcd.lcdprint(self.line2)
-                    self.lcd.lcdcommand('10000000')  # Move cursor to beginning
-                except Exception as exp:
-                    LOGGER.error(
-                        "An exception occurred while writing to LCD: %s", exp)
+                # It may have been plugged in since
+                self.connect()
+
+            self.lcd.lcdcommand('00000001')  # Reset
+            self.lcd.lcdprint(self.line1)
+            self.lcd.lcdcommand('11000000')  # Move cursor down
+            self.lcd.lcdprint(self.line2)
+            self.lcd.lcdcommand('10000000')  # Move cursor to beginning
@@ -20,6 +20,8 @@ class PingMonitor:
         self.destination = destination
         self.interval = interval
         self.prefix = prefix
+        self.fields = [prefix + field for field in
+                       ('ping_errors', 'ping_latency', 'ping_packet_loss', 'ping_total')]
 
         self.errors = 0
         self.loss = 0
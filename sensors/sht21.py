@@ -1,42 +1,45 @@
 import logging
 
+from sensors.sysfs import Channel
+
 LOGGER = logging.getLogger(__name__)
 
+DEVICE = '/sys/bus/i2c/drivers/sht21/1-0040/'
+
 
 def setup_sensor(config):
-    return Sht21()
+    config = config or {}
+    return Sht21(fahrenheit=config.get('fahrenheit', True))
 
 
 class Sht21:
-    def __init__(self):
+    def __init__(self, fahrenheit=True):
         self.type = 'output'
         self.name = 'sht21'
-
-    def _get_temp(self):
-        with open('/sys/bus/i2c/drivers/sht21/1-0040/temp1_input') as f:
-            temp = f.readline().strip()
-            return float(temp) / 1000
-
-    def _get_humidity(self):
-        with open('/sys/bus/i2c/drivers/sht21/1-0040/humidity1_input') as f:
-            humidity = f.readline().strip()
-            return float(humidity) / 1000
+        self.fields = ['temperature', 'humidity']
+        # Fahrenheit unless configured otherwise, as it always was; calibration
+        # can convert the raw Celsius reading instead
+        self.fahrenheit = fahrenheit
+        # Kept open between reads
+        self.temp = Channel('temperature', DEVICE + 'temp1_input', scale=0.001)
+        self.humidity = Channel('humidity', DEVICE + 'humidity1_input', scale=0.001)
 
     def start(self):
         pass
 
     def read(self):
-        try:
-            temp = round(self._get_temp() * 1.8 + 32, 2)
-        except Exception:
-            temp = None
+        temp = self.temp.read()
+        if temp is not None:
+            if self.fahrenheit:
+                temp = temp * 1.8 + 32
+            temp = round(temp, 2)
 
-        try:
-            humidity = round(self._get_humidity(), 2)
-        except Exception:
-            humidity = None
+        humidity = self.humidity.read()
+        if humidity is not None:
+            humidity = round(humidity, 2)
 
         return {'temperature': temp, 'humidity': humidity}
 
     def stop(self):
-        pass
+        self.temp.close()
+        self.humidity.close()
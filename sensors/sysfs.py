@@ -0,0 +1,267 @@
+"""
+Generic sensor for hwmon and IIO channels exposed in sysfs.
+
+Channels are discovered from /sys/class/hwmon (<type><n>_input files) and
+/sys/bus/iio/devices (in_<type>[_<n>]_raw or _input files, with the device's
+_scale and _offset), or listed in the configuration. A new I2C sensor with a
+kernel driver is then only a configuration change:
+
+    sysfs:
+      name: sysfs
+      interval: 1          # seconds between background readings
+      aggregate: mean      # mean, median, min, max or last
+      devices: [sht21]     # only discover these devices (all if not set)
+      channels:            # instead of discovering
+        - field: temperature
+          path: bus/i2c/drivers/sht21/1-0040/temp1_input
+          scale: 0.001
+          offset: 0
+          aggregate: median
+
+Each channel's file is opened once and read with os.pread, so a reading
+doesn't open or close anything. Channels are read every interval seconds in
+the background, and only that thread touches the files; read() returns the
+aggregate of the readings since the last call (or the last reading if there
+hasn't been a new one), as (raw + offset) * scale, with hwmon and IIO values
+converted to degrees, percent, volts, amps and watts. Set root to read from a
+fake sysfs tree instead of /sys.
+"""
+import logging
+import os
+import statistics
+from threading import Lock, Thread
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+READ_SIZE = 64
+
+# hwmon channel types and the scale from their sysfs units
+HWMON_TYPES = {'temp': 0.001,      # millidegrees Celsius
+               'humidity': 0.001,  # milli-percent
+               'in': 0.001,        # millivolts
+               'curr': 0.001,      # milliamps
+               'power': 0.000001,  # microwatts
+               'fan': 1,           # RPM
+               'pressure': 1}
+
+# IIO types whose values are in milli units once scaled
+IIO_MILLI = {'temp', 'humidityrelative', 'voltage', 'current'}
+
+AGGREGATES = {'mean': statistics.mean,
+              'median': statistics.median,
+              'min': min,
+              'max': max,
+              'last': lambda values: values[-1]}
+
+
+def setup_sensor(config):
+    config = config or {}
+    return SysfsSensor(name=config.get('name', 'sysfs'),
+                       root=config.get('root', '/sys'),
+                       channels=config.get('channels'),
+                       devices=config.get('devices'),
+                       interval=config.get('interval', 1),
+                       aggregate=config.get('aggregate', 'mean'))
+
+
+def read_text(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+class Channel:
+    """One sysfs attribute, kept open and read with pread."""
+    def __init__(self, field, path, scale=1, offset=0, aggregate='mean', digits=3):
+        if aggregate not in AGGREGATES:
+            raise ValueError("Unknown aggregate for {}: {}".format(field, aggregate))
+
+        self.field = field
+        self.path = path
+        self.scale = scale
+        self.offset = offset
+        self.aggregate = AGGREGATES[aggregate]
+        self.digits = digits
+        self.fd = None
+        self.lock = Lock()
+        self.readings = []
+        self.last = None
+
+    def open(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read(self):
+        """Returns the scaled value, or None if it can't be read."""
+        try:
+            self.open()
+            raw = os.pread(self.fd, READ_SIZE, 0)
+            return (float(raw.strip()) + self.offset) * self.scale
+        except OSError as e:
+            LOGGER.debug("Unable to read %s: %s", self.path, e)
+            # The device may have gone away and come back
+            self.close()
+            return None
+        except ValueError:
+            LOGGER.debug("Unable to parse %s: %r", self.path, raw)
+            return None
+
+    def sample(self):
+        """Reads the channel for result(); only called from one thread."""
+        value = self.read()
+        with self.lock:
+            if value is not None:
+                self.readings.append(value)
+            self.last = value
+
+    def result(self):
+        with self.lock:
+            readings, self.readings = self.readings, []
+            last = self.last
+
+        if not readings:
+            return None if last is None else round(last, self.digits)
+        return round(self.aggregate(readings), self.digits)
+
+
+def discover_hwmon(root, devices=None, aggregate='mean'):
+    base = os.path.join(root, 'class', 'hwmon')
+    if not os.path.isdir(base):
+        return []
+
+    channels = []
+    for entry in sorted(os.listdir(base)):
+        directory = os.path.join(base, entry)
+        try:
+            device = read_text(os.path.join(directory, 'name'))
+        except OSError:
+            continue
+        if devices is not None and device not in devices:
+            continue
+
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith('_input'):
+                continue
+            channel = filename[:-len('_input')]
+            kind = channel.rstrip('0123456789')
+            if kind not in HWMON_TYPES:
+                continue
+
+            try:
+                label = read_text(os.path.join(directory, channel + '_label'))
+            except OSError:
+                label = channel
+            channels.append(Channel('{}_{}'.format(device, label.replace(' ', '_')),
+                                    os.path.join(directory, filename),
+                                    scale=HWMON_TYPES[kind], aggregate=aggregate))
+    return channels
+
+
+def _iio_attribute(directory, prefix, kind, name, default):
+    """A channel's own scale or offset, or the one shared by its type."""
+    for candidate in (prefix + '_' + name, 'in_' + kind + '_' + name):
+        try:
+            return float(read_text(os.path.join(directory, candidate)))
+        except (OSError, ValueError):
+            continue
+    return default
+
+
+def discover_iio(root, devices=None, aggregate='mean'):
+    base = os.path.join(root, 'bus', 'iio', 'devices')
+    if not os.path.isdir(base):
+        return []
+
+    channels = []
+    for entry in sorted(os.listdir(base)):
+        directory = os.path.join(base, entry)
+        try:
+            device = read_text(os.path.join(directory, 'name'))
+        except OSError:
+            continue
+        if devices is not None and device not in devices:
+            continue
+
+        for filename in sorted(os.listdir(directory)):
+            if not filename.startswith('in_'):
+                continue
+            if filename.endswith('_raw'):
+                prefix = filename[:-len('_raw')]
+            elif filename.endswith('_input'):
+                prefix = filename[:-len('_input')]
+            else:
+                continue
+
+            channel = prefix[len('in_'):]
+            kind = channel.split('_')[0].rstrip('0123456789')
+            if filename.endswith('_raw'):
+                scale = _iio_attribute(directory, prefix, kind, 'scale', 1.0)
+                offset = _iio_attribute(directory, prefix, kind, 'offset', 0.0)
+            else:
+                # Already processed by the driver
+                scale, offset = 1.0, 0.0
+            if kind in IIO_MILLI:
+                scale *= 0.001
+            channels.append(Channel('{}_{}'.format(device, channel),
+                                    os.path.join(directory, filename),
+                                    scale=scale, offset=offset, aggregate=aggregate))
+    return channels
+
+
+class SysfsSensor:
+    def __init__(self, name='sysfs', root='/sys', channels=None, devices=None,
+                 interval=1, aggregate='mean'):
+        self.type = 'output'
+        self.name = name
+        self.interval = interval
+        self.running = True
+
+        if channels:
+            self.channels = [Channel(channel['field'],
+                                     os.path.join(root, channel['path']),
+                                     scale=channel.get('scale', 1),
+                                     offset=channel.get('offset', 0),
+                                     aggregate=channel.get('aggregate', aggregate),
+                                     digits=channel.get('round', 3))
+                             for channel in channels]
+        else:
+            self.channels = discover_hwmon(root, devices, aggregate) + \
+                discover_iio(root, devices, aggregate)
+
+        self.fields = [channel.field for channel in self.channels]
+
+        if not self.channels:
+            LOGGER.warning("No sysfs channels found under %s", root)
+        for channel in self.channels:
+            LOGGER.info("Reading %s from %s", channel.field, channel.path)
+
+    def start(self):
+        self.thread = Thread(target=self._run, name="SysfsThread", daemon=True)
+        self.thread.start()
+
+    def _sleep(self, amount):
+        while amount > 0 and self.running:
+            time.sleep(min(amount, 1))
+            amount -= 1
+
+    def _run(self):
+        while self.running:
+            for channel in self.channels:
+                channel.sample()
+            self._sleep(self.interval)
+
+        for channel in self.channels:
+            channel.close()
+
+    def read(self):
+        return {channel.field: channel.result() for channel in self.channels}
+
+    def stop(self):
+        # The thread closes the files once it is done with them
+        self.running = False
+        self.thread.join()
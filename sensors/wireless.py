@@ -1,12 +1,47 @@
+import fcntl
 import logging
-from subprocess import run, check_output, CalledProcessError, TimeoutExpired
-import re
+import socket
+import struct
+from subprocess import run
 import threading
 import time
 
+from utils.device_info import get_device_info
+
 
 LOGGER = logging.getLogger(__name__)
 
+# Wireless extension ioctls, the same ones iwconfig uses
+SIOCGIWAP = 0x8B15
+SIOCGIWRATE = 0x8B21
+IWREQ_SIZE = 32
+# iwconfig reports these access point addresses as "Not-Associated"
+NOT_ASSOCIATED = (b'\x00' * 6, b'\xff' * 6, b'\x44' * 6)
+# Seconds between association checks
+WATCHDOG_INTERVAL = 60
+
+
+def _iw_ioctl(interface, request):
+    name = interface.encode()[:15]
+    buf = bytearray(IWREQ_SIZE)
+    buf[:len(name)] = name
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        fcntl.ioctl(sock.fileno(), request, buf)
+    return buf[16:]
+
+
+def is_associated(interface):
+    # struct sockaddr: family followed by the access point's MAC address
+    ap_address = bytes(_iw_ioctl(interface, SIOCGIWAP)[2:8])
+    return ap_address not in NOT_ASSOCIATED
+
+
+def get_bit_rate(interface):
+    # struct iw_param: value is in bits per second
+    return struct.unpack_from('i', _iw_ioctl(interface, SIOCGIWRATE))[0]
+
+
 def setup_sensor(config):
     return WirelessMonitor()
 
@@ -17,98 +52,116 @@ class WirelessMonitor:
         self.name = 'wireless'
 
         self.connecting = threading.Event()
+        self.device = get_device_info()
+        self.interface = None
+        self.running = True
+        self.failing = set()  # Probes that failed last time
 
     def start(self):
-        # Figure out what the wireless interface is
-        try:
-            self.interface = check_output('iwconfig 2> /dev/null '
-                                          '| grep -o "^[[:alnum:]]\+"',
-                                          shell=True)
-            self.interface = self.interface.strip().decode('utf8')
-            LOGGER.debug("Monitoring wireless interface {}".format(self.interface))
-        except Exception:
+        # The wireless interface is discovered by the device information
+        self.interface = self.device.interface
+        if self.interface is None:
             LOGGER.warning("No wireless interface to monitor!")
-            self.interface = None
+        else:
+            LOGGER.debug("Monitoring wireless interface {}".format(self.interface))
+
+        # Reconnecting doesn't depend on read(), which the health supervisor
+        # may stop calling
+        self.thread = threading.Thread(target=self._watch, name="WirelessWatchdog",
+                                       daemon=True)
+        self.thread.start()
 
     def stop(self):
-        pass
+        self.running = False
+
+    def _sleep(self, amount):
+        while amount > 0 and self.running:
+            time.sleep(min(amount, 1))
+            amount -= 1
+
+    def _watch(self):
+        while self.running:
+            self._sleep(WATCHDOG_INTERVAL)
+            interface = self.device.interface
+            if interface is None or not self.running:
+                continue
+
+            try:
+                associated = is_associated(interface)
+            except OSError as e:
+                LOGGER.debug("Unable to check association of %s: %s", interface, e)
+                continue
+
+            # If not associated, try to connect
+            if not associated and not self.connecting.is_set():
+                LOGGER.warning("Not associated! Trying to reconnect")
+                self.interface = interface
+                self.connect()
+
+    def _probe(self, name, probe, data):
+        """Runs one probe, so the others still report if it fails."""
+        try:
+            probe(data)
+        except (OSError, ValueError, IndexError) as e:
+            if name not in self.failing:
+                LOGGER.warning("Unable to get wireless %s: %s", name, e)
+                self.failing.add(name)
+            return
+
+        if name in self.failing:
+            LOGGER.info("Getting wireless %s again", name)
+            self.failing.discard(name)
 
     def read(self):
         data = {}
 
+        self.interface = self.device.interface
         if self.interface is None:
             return data
 
         data['ip_address'] = self.ip_address()
+        self._probe('stats', self._read_stats, data)
+        self._probe('association', self._read_association, data)
+        return data
 
+    def _read_stats(self, data):
+        with open('/proc/net/wireless') as f:
+            lines = [line for line in f if line.strip().startswith(self.interface)]
+        stats = lines[0].split()
+        stats = stats[2:11]
+        stats[0] = float(stats[0])
+        stats = [int(x) for x in stats]
+
+        data.update({'link_quality': stats[0],
+                     'signal_level': stats[1],
+                     'noise_level': stats[2],
+                     'rx_invalid_nwid': stats[3],
+                     'rx_invalid_crypt': stats[4],
+                     'rx_invalid_frag': stats[5],
+                     'tx_retires': stats[6],
+                     'invalid_misc': stats[7],
+                     'missed_beacon': stats[8]})
+
+    def _read_association(self, data):
+        # Determine if connected
+        data['associated'] = int(is_associated(self.interface))
+        if not data['associated']:
+            return
+
+        # Get bit rate. cfg80211 drivers have no rate without a current BSS
         try:
-            # Get stats
-            with open('/proc/net/wireless') as f:
-                lines = [line for line in f if line.strip().startswith(self.interface)]
-            stats = lines[0].split()
-            stats = stats[2:11]
-            stats[0] = float(stats[0])
-            stats = [int(x) for x in stats]
-
-            data.update({'link_quality': stats[0],
-                         'signal_level': stats[1],
-                         'noise_level': stats[2],
-                         'rx_invalid_nwid': stats[3],
-                         'rx_invalid_crypt': stats[4],
-                         'rx_invalid_frag': stats[5],
-                         'tx_retires': stats[6],
-                         'invalid_misc': stats[7],
-                         'missed_beacon': stats[8]})
-        except Exception:
-            LOGGER.exception("Exception occurred while getting wireless stats")
-
-        try:
-            result = check_output('iwconfig {}'.format(self.interface),
-                                  shell=True,
-                                  timeout=5)
-            result = result.decode('utf8')
-
-            # Determine if connected
-            data['associated'] = int('Not-Associated' not in result)
-
-            # Get bit rate
-            m = re.search("Bit Rate=(\\d+) Mb/s", result)
-            if m is not None:
-                data['data_rate'] = int(m.group(1))
-
-            # If not associated, start thread to try to connect
-            if not data['associated']:
-                LOGGER.warning("Not associated! Trying to reconnect")
-
-                if not self.connecting.is_set():
-                    LOGGER.info("Starting thread to connect")
-                    t = threading.Thread(target=self.connect)
-                    t.start()
-                else:
-                    LOGGER.info("A thread is already trying to connect to WiFi")
-
-        except Exception:
-            LOGGER.exception("Exception occurred while running iwconfig")
-
-        return data
+            bit_rate = get_bit_rate(self.interface)
+        except OSError as e:
+            LOGGER.debug("Unable to get bit rate of %s: %s", self.interface, e)
+        else:
+            if bit_rate > 0:
+                data['data_rate'] = bit_rate // 1000000
 
     def ip_address(self):
         if self.interface is None:
             return ''
 
-        try:
-            ip = check_output('ifconfig {} '
-                              '| grep "inet addr"'
-                              '| cut -d: -f2 '
-                              '| cut -d" " -f1'.format(self.interface),
-                              shell=True,
-                              timeout=5)
-            ip = ip.strip().decode('utf8')
-            LOGGER.info("IP address: %s", ip)
-            return ip
-        except Exception:
-            LOGGER.warning("Unable to get IP address")
-            return ''
+        return self.device.ip_address
 
     def connect(self):
         self.connecting.set()
@@ -0,0 +1,85 @@
+import json
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+
+from persistent_queue import PersistentQueue
+
+from utils import coap
+from utils.coap_client import Client
+from utils.coap_server import CoapServer
+
+
+class CoapServerTest(unittest.TestCase):
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.queue = PersistentQueue('sensor.queue', path=path)
+
+        self.server = CoapServer(self.queue, lambda sample: sample, 'test', 'test',
+                                 host='127.0.0.1', port=0, block_size=64,
+                                 multicast=False)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def push(self, count, start=0):
+        for i in range(start, start + count):
+            self.queue.push({'sample_time': i, 'data': {'value': i}})
+        self.queue.flush()
+
+    def test_block_wise_get(self):
+        self.push(20)
+        client = Client(server=self.server.address)
+        self.addCleanup(client.stop)
+
+        response = client.get('air_quality', payload=struct.pack('!HH', 0, 20),
+                              timeout=10)
+        self.assertIsNotNone(response)
+        self.assertEqual(response.code, coap.CONTENT)
+
+        # Reassembled from several 64 byte blocks
+        num, more, size = coap.decode_block(response.option(coap.BLOCK2))
+        self.assertGreater(num, 0)
+        self.assertFalse(more)
+        self.assertEqual(size, 64)
+        self.assertEqual(json.loads(response.payload.decode()),
+                         [{'sample_time': i, 'data': {'value': i}} for i in range(20)])
+
+        # The next request acknowledges them
+        response = client.get('air_quality', payload=struct.pack('!HH', 20, 5),
+                              timeout=10)
+        self.assertEqual(json.loads(response.payload.decode()), [])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_observe_notification(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(10)
+        self.addCleanup(sock.close)
+
+        request = coap.Message(coap.CON, coap.GET, mid=1, token=b'obs1',
+                               options=[(coap.OBSERVE, 0)],
+                               payload=struct.pack('!HH', 0, 1))
+        request.uri_path = 'air_quality'
+        sock.sendto(request.encode(), self.server.address)
+
+        response = coap.Message.decode(sock.recv(65535))
+        self.assertEqual(response.mtype, coap.ACK)
+        self.assertEqual(response.token, b'obs1')
+        self.assertIsNotNone(response.option(coap.OBSERVE))
+        self.assertEqual(json.loads(response.payload.decode()), [])
+
+        # Queuing a sample notifies the observer
+        self.push(1, start=7)
+        notification = coap.Message.decode(sock.recv(65535))
+        self.assertEqual(notification.token, b'obs1')
+        self.assertEqual(notification.code, coap.CONTENT)
+        self.assertGreater(notification.option(coap.OBSERVE),
+                           response.option(coap.OBSERVE))
+        self.assertEqual(json.loads(notification.payload.decode()),
+                         [{'sample_time': 7, 'data': {'value': 7}}])
+
+
+if __name__ == '__main__':
+    unittest.main()
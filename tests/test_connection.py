@@ -0,0 +1,116 @@
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from utils.connection import Backoff, ConnectionMetrics, make_tls_context, probe
+
+
+class TlsStandIn:
+    """Accepts TLS connections on loopback, sends a byte and hangs up."""
+    def __init__(self, cert, key):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(cert, key)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.sock.settimeout(0.2)
+        self.port = self.sock.getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+
+            try:
+                with self.context.wrap_socket(conn, server_side=True) as tls:
+                    tls.sendall(b'x')
+            except (ssl.SSLError, OSError):
+                pass
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+
+class ResumptionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if shutil.which('openssl') is None:
+            raise unittest.SkipTest("openssl is needed to make a certificate")
+
+        cls.path = tempfile.mkdtemp()
+        cls.cert = os.path.join(cls.path, 'cert.pem')
+        cls.key = os.path.join(cls.path, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                        '-keyout', cls.key, '-out', cls.cert, '-days', '1',
+                        '-subj', '/CN=localhost',
+                        '-addext', 'subjectAltName=DNS:localhost'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path)
+
+    def test_second_connection_is_resumed(self):
+        server = TlsStandIn(self.cert, self.key)
+        self.addCleanup(server.close)
+
+        metrics = ConnectionMetrics()
+        context = make_tls_context(self.cert, metrics)
+        results = probe('localhost', server.port, context, 3)
+
+        self.assertEqual([resumed for _, resumed in results], [False, True, True])
+        self.assertEqual(metrics.handshakes, 3)
+        self.assertEqual(metrics.resumed, 2)
+
+    def test_session_is_only_offered_to_the_same_host(self):
+        server = TlsStandIn(self.cert, self.key)
+        self.addCleanup(server.close)
+
+        context = make_tls_context(self.cert)
+        probe('localhost', server.port, context, 1)
+        self.assertEqual(context.session_host, 'localhost')
+
+        context.check_hostname = False
+        with socket.create_connection(('127.0.0.1', server.port)) as sock:
+            with context.wrap_socket(sock, server_hostname='127.0.0.1') as tls:
+                self.assertFalse(tls.session_reused)
+
+
+class BackoffTest(unittest.TestCase):
+    def delays(self, backoff, count):
+        return [backoff.next() for _ in range(count)]
+
+    def test_grows_to_maximum(self):
+        backoff = Backoff(initial=1, maximum=8)
+        with mock.patch('utils.connection.random.uniform', lambda low, high: high):
+            self.assertEqual(self.delays(backoff, 6), [1, 2, 4, 8, 8, 8])
+
+        backoff.reset()
+        with mock.patch('utils.connection.random.uniform', lambda low, high: low):
+            self.assertEqual(self.delays(backoff, 6), [0.5, 1, 2, 4, 4, 4])
+
+    def test_jitter_stays_within_bounds(self):
+        backoff = Backoff(initial=1, maximum=300)
+        for attempt, delay in enumerate(self.delays(backoff, 20)):
+            ceiling = min(300, 2 ** attempt)
+            self.assertGreaterEqual(delay, ceiling / 2)
+            self.assertLessEqual(delay, ceiling)
+
+
+if __name__ == '__main__':
+    unittest.main()
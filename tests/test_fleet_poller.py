@@ -0,0 +1,80 @@
+from concurrent.futures import Future
+import threading
+import unittest
+
+from utils import coap
+from utils.coap_server import CoapServer
+from utils.fleet_poller import Device, FleetPoller
+
+
+class ListQueue:
+    def __init__(self, items):
+        self.items = list(items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def peek(self, count):
+        if count == 1:
+            return self.items[0] if self.items else None
+        return self.items[:count]
+
+    def delete(self, count):
+        del self.items[:count]
+
+    def flush(self):
+        pass
+
+
+class LossyClient:
+    """Hands requests straight to a server, losing the responses to some."""
+    def __init__(self, server, lose):
+        self.server = server
+        self.lose = set(lose)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def request(self, path, payload=None, destination=None):
+        message = coap.Message(coap.CON, coap.GET, payload=payload)
+        message.uri_path = path
+        message.source = destination
+
+        with self.lock:
+            self.requests += 1
+            number = self.requests
+            response = self.server._handle_request(message, False)
+
+        future = Future()
+        # The device handled the request, but the response never arrives
+        future.set_result(None if number in self.lose else response)
+        return future
+
+
+class FleetPollerTest(unittest.TestCase):
+    def drain(self, lose):
+        queue = ListQueue(range(25))
+        server = CoapServer(queue, lambda sample: sample, 'test', 'test',
+                            host='127.0.0.1', port=0, multicast=False)
+        self.addCleanup(server.sock.close)
+
+        received = []
+        poller = FleetPoller(LossyClient(server, lose), [Device(('127.0.0.1', 1))],
+                             size=10, sink=lambda device, samples: received.extend(samples))
+        poller.run()
+        return queue, received
+
+    def test_drains_everything(self):
+        queue, received = self.drain(lose=[])
+        self.assertEqual(received, list(range(25)))
+        self.assertEqual(len(queue), 0)
+
+    def test_lost_response_loses_no_samples(self):
+        # The second request acknowledges the first batch and is sent the
+        # second one, which is lost
+        queue, received = self.drain(lose=[2])
+        self.assertEqual(sorted(set(received)), list(range(25)))
+        self.assertEqual(len(queue), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import socket
+import threading
+import time
+import unittest
+
+from utils.clock import SampleClock
+from utils.sntp import NTP_PACKET, NTP_TIMESTAMP, ClockSync, SntpClient, to_ntp
+
+
+class SntpStandIn:
+    """Answers SNTP requests on loopback with monotonic time + offset + drift."""
+    def __init__(self, offset, drift=0.0):
+        self.offset = offset
+        self.drift = drift
+        self.base = time.monotonic()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.2)
+        self.address = self.sock.getsockname()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def true_time(self, monotonic):
+        return monotonic + self.offset + self.drift * (monotonic - self.base)
+
+    def _run(self):
+        while self.running:
+            try:
+                request, client = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+
+            now = NTP_TIMESTAMP.pack(*to_ntp(self.true_time(time.monotonic())))
+            response = bytearray(NTP_PACKET.size)
+            response[0] = (4 << 3) | 4  # Version 4, server
+            response[1] = 1  # Stratum
+            response[24:32] = request[40:48]
+            response[32:40] = now
+            response[40:48] = now
+            self.sock.sendto(bytes(response), client)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+
+class SntpTest(unittest.TestCase):
+    def server(self, offset, drift=0.0):
+        server = SntpStandIn(offset, drift)
+        self.addCleanup(server.close)
+        return server
+
+    def test_offset(self):
+        server = self.server(1700000000.0)
+        offset, delay, _ = SntpClient([server.address], timeout=1).measure()
+        self.assertAlmostEqual(offset, 1700000000.0, delta=0.005)
+        self.assertLess(delay, 0.05)
+
+    def test_drift(self):
+        server = self.server(1700000000.0, drift=0.01)
+        sync = ClockSync(SampleClock(), SntpClient([server.address], timeout=1),
+                         min_drift_span=0)
+        for _ in range(5):
+            sync.sync()
+            time.sleep(0.25)
+
+        self.assertAlmostEqual(sync.estimate_drift(), 0.01, delta=0.002)
+        self.assertAlmostEqual(sync.clock.now(), server.true_time(time.monotonic()),
+                               delta=0.005)
+
+    def test_correct_unsynced_sample(self):
+        server = self.server(1700000000.0)
+        clock = SampleClock()
+        sample_time, metadata = clock.stamp()
+        self.assertFalse(metadata['clock_synced'])
+
+        sample = {'sample_time': sample_time, 'metadata': metadata}
+        other_boot = {'sample_time': sample_time,
+                      'metadata': dict(metadata, boot_id='another boot')}
+
+        ClockSync(clock, SntpClient([server.address], timeout=1)).sync()
+        clock.correct(sample)
+        clock.correct(other_boot)
+
+        expected = server.true_time(metadata['monotonic_time'] / 1e6)
+        self.assertAlmostEqual(sample['sample_time'] / 1e6, expected, delta=0.005)
+        self.assertTrue(sample['metadata']['clock_synced'])
+        self.assertTrue(sample['metadata']['clock_corrected'])
+
+        # Its monotonic time means nothing in this boot
+        self.assertEqual(other_boot['sample_time'], sample_time)
+        self.assertFalse(other_boot['metadata']['clock_synced'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from sensors.sysfs import SysfsSensor, discover_hwmon, discover_iio
+
+
+class SysfsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        self.write('class/hwmon/hwmon0/name', 'sht21')
+        self.write('class/hwmon/hwmon0/temp1_input', '21500')
+        self.write('class/hwmon/hwmon0/temp1_label', 'board temp')
+        self.write('class/hwmon/hwmon0/humidity1_input', '45250')
+        self.write('class/hwmon/hwmon0/update_interval', '1000')
+        self.write('class/hwmon/hwmon1/name', 'cpu_thermal')
+        self.write('class/hwmon/hwmon1/temp1_input', '48000')
+
+        device = 'bus/iio/devices/iio:device0/'
+        self.write(device + 'name', 'bme280')
+        self.write(device + 'in_pressure_input', '101.325')
+        self.write(device + 'in_temp_raw', '2500')
+        self.write(device + 'in_temp_scale', '10')
+        # A channel's own offset, and the scale shared by its type
+        self.write(device + 'in_voltage0_raw', '1000')
+        self.write(device + 'in_voltage0_offset', '100')
+        self.write(device + 'in_voltage_scale', '0.5')
+        self.write(device + 'sampling_frequency', '1')
+
+    def write(self, path, value):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(value + '\n')
+
+    def values(self, channels):
+        return {channel.field: channel.read() for channel in channels}
+
+    def test_discover_hwmon(self):
+        channels = discover_hwmon(self.root, devices=['sht21'])
+        self.addCleanup(lambda: [channel.close() for channel in channels])
+
+        values = self.values(channels)
+        self.assertEqual(sorted(values), ['sht21_board_temp', 'sht21_humidity1'])
+        self.assertAlmostEqual(values['sht21_board_temp'], 21.5)
+        self.assertAlmostEqual(values['sht21_humidity1'], 45.25)
+
+        self.assertEqual(len(discover_hwmon(self.root)), 3)
+
+    def test_discover_iio(self):
+        channels = discover_iio(self.root)
+        self.addCleanup(lambda: [channel.close() for channel in channels])
+
+        values = self.values(channels)
+        self.assertEqual(sorted(values), ['bme280_pressure', 'bme280_temp',
+                                          'bme280_voltage0'])
+        # Processed by the driver
+        self.assertAlmostEqual(values['bme280_pressure'], 101.325)
+        # raw * scale in millidegrees and millivolts
+        self.assertAlmostEqual(values['bme280_temp'], 25.0)
+        self.assertAlmostEqual(values['bme280_voltage0'], 0.55)
+
+    def test_aggregates_background_samples(self):
+        path = 'class/hwmon/hwmon0/temp1_input'
+        sensor = SysfsSensor(root=self.root, interval=0.05,
+                             channels=[{'field': 'low', 'path': path, 'scale': 0.001,
+                                        'aggregate': 'min'},
+                                       {'field': 'high', 'path': path, 'scale': 0.001,
+                                        'aggregate': 'max'}])
+        sensor.start()
+        self.addCleanup(sensor.stop)
+
+        self.write(path, '10000')
+        time.sleep(0.3)
+        self.write(path, '30000')
+        time.sleep(0.3)
+        self.assertEqual(sensor.read(), {'low': 10.0, 'high': 30.0})
+
+        # Only readings since the last call count
+        time.sleep(0.3)
+        self.assertEqual(sensor.read(), {'low': 30.0, 'high': 30.0})
+
+    def test_missing_channel(self):
+        sensor = SysfsSensor(root=self.root, interval=0.05,
+                             channels=[{'field': 'gone',
+                                        'path': 'class/hwmon/hwmon9/temp1_input'}])
+        sensor.start()
+        self.addCleanup(sensor.stop)
+
+        time.sleep(0.2)
+        self.assertEqual(sensor.fields, ['gone'])
+        self.assertEqual(sensor.read(), {'gone': None})
+
+
+if __name__ == '__main__':
+    unittest.main()
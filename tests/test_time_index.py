@@ -0,0 +1,56 @@
+import shutil
+import tempfile
+import unittest
+
+from utils.time_index import IndexedQueue
+
+
+class IndexedQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def open(self):
+        return IndexedQueue('sensor.queue', path=self.path, index_interval=4)
+
+    def push(self, queue, times):
+        for sample_time in times:
+            queue.push({'sample_time': sample_time, 'data': {'value': sample_time}})
+
+    def test_ordered_ranges(self):
+        queue = self.open()
+        self.push(queue, range(100, 130))
+
+        self.assertEqual(queue.count_between(0, 1000), 30)
+        self.assertEqual(queue.count_between(110, 120), 10)
+        self.assertEqual([sample['sample_time'] for sample in queue.samples_between(105, 108)],
+                         [105, 106, 107])
+
+    def test_clock_going_backwards(self):
+        # Unsynced clock restarting in the past after a reboot
+        queue = self.open()
+        self.push(queue, range(500, 520))
+        self.push(queue, range(0, 10))
+
+        self.assertEqual(queue.count_between(0, 1000), 30)
+        self.assertEqual(queue.count_between(0, 10), 10)
+        self.assertEqual(queue.count_between(505, 515), 10)
+        self.assertEqual(sorted(sample['sample_time']
+                                for sample in queue.samples_between(0, 1000)),
+                         list(range(10)) + list(range(500, 520)))
+
+        # Still known after reopening the queue
+        queue = self.open()
+        self.assertEqual(queue.count_between(0, 1000), 30)
+        self.push(queue, range(10, 15))
+        self.assertEqual(queue.count_between(0, 20), 15)
+
+        # Once the older samples are gone the index is searched again
+        queue.delete(20)
+        queue.flush()
+        self.assertTrue(queue.index.ordered(queue._get_queue_top()))
+        self.assertEqual(queue.count_between(0, 1000), 15)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Samples faster while particulate levels are high or rising.
+
+A 60 second average hides most of a short pollution event (cooking, a puff of
+wildfire smoke). While an event is on, the sampler shortens the interval
+between samples to fast_interval, which is never shorter than what the
+slowest output sensor can deliver (its min_interval: the Dylos only reports
+once a minute, the PMS3003 about once a second and the DHT22 every 2 s).
+
+An event starts when a PM field reaches its level, or rises by at least rise
+per minute between samples. It ends once every field is below its clear_level
+(level by default) and nothing has triggered for hold seconds, so the rate
+doesn't flap around the threshold. Each sample records the interval it was
+taken at in metadata.sample_interval.
+"""
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class Threshold:
+    def __init__(self, level=None, clear_level=None, rise=None):
+        self.level = level
+        self.clear_level = clear_level if clear_level is not None else level
+        self.rise = rise
+
+    def triggered(self, value, previous, now):
+        """previous is (value, time) of the last reading, or None."""
+        if self.level is not None and value >= self.level:
+            return True
+
+        if self.rise is None or previous is None:
+            return False
+        previous_value, previous_time = previous
+        minutes = (now - previous_time) / 60
+        return minutes > 0 and (value - previous_value) / minutes >= self.rise
+
+    def clear(self, value):
+        return self.clear_level is None or value < self.clear_level
+
+
+class AdaptiveSampler:
+    def __init__(self, thresholds, base_interval=60, fast_interval=10, hold=600):
+        self.thresholds = {field: Threshold(**(cfg or {}))
+                           for field, cfg in thresholds.items()}
+        self.base_interval = base_interval
+        self.fast_interval = min(fast_interval, base_interval)
+        self.hold = hold
+
+        self.interval = base_interval
+        self.last = {}  # Field: (value, time)
+        self.triggered_at = None
+
+    def update(self, data):
+        """Adjusts the interval to a new sample's data. Returns the interval."""
+        now = time.monotonic()
+        triggered = False
+        clear = True
+
+        for field, threshold in self.thresholds.items():
+            value = data.get(field)
+            if not is_number(value):
+                continue
+
+            if threshold.triggered(value, self.last.get(field), now):
+                triggered = True
+            if not threshold.clear(value):
+                clear = False
+            self.last[field] = (value, now)
+
+        if triggered:
+            if self.triggered_at is None:
+                LOGGER.info("Particulate event, sampling every %s s", self.fast_interval)
+            self.triggered_at = now
+        elif self.triggered_at is not None and clear and \
+                now - self.triggered_at >= self.hold:
+            LOGGER.info("Particulate event is over, sampling every %s s",
+                        self.base_interval)
+            self.triggered_at = None
+
+        self.interval = self.base_interval if self.triggered_at is None \
+            else self.fast_interval
+        return self.interval
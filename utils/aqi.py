@@ -0,0 +1,149 @@
+"""
+On-device PM2.5 NowCast and AQI.
+
+The EPA NowCast weighs the last 12 hourly averages of PM2.5, more heavily the
+faster the concentration is changing:
+
+    w = max(min(c) / max(c), 0.5)
+    NowCast = sum(w^i * c[i]) / sum(w^i)    (c[0] is the current hour)
+
+It needs at least two of the last three hours. Samples are only added to a
+running sum and count for their hour (two fixed size arrays used as a ring of
+12 hours), so each sample costs the same however many samples an hour holds,
+and the NowCast itself only looks at 12 numbers. The current, partial hour
+counts as the latest hour so the value follows events as they happen.
+
+The ring is saved whenever a new hour starts, so a restart doesn't lose the
+last 12 hours.
+
+The AQI uses the PM2.5 breakpoints from the EPA's 2024 revision.
+"""
+from array import array
+import logging
+import math
+
+from utils.checkpoint import read_state, write_state
+
+LOGGER = logging.getLogger(__name__)
+
+HOURS = 12
+HOUR = 3600 * 1000000  # sample_time is in microseconds
+
+# (concentration low, high, AQI low, high)
+PM25_BREAKPOINTS = [(0.0, 9.0, 0, 50),
+                    (9.1, 35.4, 51, 100),
+                    (35.5, 55.4, 101, 150),
+                    (55.5, 125.4, 151, 200),
+                    (125.5, 225.4, 201, 300),
+                    (225.5, 325.4, 301, 500)]
+
+CATEGORIES = [(50, 'good'),
+              (100, 'moderate'),
+              (150, 'unhealthy_for_sensitive_groups'),
+              (200, 'unhealthy'),
+              (300, 'very_unhealthy'),
+              (math.inf, 'hazardous')]
+
+
+def pm25_aqi(concentration):
+    """AQI for a PM2.5 concentration in ug/m3 (truncated to 0.1 as the EPA does)."""
+    concentration = math.floor(concentration * 10) / 10
+    for low, high, aqi_low, aqi_high in PM25_BREAKPOINTS:
+        if concentration <= high:
+            return round((aqi_high - aqi_low) / (high - low) *
+                         (max(concentration, low) - low) + aqi_low)
+    return 500
+
+
+def category(aqi):
+    for limit, name in CATEGORIES:
+        if aqi <= limit:
+            return name
+
+
+class NowCast:
+    def __init__(self, filename='aqi.state'):
+        self.filename = filename
+        self.sums = array('d', [0.0] * HOURS)
+        self.counts = array('L', [0] * HOURS)
+        self.hour = None  # Hour (since the epoch) of the latest sample
+
+        state = read_state(filename) if filename is not None else None
+        if state:
+            self.sums = array('d', state['sums'])
+            self.counts = array('L', state['counts'])
+            self.hour = state['hour']
+
+    def save(self):
+        if self.filename is not None:
+            write_state(self.filename, {'hour': self.hour,
+                                        'sums': list(self.sums),
+                                        'counts': list(self.counts)})
+
+    def add(self, value, sample_time):
+        hour = sample_time // HOUR
+
+        if self.hour is None or hour - self.hour >= HOURS or hour < self.hour - HOURS:
+            # Nothing in the window is still relevant (or the clock jumped)
+            for slot in range(HOURS):
+                self.sums[slot] = 0.0
+                self.counts[slot] = 0
+            self.hour = hour
+        elif hour > self.hour:
+            for skipped in range(self.hour + 1, hour + 1):
+                self.sums[skipped % HOURS] = 0.0
+                self.counts[skipped % HOURS] = 0
+            self.hour = hour
+            self.save()
+
+        if hour > self.hour - HOURS:
+            self.sums[hour % HOURS] += value
+            self.counts[hour % HOURS] += 1
+
+    def hourly(self):
+        """Hourly averages, latest first (None for hours without samples)."""
+        averages = []
+        for age in range(HOURS):
+            slot = (self.hour - age) % HOURS
+            count = self.counts[slot]
+            averages.append(self.sums[slot] / count if count else None)
+        return averages
+
+    def value(self):
+        """The NowCast in ug/m3, or None without two of the last three hours."""
+        if self.hour is None:
+            return None
+
+        averages = self.hourly()
+        if sum(1 for average in averages[:3] if average is not None) < 2:
+            return None
+
+        present = [average for average in averages if average is not None]
+        highest = max(present)
+        weight = max(min(present) / highest, 0.5) if highest > 0 else 1
+
+        total = 0
+        weights = 0
+        for age, average in enumerate(averages):
+            if average is not None:
+                total += weight ** age * average
+                weights += weight ** age
+        return math.floor(total / weights * 10) / 10
+
+
+class AqiEngine:
+    """Adds nowcast and aqi to each sample's data."""
+    def __init__(self, field='pm25', scale=1.0, filename='aqi.state'):
+        self.field = field
+        self.scale = scale
+        self.nowcast = NowCast(filename)
+
+    def update(self, sample):
+        data = sample['data']
+        value = data.get(self.field)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            self.nowcast.add(value * self.scale, sample['sample_time'])
+
+        nowcast = self.nowcast.value()
+        data['nowcast'] = nowcast
+        data['aqi'] = None if nowcast is None else pm25_aqi(nowcast)
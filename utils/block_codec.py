@@ -0,0 +1,438 @@
+"""
+Compact encoding for blocks of samples, after Facebook's Gorilla time series
+compression.
+
+A block is stored column by column instead of sample by sample, so field names
+are only written once (in the block's field dictionary) and each column can be
+compressed for the way it changes:
+
+- Integer columns (sample_time, sequence, counters) store the difference
+  between consecutive deltas. sample_time steps by about a minute and sequence
+  by one, so most samples take a single bit.
+- Float columns (latency, temperature, humidity) store each value XORed with
+  the previous one. Slowly changing readings share their sign, exponent and
+  high mantissa bits, so only the few bits in the middle are written.
+- Everything else (strings, booleans, nested values) is run length encoded,
+  which collapses fields like the firmware version to a single entry.
+
+Missing fields and None values are kept in per-column bitmaps. Floats read
+back as floats even if some of the values were integers.
+
+The decoder is plain Python (plus msgpack for the header and generic columns)
+so it can run on the ingestion side without building anything.
+
+    data = encode(samples)
+    assert decode(data) == samples
+"""
+import struct
+
+import msgpack
+
+from utils.queue_reader import decode as decode_value
+
+MAGIC = b'GB'
+VERSION = 1
+
+INT = 0
+FLOAT = 1
+GENERIC = 2
+
+HAS_MISSING = 0x01
+HAS_NONE = 0x02
+
+# Integers outside of this range are stored as generic values so that delta of
+# deltas always fit in 64 bits
+INT_LIMIT = 1 << 61
+
+# Delta of delta buckets: (prefix bits, prefix length, value bits)
+DOD_BUCKETS = [(0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12),
+               (0b11110, 5, 32), (0b11111, 5, 64)]
+
+DOUBLE = struct.Struct('>d')
+UINT64 = struct.Struct('>Q')
+
+
+class CodecError(ValueError):
+    pass
+
+
+class BitWriter:
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0
+        self.bits = 0
+
+    def write(self, value, width):
+        self.acc = (self.acc << width) | (value & ((1 << width) - 1))
+        self.bits += width
+
+        while self.bits >= 8:
+            self.bits -= 8
+            self.out.append(self.acc >> self.bits)
+            self.acc &= (1 << self.bits) - 1
+
+    def getvalue(self):
+        if self.bits:
+            return bytes(self.out) + bytes([self.acc << (8 - self.bits)])
+        return bytes(self.out)
+
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.index = 0
+        self.acc = 0
+        self.bits = 0
+
+    def read(self, width):
+        while self.bits < width:
+            if self.index >= len(self.data):
+                raise CodecError("Column ended early")
+            self.acc = (self.acc << 8) | self.data[self.index]
+            self.index += 1
+            self.bits += 8
+
+        self.bits -= width
+        value = self.acc >> self.bits
+        self.acc &= (1 << self.bits) - 1
+        return value
+
+    def read_signed(self, width):
+        value = self.read(width)
+        if value >= 1 << (width - 1):
+            value -= 1 << width
+        return value
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise CodecError("Truncated varint")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and \
+        -INT_LIMIT <= value < INT_LIMIT
+
+
+def is_float(value):
+    return isinstance(value, float)
+
+
+def column_kind(values):
+    if all(is_int(value) for value in values):
+        return INT
+    if all(is_int(value) or is_float(value) for value in values):
+        return FLOAT
+    return GENERIC
+
+
+def encode_ints(writer, values):
+    previous = values[0]
+    delta = 0
+    writer.write(previous, 64)
+
+    for value in values[1:]:
+        new_delta = value - previous
+        dod = new_delta - delta
+        previous, delta = value, new_delta
+
+        if dod == 0:
+            writer.write(0, 1)
+            continue
+
+        for prefix, length, width in DOD_BUCKETS:
+            if -(1 << (width - 1)) <= dod < 1 << (width - 1):
+                writer.write(prefix, length)
+                writer.write(dod, width)
+                break
+
+
+def decode_ints(reader, count):
+    previous = reader.read_signed(64)
+    values = [previous]
+    delta = 0
+
+    for _ in range(count - 1):
+        dod = 0
+        if reader.read(1):
+            for prefix, length, width in DOD_BUCKETS[:-1]:
+                if not reader.read(1):
+                    break
+            else:
+                width = DOD_BUCKETS[-1][2]
+            dod = reader.read_signed(width)
+
+        delta += dod
+        previous += delta
+        values.append(previous)
+
+    return values
+
+
+def encode_floats(writer, values):
+    previous, = UINT64.unpack(DOUBLE.pack(values[0]))
+    writer.write(previous, 64)
+    leading = trailing = None
+
+    for value in values[1:]:
+        current, = UINT64.unpack(DOUBLE.pack(value))
+        xor = current ^ previous
+        previous = current
+
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+
+        new_leading = min(64 - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+
+        if leading is not None and new_leading >= leading and new_trailing >= trailing:
+            # Fits in the previous window of meaningful bits
+            writer.write(0b10, 2)
+            writer.write(xor >> trailing, 64 - leading - trailing)
+        else:
+            leading, trailing = new_leading, new_trailing
+            size = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            writer.write(size - 1, 6)
+            writer.write(xor >> trailing, size)
+
+
+def decode_floats(reader, count):
+    previous = reader.read(64)
+    values = [DOUBLE.unpack(UINT64.pack(previous))[0]]
+    leading = trailing = None
+
+    for _ in range(count - 1):
+        if reader.read(1):
+            if reader.read(1):
+                leading = reader.read(5)
+                trailing = 64 - leading - (reader.read(6) + 1)
+            elif leading is None:
+                raise CodecError("Float window used before it was set")
+            previous ^= reader.read(64 - leading - trailing) << trailing
+
+        values.append(DOUBLE.unpack(UINT64.pack(previous))[0])
+
+    return values
+
+
+def encode_runs(values):
+    runs = []
+    for value in values:
+        if runs and runs[-1][0] == value and type(runs[-1][0]) is type(value):
+            runs[-1][1] += 1
+        else:
+            runs.append([value, 1])
+    return msgpack.packb(runs, use_bin_type=True)
+
+
+def decode_runs(data):
+    values = []
+    for value, run in decode_value(msgpack.unpackb(data)):
+        values.extend([value] * run)
+    return values
+
+
+def pack_bitmap(flags):
+    writer = BitWriter()
+    for flag in flags:
+        writer.write(flag, 1)
+    return writer.getvalue()
+
+
+def unpack_bitmap(data, offset, count):
+    size = (count + 7) // 8
+    if offset + size > len(data):
+        raise CodecError("Truncated bitmap")
+    reader = BitReader(data[offset:offset + size])
+    return [reader.read(1) for _ in range(count)], offset + size
+
+
+def encode_column(rows):
+    """rows is a list of (present, value) pairs, one for each sample."""
+    values = [value for present, value in rows if present and value is not None]
+    kind = column_kind(values) if values else GENERIC
+
+    flags = 0
+    if not all(present for present, _ in rows):
+        flags |= HAS_MISSING
+    if any(present and value is None for present, value in rows):
+        flags |= HAS_NONE
+
+    out = bytearray([flags])
+    if flags & HAS_MISSING:
+        out += pack_bitmap(present for present, _ in rows)
+    if flags & HAS_NONE:
+        out += pack_bitmap(value is None for present, value in rows if present)
+
+    if kind == GENERIC:
+        out += encode_runs(values)
+    elif values:
+        writer = BitWriter()
+        if kind == INT:
+            encode_ints(writer, values)
+        else:
+            encode_floats(writer, values)
+        out += writer.getvalue()
+
+    return kind, bytes(out)
+
+
+def decode_column(kind, data, count):
+    flags = data[0]
+    offset = 1
+
+    present = [1] * count
+    if flags & HAS_MISSING:
+        present, offset = unpack_bitmap(data, offset, count)
+
+    nones = [0] * sum(present)
+    if flags & HAS_NONE:
+        nones, offset = unpack_bitmap(data, offset, len(nones))
+
+    value_count = len(nones) - sum(nones)
+    if kind == GENERIC:
+        values = decode_runs(data[offset:])
+    elif value_count == 0:
+        values = []
+    elif kind == INT:
+        values = decode_ints(BitReader(data[offset:]), value_count)
+    elif kind == FLOAT:
+        values = decode_floats(BitReader(data[offset:]), value_count)
+    else:
+        raise CodecError("Unknown column kind: {}".format(kind))
+
+    if len(values) != value_count:
+        raise CodecError("Column has {} values instead of {}".format(len(values), value_count))
+
+    # (present, value) for each sample
+    values = iter(values)
+    nones = iter(nones)
+    rows = []
+    for flag in present:
+        if not flag:
+            rows.append((False, None))
+        elif next(nones):
+            rows.append((True, None))
+        else:
+            rows.append((True, next(values)))
+    return rows
+
+
+def field_paths(samples):
+    """
+    The block's field dictionary: every field in the samples, with the fields
+    of nested dicts (data, metadata) as two part paths, in first seen order.
+    """
+    nested = {}
+    order = []
+    for sample in samples:
+        for key, value in sample.items():
+            if key not in nested:
+                nested[key] = True
+                order.append(key)
+            nested[key] = nested[key] and isinstance(value, dict)
+
+    paths = []
+    seen = set()
+    for key in order:
+        if not nested[key]:
+            paths.append((key,))
+            continue
+
+        found = False
+        for sample in samples:
+            for name in sample.get(key, {}):
+                found = True
+                if (key, name) not in seen:
+                    seen.add((key, name))
+                    paths.append((key, name))
+
+        if not found:
+            # Only ever an empty dict; keep it so it is restored
+            paths.append((key,))
+
+    return paths
+
+
+def lookup(sample, path):
+    value = sample
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return False, None
+        value = value[key]
+    return True, value
+
+
+def encode(samples):
+    """Encodes a list of samples (dicts with str keys) into a block."""
+    paths = field_paths(samples)
+
+    fields = []
+    columns = []
+    for path in paths:
+        kind, column = encode_column([lookup(sample, path) for sample in samples])
+        fields.append([list(path), kind])
+        columns.append(column)
+
+    header = msgpack.packb([len(samples), fields], use_bin_type=True)
+
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    write_varint(out, len(header))
+    out += header
+    for column in columns:
+        write_varint(out, len(column))
+        out += column
+    return bytes(out)
+
+
+def decode(data):
+    """Decodes a block back into a list of samples."""
+    if data[:len(MAGIC)] != MAGIC:
+        raise CodecError("Not a sample block")
+    if data[len(MAGIC)] != VERSION:
+        raise CodecError("Unsupported block version: {}".format(data[len(MAGIC)]))
+
+    try:
+        size, offset = read_varint(data, len(MAGIC) + 1)
+        count, fields = decode_value(msgpack.unpackb(data[offset:offset + size]))
+        offset += size
+    except (ValueError, TypeError, msgpack.exceptions.UnpackException) as e:
+        raise CodecError("Invalid block header: {}".format(e))
+
+    samples = [{} for _ in range(count)]
+    for path, kind in fields:
+        size, offset = read_varint(data, offset)
+        if offset + size > len(data):
+            raise CodecError("Truncated column")
+        rows = decode_column(kind, data[offset:offset + size], count)
+        offset += size
+
+        for sample, (present, value) in zip(samples, rows):
+            if not present:
+                continue
+
+            for key in path[:-1]:
+                sample = sample.setdefault(key, {})
+            sample[path[-1]] = value
+
+    return samples
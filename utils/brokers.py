@@ -0,0 +1,385 @@
+"""
+Publishing to more than one MQTT broker.
+
+`brokers` in the mqtt section is a list of brokers, each with a server, port,
+and optionally ca_certs, priority (lower goes first) and required. A single
+server and port is a list of one.
+
+In failover mode (the default) one broker is connected at a time: the one with
+the best priority that is healthy. The brokers that aren't in use are probed
+with a TCP connection every probe_interval seconds. The publisher fails over
+when the active broker has been disconnected for failover_after seconds or
+doesn't acknowledge a message within publish_timeout, and fails back as soon
+as a broker with a better priority passes a probe.
+
+In fanout mode every broker gets every message over its own connection: paho
+keeps QoS 1 messages for a broker that is down and sends them when it
+reconnects. A sample only leaves the queue once every required broker has
+acknowledged it, so publishing waits for all of them to be connected and
+publish() returns once they have all acknowledged. A required broker that is
+down or slow holds up publishing (the samples stay in the queue, so a restart
+loses nothing); one that shouldn't should be configured with required: no.
+Those brokers are sent every message but never waited for, and paho keeps at
+most max_queued messages for them while they are down.
+
+publish() can be given a timeout, after which it raises PublishTimeout: the
+message wasn't rejected, it just wasn't acknowledged in time, so it should be
+kept and tried again later. In fanout mode a message published again right
+after a timeout (the same topic and payload) isn't sent again to the brokers
+that already have it or are still sending it.
+
+Either way a sample can reach a broker twice (boot_id and sequence identify
+it). Retained messages, like the schema, are sent again to a broker every
+time it connects.
+"""
+import logging
+import socket
+import threading
+import time
+
+import paho.mqtt.client as paho
+
+from utils.connection import Backoff, ConnectionMetrics, make_tls_context
+
+LOGGER = logging.getLogger(__name__)
+
+FAILOVER = 'failover'
+FANOUT = 'fanout'
+POLL_INTERVAL = 0.05
+
+
+class PublishTimeout(Exception):
+    pass
+
+
+def acknowledged(info, timeout):
+    """Waits up to timeout seconds for a QoS 1 message to be acknowledged."""
+    try:
+        info.wait_for_publish(timeout)
+    except (RuntimeError, ValueError):
+        # Newer versions of paho raise if the message couldn't be queued
+        return False
+    return info.is_published()
+
+
+def is_acknowledged(info):
+    """Whether a QoS 1 message has been acknowledged, without waiting."""
+    try:
+        return info.is_published()
+    except ValueError:
+        # Not queued: paho already holds max_queued messages for the broker
+        return False
+    except RuntimeError:
+        # Newer versions of paho raise for a message published while
+        # disconnected, which is still sent once the broker is back
+        return getattr(info, '_published', False)
+
+
+class Broker:
+    def __init__(self, cfg, username, password, reconnect_cfg=None):
+        self.server = cfg['server']
+        self.port = cfg.get('port', 1883)
+        self.name = cfg.get('name', '{}:{}'.format(self.server, self.port))
+        self.priority = cfg.get('priority', 0)
+        self.required = cfg.get('required', True)
+
+        reconnect_cfg = reconnect_cfg or {}
+        self.backoff = Backoff(reconnect_cfg.get('initial', 1),
+                               reconnect_cfg.get('maximum', 300))
+
+        self.connected = threading.Event()
+        self.down_since = time.monotonic()
+        self.healthy = True  # Until a probe says otherwise
+        self.retained = {}  # Topic: payload, shared with the pool
+        self.running = False
+        self.attempt = 0  # So a stopped connect loop doesn't carry on after a restart
+
+        self.client = paho.Client()
+        self.client.username_pw_set(username=username, password=password)
+        self.client.on_connect = self._on_connect
+        self.client.on_publish = self._on_publish
+        self.client.on_disconnect = self._on_disconnect
+        # Reconnect interval on disconnect, doubling up to the maximum
+        self.client.reconnect_delay_set(min_delay=reconnect_cfg.get('initial', 1),
+                                        max_delay=reconnect_cfg.get('maximum', 300))
+
+        # Built once so reconnects can resume the previous TLS session
+        self.metrics = ConnectionMetrics()
+        self.context = None
+        if 'ca_certs' in cfg:
+            self.context = make_tls_context(cfg['ca_certs'], self.metrics)
+            self.client.tls_set_context(self.context)
+
+    def start(self, network_ready=None):
+        self.running = True
+        self.attempt += 1
+        self.down_since = time.monotonic()
+        threading.Thread(target=self._connect, args=(network_ready, self.attempt),
+                         name="BrokerThread-{}".format(self.name), daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _sleep(self, amount):
+        while amount > 0 and self.running:
+            time.sleep(min(amount, 1))
+            amount -= 1
+
+    def _connect(self, network_ready, attempt):
+        if network_ready is not None:
+            network_ready.wait()
+
+        while self.running and attempt == self.attempt:
+            try:
+                LOGGER.info("Trying to connect to %s", self.name)
+                self.client.connect(self.server, self.port)
+                break
+            except Exception:
+                delay = self.backoff.next()
+                LOGGER.exception("Unable to connect to %s, trying again in %.0f s",
+                                 self.name, delay)
+                self._sleep(delay)
+        else:
+            return
+
+        self.backoff.reset()
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            LOGGER.error("%s refused the connection: rc %s", self.name, rc)
+            return
+
+        LOGGER.info("Connected to %s", self.name)
+        if self.context is not None:
+            # The TLS 1.3 session ticket has arrived by now
+            self.context.remember(client.socket())
+        self.metrics.connected()
+
+        for topic, payload in list(self.retained.items()):
+            client.publish(topic, payload, qos=1, retain=True)
+
+        self.down_since = None
+        self.connected.set()
+
+    def _on_publish(self, client, userdata, mid):
+        LOGGER.debug("%s acknowledged message %s", self.name, mid)
+        self.metrics.published()
+
+    def _on_disconnect(self, client, userdata, rc):
+        LOGGER.info("Disconnected from %s: rc %s", self.name, rc)
+        self.connected.clear()
+        if self.down_since is None:
+            self.down_since = time.monotonic()
+
+    def probe(self, timeout=5):
+        """Whether a TCP connection to the broker can be made."""
+        try:
+            socket.create_connection((self.server, self.port), timeout=timeout).close()
+            healthy = True
+        except OSError:
+            healthy = False
+
+        if healthy != self.healthy:
+            LOGGER.info("%s is %s", self.name, "reachable" if healthy else "unreachable")
+        self.healthy = healthy
+        return healthy
+
+    def publish(self, topic, payload, retain=False):
+        return self.client.publish(topic, payload, qos=1, retain=retain)
+
+
+def brokers_from_config(mqtt_cfg):
+    """Brokers from the brokers list, or the single server and port."""
+    configs = mqtt_cfg.get('brokers')
+    if not configs:
+        configs = [{key: mqtt_cfg[key] for key in ('server', 'port', 'ca_certs')
+                    if key in mqtt_cfg}]
+
+    return [Broker(cfg, mqtt_cfg['uname'], mqtt_cfg['password'],
+                   mqtt_cfg.get('reconnect')) for cfg in configs]
+
+
+class BrokerPool:
+    def __init__(self, brokers, mode=FAILOVER, probe_interval=60,
+                 failover_after=30, publish_timeout=30, max_queued=10000):
+        if mode not in (FAILOVER, FANOUT):
+            raise ValueError("Unknown broker mode: {}".format(mode))
+
+        # Sorting is stable, so brokers with the same priority keep their order
+        self.brokers = sorted(brokers, key=lambda broker: broker.priority)
+        self.mode = mode
+        self.probe_interval = probe_interval
+        self.failover_after = failover_after
+        self.publish_timeout = publish_timeout
+        self.max_queued = max_queued
+        # Fan-out: the last message published and its info for each broker
+        self.pending = None
+
+        self.lock = threading.RLock()
+        self.retained = {}
+        for broker in self.brokers:
+            broker.retained = self.retained
+
+        self.active = None
+        self.network_ready = None
+        self.running = True
+
+    def start(self, network_ready=None):
+        self.network_ready = network_ready
+        if self.mode == FANOUT:
+            for broker in self.brokers:
+                if not broker.required:
+                    broker.client.max_queued_messages_set(self.max_queued)
+                broker.start(network_ready)
+        else:
+            self._activate(self.brokers[0])
+
+        threading.Thread(target=self._run, name="BrokerProbeThread", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        for broker in self.brokers:
+            if broker.running:
+                broker.stop()
+
+    def _sleep(self, amount):
+        while amount > 0 and self.running:
+            time.sleep(min(amount, 1))
+            amount -= 1
+
+    def _run(self):
+        while self.running:
+            self._sleep(self.probe_interval)
+            if not self.running:
+                break
+
+            for broker in self.brokers:
+                if self.mode == FANOUT or broker is not self.active:
+                    broker.probe()
+            self._choose()
+
+    def _activate(self, broker):
+        with self.lock:
+            if broker is self.active:
+                return
+
+            if self.active is not None:
+                LOGGER.warning("Switching from %s to %s", self.active.name, broker.name)
+                self.active.stop()
+
+            self.active = broker
+            broker.start(self.network_ready)
+
+    def _usable(self, broker):
+        if broker is not self.active:
+            return broker.healthy
+
+        down_since = broker.down_since
+        return down_since is None or \
+            time.monotonic() - down_since < self.failover_after
+
+    def _choose(self):
+        """Switches to the best broker that is usable (failover mode)."""
+        if self.mode != FAILOVER:
+            return
+
+        with self.lock:
+            for broker in self.brokers:
+                if self._usable(broker):
+                    self._activate(broker)
+                    return
+
+    def _failed(self, broker):
+        """The active broker didn't acknowledge in time; use another if there is one."""
+        with self.lock:
+            for other in self.brokers:
+                if other is not broker and other.healthy:
+                    broker.healthy = False
+                    self._activate(other)
+                    return
+
+    def wait_connected(self, timeout=None):
+        """Waits until there is a broker to publish to, or every required one (fanout)."""
+        if self.mode == FANOUT:
+            required = [broker for broker in self.brokers if broker.required]
+            deadline = None if timeout is None else time.monotonic() + timeout
+            for broker in required:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                if not broker.connected.wait(remaining):
+                    return False
+            return True
+
+        if self.active.connected.wait(timeout):
+            return True
+        self._choose()
+        return False
+
+    def retain(self, topic, payload):
+        """Publishes a retained message to every broker, now and whenever it connects."""
+        self.retained[topic] = payload
+        for broker in self.brokers:
+            if broker.connected.is_set():
+                broker.publish(topic, payload, retain=True)
+
+    def publish(self, topic, payload, timeout=None):
+        """
+        Returns once the message has been acknowledged where it is required,
+        or raises PublishTimeout after timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.mode == FANOUT:
+            self._fan_out(topic, payload, deadline)
+            return
+
+        while True:
+            self._check_deadline(deadline)
+            broker = self.active
+            if not broker.connected.wait(1):
+                self._choose()
+                continue
+
+            if acknowledged(broker.publish(topic, payload), self.publish_timeout):
+                return
+
+            LOGGER.warning("%s didn't acknowledge within %s s", broker.name,
+                           self.publish_timeout)
+            self._failed(broker)
+
+    @staticmethod
+    def _check_deadline(deadline):
+        if deadline is not None and time.monotonic() >= deadline:
+            raise PublishTimeout("No broker acknowledged the message in time")
+
+    def _fan_out(self, topic, payload, deadline=None):
+        infos = {}
+        if self.pending is not None and self.pending[:2] == (topic, payload):
+            # Retried after a timeout: only brokers that failed to take it get it again
+            infos = {broker: info for broker, info in self.pending[2].items()
+                     if info.rc != paho.MQTT_ERR_QUEUE_SIZE}
+
+        for broker in self.brokers:
+            if broker not in infos:
+                # Queued by paho if the broker is down, and sent once it's back
+                infos[broker] = broker.publish(topic, payload)
+        self.pending = (topic, payload, infos)
+
+        waiting = [broker for broker in self.brokers if broker.required]
+        started = time.monotonic()
+        while waiting:
+            self._check_deadline(deadline)
+
+            waiting = [broker for broker in waiting if not is_acknowledged(infos[broker])]
+            if not waiting:
+                break
+
+            if time.monotonic() - started >= self.publish_timeout:
+                LOGGER.warning("Waiting for %s to acknowledge",
+                               ', '.join(broker.name for broker in waiting))
+                started = time.monotonic()
+
+            time.sleep(POLL_INTERVAL)
+
+        self.pending = None
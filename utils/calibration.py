@@ -0,0 +1,164 @@
+"""
+Per-device calibration of sensor readings.
+
+Each entry under calibration.fields turns one raw field into a calibrated one
+that is stored next to it (as <field>_cal unless output says otherwise), so
+both are kept. The steps run in this order, each one optional:
+
+    unit:       a unit conversion from UNITS
+    linear:     {slope, offset}
+    polynomial: [c0, c1, c2, ...] for c0 + c1 x + c2 x^2 + ...
+    humidity:   {field, kappa, density}, the hygroscopic growth correction
+                for optical PM sensors (Crilley et al. 2018):
+                    x / (1 + (kappa / density) / (100 / RH - 1))
+    round:      decimal places (2 by default)
+
+Fields are calibrated in the order they are listed, so a humidity correction
+can use a humidity that was calibrated before it (humidity_cal).
+
+The configuration is compiled once into a list of steps. apply() runs them on
+one sample as it is read; apply_batch() runs them over many samples at once
+(a backlog being compacted into a block), one step at a time over a column of
+values held in an array of doubles, with NaN for missing values.
+"""
+from array import array
+import logging
+import math
+
+LOGGER = logging.getLogger(__name__)
+
+UNITS = {'fahrenheit_to_celsius': lambda x: (x - 32) / 1.8,
+         'celsius_to_fahrenheit': lambda x: x * 1.8 + 32,
+         'kelvin_to_celsius': lambda x: x - 273.15,
+         # Dylos counts are per 0.01 cubic feet
+         'per_hundredth_cubic_foot_to_per_litre': lambda x: x * 100 / 28.316846592}
+
+# Above this the humidity correction blows up
+MAX_HUMIDITY = 99.0
+
+NAN = float('nan')
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def polynomial(coefficients):
+    coefficients = list(reversed(coefficients))
+
+    def evaluate(x):
+        result = 0.0
+        for coefficient in coefficients:
+            result = result * x + coefficient
+        return result
+    return evaluate
+
+
+def growth_factor(humidity, kappa, density):
+    humidity = min(humidity, MAX_HUMIDITY)
+    if humidity <= 0:
+        return 1.0
+    return 1 + (kappa / density) / (100 / humidity - 1)
+
+
+class FieldCalibration:
+    def __init__(self, field, cfg):
+        self.field = field
+        self.output = cfg.get('output', field + '_cal')
+        self.digits = cfg.get('round', 2)
+
+        # Functions of one value, in the order they are applied
+        self.steps = []
+        if 'unit' in cfg:
+            if cfg['unit'] not in UNITS:
+                raise ValueError("Unknown unit conversion for {}: {}".format(
+                    field, cfg['unit']))
+            self.steps.append(UNITS[cfg['unit']])
+        if 'linear' in cfg:
+            linear = cfg['linear']
+            self.steps.append(polynomial([linear.get('offset', 0), linear.get('slope', 1)]))
+        if 'polynomial' in cfg:
+            self.steps.append(polynomial(cfg['polynomial']))
+
+        humidity = cfg.get('humidity')
+        self.humidity_field = None
+        if humidity:
+            self.humidity_field = humidity.get('field', 'humidity')
+            self.kappa = humidity.get('kappa', 0.4)
+            self.density = humidity.get('density', 1.65)
+
+    def apply(self, data):
+        value = data.get(self.field)
+        if not is_number(value):
+            data[self.output] = None
+            return
+
+        for step in self.steps:
+            value = step(value)
+
+        if self.humidity_field is not None:
+            humidity = data.get(self.humidity_field)
+            if not is_number(humidity):
+                data[self.output] = None
+                return
+            value /= growth_factor(humidity, self.kappa, self.density)
+
+        data[self.output] = round(value, self.digits)
+
+    def apply_columns(self, columns):
+        """Calibrates a column of values (an array of doubles) in place."""
+        values = columns[self.field]
+        for step in self.steps:
+            for i, value in enumerate(values):
+                values[i] = step(value)
+
+        if self.humidity_field is not None:
+            humidity = columns[self.humidity_field]
+            for i, value in enumerate(values):
+                values[i] = value / growth_factor(humidity[i], self.kappa, self.density)
+
+        columns[self.output] = values
+
+
+class Calibration:
+    def __init__(self, fields_cfg):
+        self.fields = [FieldCalibration(field, cfg or {})
+                       for field, cfg in (fields_cfg or {}).items()]
+
+    def apply(self, data):
+        """Adds calibrated values to a sample's data."""
+        for field in self.fields:
+            try:
+                field.apply(data)
+            except (ArithmeticError, ValueError):
+                LOGGER.exception("Unable to calibrate %s", field.field)
+                data[field.output] = None
+
+    def apply_batch(self, samples):
+        """
+        Adds calibrated values to decoded samples that don't have them yet,
+        working a column at a time.
+        """
+        for field in self.fields:
+            pending = [sample['data'] for sample in samples
+                       if isinstance(sample.get('data'), dict) and
+                       field.output not in sample['data']]
+            if not pending:
+                continue
+
+            # Copies of the values, so the raw ones are left alone
+            columns = {}
+            for name in (field.field, field.humidity_field):
+                if name is not None and name not in columns:
+                    columns[name] = array('d', (data[name] if is_number(data.get(name))
+                                                else NAN for data in pending))
+
+            try:
+                field.apply_columns(columns)
+            except (ArithmeticError, ValueError):
+                LOGGER.exception("Unable to calibrate %s", field.field)
+                continue
+
+            for data, value in zip(pending, columns[field.output]):
+                data[field.output] = None if math.isnan(value) \
+                    else round(value, field.digits)
@@ -0,0 +1,113 @@
+"""
+State that lets samples be published exactly once as far as the server can
+tell.
+
+Every sample carries the boot ID and a sequence number that keeps counting
+across restarts, so the ingestion side can drop duplicates by (device, boot,
+sequence). The counter is persisted by reserving blocks of numbers ahead of
+time, so it is only written to disk once every `reserve` samples; after a
+crash the unused part of the block is skipped, never reused.
+
+The publisher acknowledges a batch of samples with one checkpoint instead of
+deleting and flushing the queue after each one. The checkpoint (how many items
+were acknowledged and which item was last) is written before the items are
+deleted, so if the process dies in between, the items are deleted on the next
+start instead of being published again.
+"""
+import json
+import logging
+import os
+import zlib
+
+LOGGER = logging.getLogger(__name__)
+
+
+def write_state(filename, state):
+    """Atomically replaces a small JSON state file."""
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, filename)
+
+
+def read_state(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        LOGGER.warning("Ignoring corrupt state file %s", filename)
+        return None
+
+
+def _get(item, *path):
+    for key in path:
+        if not isinstance(item, dict):
+            return None
+        item = item.get(key, item.get(key.encode()))
+    return item.decode() if isinstance(item, bytes) else item
+
+
+def identity(item, dumps):
+    """
+    What identifies a queue item: its boot ID and sequence number, or a
+    checksum for items that don't have them (compacted blocks).
+    """
+    sequence = _get(item, 'data', 'sequence')
+    if sequence is not None:
+        return [_get(item, 'metadata', 'boot_id'), sequence]
+    return [None, zlib.crc32(dumps(item))]
+
+
+class SequenceCounter:
+    def __init__(self, filename='sequence.state', reserve=1000):
+        self.filename = filename
+        self.reserve = reserve
+
+        state = read_state(filename) or {}
+        # Start after everything that might have been handed out
+        self.value = state.get('reserved', 0)
+        self.reserved = self.value
+
+    def next(self):
+        self.value += 1
+        if self.value > self.reserved:
+            self.reserved = self.value + self.reserve - 1
+            write_state(self.filename, {'reserved': self.reserved})
+        return self.value
+
+
+class AckCheckpoint:
+    def __init__(self, filename='ack.checkpoint'):
+        self.filename = filename
+
+    def confirm(self, queue, last, count):
+        """
+        Records that the first count items of the queue, ending with last,
+        have been acknowledged, then removes them.
+        """
+        write_state(self.filename, {'count': count,
+                                    'last': identity(last, queue.dumps)})
+        queue.delete(count)
+        queue.flush()
+
+    def recover(self, queue):
+        """Finishes removing a batch if the process died while doing it."""
+        state = read_state(self.filename)
+        if not state or state['count'] > len(queue):
+            return 0
+
+        count = state['count']
+        items = queue.peek(count)
+        last = items[-1] if count > 1 else items
+
+        if identity(last, queue.dumps) != state['last']:
+            return 0
+
+        LOGGER.info("Removing %d items that were acknowledged before a restart", count)
+        queue.delete(count)
+        queue.flush()
+        return count
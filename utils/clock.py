@@ -0,0 +1,108 @@
+"""
+Timestamps for samples that are independent of when the system clock gets set.
+
+The BeagleBone has no real-time clock, so the wall clock is wrong until it is
+synchronized over the network. Samples are stamped from the monotonic clock
+plus an offset (and drift) estimated by utils.sntp; the system clock itself is
+never stepped. Until the first synchronization, samples are marked as
+unsynchronized and carry their raw monotonic time so they can be corrected
+before they leave the device.
+"""
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_boot_id():
+    """Identifies the current kernel boot; the monotonic clock resets with it."""
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.readline().strip()
+    except OSError:
+        return ''
+
+
+class SampleClock:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.boot_id = get_boot_id()
+
+        # Best guess until we hear otherwise: whatever the system clock says
+        self.base = time.monotonic()
+        self.offset = time.time() - self.base
+        self.drift = 0.0
+
+    def _at(self, monotonic):
+        return monotonic + self.offset + self.drift * (monotonic - self.base)
+
+    def now(self):
+        """Returns the current wall clock time in seconds."""
+        monotonic = time.monotonic()
+        with self.lock:
+            return self._at(monotonic)
+
+    def stamp(self):
+        """
+        Returns (sample_time, metadata) for a new sample. sample_time is in
+        microseconds.
+        """
+        monotonic = time.monotonic()
+
+        with self.lock:
+            sample_time = self._at(monotonic)
+
+        metadata = {"clock_synced": self.synced.is_set(),
+                    "boot_id": self.boot_id}
+        if not metadata["clock_synced"]:
+            metadata["monotonic_time"] = int(monotonic * 1e6)
+
+        return int(sample_time * 1e6), metadata
+
+    def discipline(self, base, offset, drift):
+        """
+        Sets the offset from the monotonic clock to true time, measured at
+        monotonic time base, and the rate at which it drifts.
+        """
+        with self.lock:
+            self.base = base
+            self.offset = offset
+            self.drift = drift
+
+        if not self.synced.is_set():
+            LOGGER.info("Clock synchronized")
+        self.synced.set()
+
+    def correct(self, data):
+        """
+        Rewrites sample_time of a sample taken before the clock was
+        synchronized. Samples from a previous boot can't be corrected because
+        their monotonic time is meaningless now.
+        """
+        metadata = data.get('metadata', {})
+        if metadata.get('clock_synced', True):
+            return data
+
+        sample_time = self.corrected_time(metadata.get('monotonic_time'),
+                                          metadata.get('boot_id'))
+        if sample_time is None:
+            return data
+
+        data['sample_time'] = sample_time
+        metadata['clock_synced'] = True
+        metadata['clock_corrected'] = True
+        return data
+
+    def corrected_time(self, monotonic_time, boot_id):
+        """
+        sample_time in microseconds for an unsynchronized sample taken at
+        monotonic_time (microseconds), or None if it can't be corrected yet.
+        """
+        if not self.synced.is_set() or monotonic_time is None or \
+           boot_id != self.boot_id:
+            return None
+
+        with self.lock:
+            return int(self._at(monotonic_time / 1e6) * 1e6)
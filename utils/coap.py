@@ -0,0 +1,232 @@
+"""
+Minimal CoAP (RFC 7252) message encoding and decoding, with the option
+helpers needed for block-wise transfers (RFC 7959) and Observe (RFC 7641).
+"""
+import struct
+
+VERSION = 1
+COAP_PORT = 5683
+MULTICAST_ADDRESS = '224.0.1.187'
+DISCOVERY_PATH = '.well-known/core'
+
+CON = 0
+NON = 1
+ACK = 2
+RST = 3
+
+EMPTY = 0
+GET = 1
+POST = 2
+PUT = 3
+DELETE = 4
+CONTENT = 69  # 2.05
+BAD_REQUEST = 128  # 4.00
+NOT_FOUND = 132  # 4.04
+METHOD_NOT_ALLOWED = 133  # 4.05
+INTERNAL_SERVER_ERROR = 160  # 5.00
+
+IF_MATCH = 1
+URI_HOST = 3
+ETAG = 4
+OBSERVE = 6
+URI_PORT = 7
+URI_PATH = 11
+CONTENT_FORMAT = 12
+URI_QUERY = 15
+BLOCK2 = 23
+BLOCK1 = 27
+SIZE2 = 28
+
+TEXT_PLAIN = 0
+LINK_FORMAT = 40
+JSON = 50
+
+# Options whose values are unsigned integers
+UINT_OPTIONS = {OBSERVE, URI_PORT, CONTENT_FORMAT, BLOCK2, BLOCK1, SIZE2}
+# Options whose values are strings
+STRING_OPTIONS = {URI_HOST, URI_PATH, URI_QUERY}
+
+PAYLOAD_MARKER = 0xFF
+HEADER = struct.Struct('!BBH')
+
+
+class CoapError(Exception):
+    pass
+
+
+def code_string(code):
+    return '{}.{:02d}'.format(code >> 5, code & 0x1F)
+
+
+def encode_uint(value):
+    if value == 0:
+        return b''
+    return value.to_bytes((value.bit_length() + 7) // 8, 'big')
+
+
+def decode_uint(value):
+    return int.from_bytes(value, 'big')
+
+
+def encode_block(num, more, size):
+    """Block1/Block2 option value for block number num of size bytes."""
+    szx = size.bit_length() - 5
+    if not 0 <= szx <= 6 or size != 2 ** (szx + 4):
+        raise ValueError("Invalid block size {}".format(size))
+    return (num << 4) | (int(more) << 3) | szx
+
+
+def decode_block(value):
+    """Returns (num, more, size) from a Block1/Block2 option value."""
+    return value >> 4, bool(value & 0x8), 2 ** ((value & 0x7) + 4)
+
+
+def _encode_extended(value):
+    if value < 13:
+        return value, b''
+    elif value < 269:
+        return 13, struct.pack('!B', value - 13)
+    return 14, struct.pack('!H', value - 269)
+
+
+class Message:
+    def __init__(self, mtype=CON, code=EMPTY, mid=0, token=b'', options=None,
+                 payload=b''):
+        self.mtype = mtype
+        self.code = code
+        self.mid = mid
+        self.token = token
+        self.options = options or []  # List of (number, value) pairs
+        self.payload = payload
+        self.source = None
+
+    def __repr__(self):
+        return '<Message type={} code={} mid={} token={} options={} ' \
+               'payload={} bytes>'.format(self.mtype, code_string(self.code),
+                                          self.mid, self.token.hex(),
+                                          self.options, len(self.payload))
+
+    @property
+    def is_request(self):
+        return 1 <= self.code <= 31
+
+    @property
+    def is_response(self):
+        return self.code >= 64
+
+    def option(self, number, default=None):
+        for option, value in self.options:
+            if option == number:
+                return value
+        return default
+
+    def add_option(self, number, value):
+        self.options.append((number, value))
+
+    def remove_option(self, number):
+        self.options = [(n, v) for n, v in self.options if n != number]
+
+    @property
+    def uri_path(self):
+        return '/'.join(value for option, value in self.options
+                        if option == URI_PATH)
+
+    @uri_path.setter
+    def uri_path(self, path):
+        self.remove_option(URI_PATH)
+        for segment in path.strip('/').split('/'):
+            if segment:
+                self.add_option(URI_PATH, segment)
+
+    def encode(self):
+        if len(self.token) > 8:
+            raise CoapError("Token is too long")
+
+        data = bytearray(HEADER.pack((VERSION << 6) | (self.mtype << 4) | len(self.token),
+                                     self.code, self.mid))
+        data += self.token
+
+        # Options are delta encoded so they must be in order; the sort is
+        # stable so repeated options keep their order
+        last = 0
+        for number, value in sorted(self.options, key=lambda option: option[0]):
+            if number in UINT_OPTIONS:
+                value = encode_uint(value)
+            elif number in STRING_OPTIONS:
+                value = value.encode()
+
+            delta, delta_ext = _encode_extended(number - last)
+            length, length_ext = _encode_extended(len(value))
+            data.append((delta << 4) | length)
+            data += delta_ext + length_ext + value
+            last = number
+
+        if self.payload:
+            data.append(PAYLOAD_MARKER)
+            data += self.payload
+
+        return bytes(data)
+
+    @classmethod
+    def decode(cls, data):
+        try:
+            return cls._decode(data)
+        except (IndexError, struct.error, UnicodeDecodeError) as e:
+            raise CoapError("Malformed message: {}".format(e))
+
+    @classmethod
+    def _decode(cls, data):
+        if len(data) < HEADER.size:
+            raise CoapError("Message is too short")
+
+        first, code, mid = HEADER.unpack_from(data)
+        if first >> 6 != VERSION:
+            raise CoapError("Unknown version")
+
+        token_length = first & 0xF
+        if token_length > 8:
+            raise CoapError("Invalid token length")
+
+        message = cls(mtype=(first >> 4) & 0x3, code=code, mid=mid)
+        pos = HEADER.size
+        message.token = bytes(data[pos:pos + token_length])
+        pos += token_length
+
+        number = 0
+        while pos < len(data):
+            byte = data[pos]
+            pos += 1
+
+            if byte == PAYLOAD_MARKER:
+                message.payload = bytes(data[pos:])
+                if not message.payload:
+                    raise CoapError("Payload marker without a payload")
+                break
+
+            delta, length = byte >> 4, byte & 0xF
+            delta, pos = cls._decode_extended(data, delta, pos)
+            length, pos = cls._decode_extended(data, length, pos)
+
+            number += delta
+            value = bytes(data[pos:pos + length])
+            if len(value) != length:
+                raise CoapError("Truncated option")
+            pos += length
+
+            if number in UINT_OPTIONS:
+                value = decode_uint(value)
+            elif number in STRING_OPTIONS:
+                value = value.decode()
+            message.options.append((number, value))
+
+        return message
+
+    @staticmethod
+    def _decode_extended(data, value, pos):
+        if value == 13:
+            return data[pos] + 13, pos + 1
+        elif value == 14:
+            return struct.unpack_from('!H', data, pos)[0] + 269, pos + 2
+        elif value == 15:
+            raise CoapError("Invalid option")
+        return value, pos
@@ -1,93 +1,262 @@
 from __future__ import print_function, division
+from concurrent.futures import Future, TimeoutError
 import json
 import logging
-from queue import Queue, Empty
+import os
 from pprint import pprint
 import random
+import select
+import socket
 import struct
 import threading
+import time
+from urllib.parse import urlparse
 
-from coapthon.messages.message import Message
-from coapthon import defines
-from coapthon.client.coap import CoAP
-from coapthon.messages.request import Request
-from coapthon.utils import generate_random_token, parse_uri
+from utils import coap
 
 logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+ACK_TIMEOUT = 2
+ACK_RANDOM_FACTOR = 1.5
+MAX_RETRANSMIT = 4
+# Time to wait for a response once a request has been acknowledged or when
+# the request is not confirmable
+RESPONSE_TIMEOUT = 30
+DISCOVERY_WAIT = 3
+
+
+def parse_uri(uri):
+    """Returns (host, port, path) from coap://host[:port]/path."""
+    result = urlparse(uri)
+    if result.scheme != 'coap' or not result.hostname:
+        raise ValueError("Not a CoAP URI: {}".format(uri))
+    return result.hostname, result.port or coap.COAP_PORT, result.path.strip('/')
+
+
+class Exchange:
+    """A request that is waiting for its response."""
+    def __init__(self, request, destination, multicast=False):
+        self.request = request
+        self.destination = destination
+        self.multicast = multicast
+        self.future = Future()
+
+        self.acknowledged = request.mtype != coap.CON
+        self.retransmits = 0
+        self.ack_timeout = ACK_TIMEOUT * random.uniform(1, ACK_RANDOM_FACTOR)
+        self.sent = time.monotonic()
+        self.deadline = self.sent + RESPONSE_TIMEOUT
+
+        self.payload = b''  # Accumulated Block2 payload
+        self.responses = []  # Multicast responses
 
 
 class Client(object):
-    def __init__(self, server):
+    """
+    CoAP client that can have many requests in flight at once, to one or many
+    servers. Responses are matched to requests by token (and acknowledgements
+    by message ID), and each request resolves a Future.
+    """
+    def __init__(self, server=None, bind=('', 0)):
         self.server = server
-        self.protocol = CoAP(self.server,
-                             random.randint(1, 65535),
-                             self._wait_response,
-                             self._timeout)
-        self.queue = Queue()
-        self.running = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(bind)
 
-    def _wait_response(self, message):
-        if message.code != defines.Codes.CONTINUE.number:
-            self.queue.put(message)
+        self.lock = threading.Lock()
+        self.exchanges = {}  # token -> Exchange
+        self.mids = {}  # message ID -> Exchange, until acknowledged
+        self.mid = random.randint(0, 0xFFFF)
+        self.running = True
 
-    def _timeout(self, message):
-        self.queue.put(None)
+        self.thread = threading.Thread(target=self._run, name="CoapClientThread",
+                                       daemon=True)
+        self.thread.start()
 
     def stop(self):
         self.running = False
-        # self.protocol.stop()
-        self.queue.put(None)
-
-    def get(self, path, payload=None):  # pragma: no cover
-        request = Request()
-        request.destination = self.server
-        request.code = defines.Codes.GET.number
-        request.uri_path = path
-        request.payload = payload
-
-        # Clear out queue before sending a request. It is possible that an old
-        # response was received between requests. We don't want the requests
-        # and responses to be mismatched. I expect the protocol to take care of
-        # that, but I don't have confidence in the CoAP library.
-        try:
-            while True:
-                self.queue.get_nowait()
-        except Empty:
-            pass
+        self.thread.join()
+        self.sock.close()
+
+        with self.lock:
+            for exchange in self.exchanges.values():
+                self._finish(exchange, None)
+            self.exchanges.clear()
+            self.mids.clear()
 
-        self.protocol.send_message(request)
-        response = self.queue.get(block=True)
-        return response
+    def _next_mid(self):
+        self.mid = (self.mid + 1) & 0xFFFF
+        return self.mid
 
-    def multicast_discover(self): # pragma: no cover
-        request = Request()
-        request.destination = self.server
-        request.code = defines.Codes.GET.number
-        request.uri_path = defines.DISCOVERY_URL
+    def _new_token(self):
+        while True:
+            token = os.urandom(4)
+            if token not in self.exchanges:
+                return token
 
-        self.protocol.send_message(request)
-        first_response = self.queue.get(block=True)
+    def request(self, path, payload=None, destination=None, code=coap.GET,
+                confirmable=True, options=None, window=DISCOVERY_WAIT):
+        """
+        Sends a request and returns a Future for the response message. A
+        request to the multicast group resolves to the list of responses
+        received within window seconds.
+        """
+        destination = destination or self.server
+        multicast = destination[0] == coap.MULTICAST_ADDRESS
 
-        if first_response is None:
-            # The message timed out
-            return []
+        message = coap.Message(coap.CON if confirmable and not multicast else coap.NON,
+                               code, options=list(options or []),
+                               payload=payload or b'')
+        message.uri_path = path
 
-        responses = [first_response]
+        with self.lock:
+            message.mid = self._next_mid()
+            message.token = self._new_token()
+
+            exchange = Exchange(message, destination, multicast)
+            if multicast:
+                exchange.deadline = exchange.sent + window
+            self.exchanges[message.token] = exchange
+            if message.mtype == coap.CON:
+                self.mids[message.mid] = exchange
+
+            self._send(exchange)
+
+        return exchange.future
+
+    def get(self, path, payload=None, destination=None, timeout=None):  # pragma: no cover
+        """Blocking GET. Returns the response or None if it timed out."""
+        future = self.request(path, payload=payload, destination=destination)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            return None
+
+    def multicast_discover(self, wait=DISCOVERY_WAIT):  # pragma: no cover
+        """Returns all of the responses received within wait seconds."""
+        destination = self.server or (coap.MULTICAST_ADDRESS, coap.COAP_PORT)
+        future = self.request(coap.DISCOVERY_PATH, destination=destination,
+                              confirmable=False, window=wait)
+        return future.result() or []
+
+    def _send(self, exchange):
         try:
-            # Keep trying to get more responses if they come in
-            while self.running:
-                responses.append(self.queue.get(block=True, timeout=10))
-        except Empty:
-            pass
+            self.sock.sendto(exchange.request.encode(), exchange.destination)
+        except OSError as e:
+            LOGGER.warning("Unable to send to %s: %s", exchange.destination, e)
+
+    def _finish(self, exchange, result):
+        self.exchanges.pop(exchange.request.token, None)
+        self.mids.pop(exchange.request.mid, None)
+        if not exchange.future.done():
+            exchange.future.set_result(result)
+
+    def _run(self):
+        while self.running:
+            readable, _, _ = select.select([self.sock], [], [], 0.1)
+
+            if readable:
+                try:
+                    data, source = self.sock.recvfrom(65535)
+                    message = coap.Message.decode(data)
+                    message.source = source
+                except (OSError, coap.CoapError) as e:
+                    LOGGER.debug("Ignoring message: %s", e)
+                else:
+                    with self.lock:
+                        self._handle(message)
+
+            with self.lock:
+                self._check_timeouts()
+
+    def _handle(self, message):
+        if message.mtype in (coap.ACK, coap.RST):
+            exchange = self.mids.pop(message.mid, None)
+            if exchange is not None:
+                exchange.acknowledged = True
+                exchange.deadline = time.monotonic() + RESPONSE_TIMEOUT
+                if message.mtype == coap.RST:
+                    self._finish(exchange, None)
+                    return
+
+        if message.code == coap.EMPTY:
+            return
+
+        exchange = self.exchanges.get(message.token)
+
+        if message.mtype == coap.CON:
+            # Separate response: acknowledge it, or reject it if it is unknown
+            reply = coap.ACK if exchange is not None else coap.RST
+            self.sock.sendto(coap.Message(reply, mid=message.mid).encode(),
+                             message.source)
+
+        if exchange is None:
+            return
+
+        if exchange.multicast:
+            exchange.responses.append(message)
+            return
+
+        block2 = message.option(coap.BLOCK2)
+        if block2 is not None and message.code == coap.CONTENT:
+            num, more, size = coap.decode_block(block2)
+            exchange.payload += message.payload
+
+            if more:
+                # Ask for the next block with the same token
+                request = exchange.request
+                request.remove_option(coap.BLOCK2)
+                request.remove_option(coap.OBSERVE)
+                request.add_option(coap.BLOCK2, coap.encode_block(num + 1, False, size))
+                request.mid = self._next_mid()
+
+                exchange.acknowledged = request.mtype != coap.CON
+                exchange.retransmits = 0
+                exchange.sent = time.monotonic()
+                exchange.deadline = exchange.sent + RESPONSE_TIMEOUT
+                if request.mtype == coap.CON:
+                    self.mids[request.mid] = exchange
+                self._send(exchange)
+                return
+
+            message.payload = exchange.payload
+
+        self._finish(exchange, message)
+
+    def _check_timeouts(self):
+        now = time.monotonic()
+
+        for exchange in list(self.exchanges.values()):
+            if exchange.multicast:
+                if now >= exchange.deadline:
+                    self._finish(exchange, exchange.responses)
+                continue
+
+            if not exchange.acknowledged and \
+               now - exchange.sent >= exchange.ack_timeout:
+                if exchange.retransmits >= MAX_RETRANSMIT:
+                    LOGGER.debug("Request to %s timed out", exchange.destination)
+                    self._finish(exchange, None)
+                    continue
+
+                exchange.retransmits += 1
+                exchange.sent = now
+                exchange.ack_timeout *= 2
+                self._send(exchange)
+
+            elif exchange.acknowledged and now >= exchange.deadline:
+                self._finish(exchange, None)
 
-        return responses
+    def pending(self):
+        with self.lock:
+            return len(self.exchanges)
 
 
 def main(path, acks, size, discover):
 
     if discover:
         try:
-            discover_client = Client(server=('224.0.1.187', 5683))
+            discover_client = Client(server=(coap.MULTICAST_ADDRESS, coap.COAP_PORT))
             responses = discover_client.multicast_discover()
 
             for response in responses:
@@ -114,7 +283,7 @@ def main(path, acks, size, discover):
                 data = json.loads(response.payload.decode())
                 pprint(data)
             except Exception as e:
-                print("Unable to unpack payload:", response.payload)
+                print("Unable to unpack payload:", None if response is None else response.payload)
                 print(e)
 
         except KeyboardInterrupt:
@@ -0,0 +1,335 @@
+"""
+CoAP server that lets a gateway pull samples straight from the persistent
+queue, as an alternative to publishing over MQTT.
+
+GET /air_quality takes a !HH payload: the number of samples from the previous
+batch to acknowledge (they are deleted from the queue) and how many samples to
+send next. Large batches are sent with block-wise transfer (Block2) and a
+gateway can register with Observe to be notified as soon as new samples are
+queued. /.well-known/core is served for discovery, including requests sent to
+the CoAP multicast group.
+"""
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from utils import coap
+
+LOGGER = logging.getLogger(__name__)
+
+AIR_QUALITY_PATH = 'air_quality'
+ACK_REQUEST = struct.Struct('!HH')
+EXCHANGE_LIFETIME = 247
+BLOCK_CACHE_LIFETIME = 60
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8)
+IN_PKTINFO = struct.Struct('i4s4s')
+# Send every Nth notification confirmable to find out if observers are gone
+CON_NOTIFICATION_INTERVAL = 10
+
+
+class Observer:
+    def __init__(self, address, token, size):
+        self.address = address
+        self.token = token
+        self.size = size
+
+
+class CoapServer:
+    def __init__(self, queue, prepare, name, sensor_type, host='',
+                 port=coap.COAP_PORT, block_size=1024, multicast=True):
+        self.queue = queue
+        self.prepare = prepare  # Turns a sample from the queue into a dict
+        self.name = name
+        self.sensor_type = sensor_type
+        self.block_size = block_size
+
+        self.lock = threading.Lock()
+        self.running = True
+        self.mid = int.from_bytes(os.urandom(2), 'big')
+
+        # Number of samples sent that have not been acknowledged yet
+        self.unacknowledged = 0
+        self.observers = {}  # (address, token) -> Observer
+        self.observe_sequence = 0
+        self.pending_notifications = {}  # mid -> (address, token)
+        self.queue_length = len(queue)
+
+        # (address, mid) -> (time, encoded response) for deduplication
+        self.responses = {}
+        # (address, path) -> (time, etag, body) for block-wise transfers
+        self.bodies = {}
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+
+        if multicast:
+            try:
+                membership = struct.pack('4s4s',
+                                         socket.inet_aton(coap.MULTICAST_ADDRESS),
+                                         socket.inet_aton('0.0.0.0'))
+                self.sock.setsockopt(socket.IPPROTO_IP,
+                                     socket.IP_ADD_MEMBERSHIP, membership)
+            except OSError:
+                LOGGER.warning("Unable to join CoAP multicast group")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name="CoapThread")
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+    def serve_forever(self):
+        LOGGER.info("CoAP server listening on %s:%s", *self.address)
+
+        while self.running:
+            readable, _, _ = select.select([self.sock], [], [], 1)
+
+            if readable:
+                try:
+                    self._receive()
+                except Exception:
+                    LOGGER.exception("Exception occurred while handling request")
+
+            if len(self.queue) > self.queue_length:
+                self._notify_observers()
+            self.queue_length = len(self.queue)
+
+            self._expire()
+
+    def _next_mid(self):
+        self.mid = (self.mid + 1) & 0xFFFF
+        return self.mid
+
+    def _send(self, message, address):
+        try:
+            self.sock.sendto(message.encode(), address)
+        except OSError as e:
+            LOGGER.warning("Unable to send to %s: %s", address, e)
+            return False
+        return True
+
+    def _receive(self):
+        data, ancdata, _, address = self.sock.recvmsg(65535, socket.CMSG_SPACE(IN_PKTINFO.size))
+
+        multicast = False
+        for level, kind, value in ancdata:
+            if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+                destination = socket.inet_ntoa(IN_PKTINFO.unpack_from(value)[2])
+                multicast = destination == coap.MULTICAST_ADDRESS
+
+        try:
+            request = coap.Message.decode(data)
+        except coap.CoapError as e:
+            LOGGER.debug("Ignoring malformed message from %s: %s", address, e)
+            return
+        request.source = address
+
+        if request.mtype in (coap.ACK, coap.RST):
+            self._handle_reply(request)
+            return
+
+        if request.code == coap.EMPTY:
+            # CoAP ping
+            if request.mtype == coap.CON:
+                self._send(coap.Message(coap.RST, mid=request.mid), address)
+            return
+
+        if not request.is_request:
+            if request.mtype == coap.CON:
+                self._send(coap.Message(coap.RST, mid=request.mid), address)
+            return
+
+        # Retransmitted requests must not acknowledge samples twice
+        cached = self.responses.get((address, request.mid))
+        if cached is not None:
+            LOGGER.debug("Resending response to duplicate request %s", request.mid)
+            self.sock.sendto(cached[1], address)
+            return
+
+        response = self._handle_request(request, multicast)
+        if response is None:
+            return
+
+        if request.mtype == coap.CON:
+            response.mtype = coap.ACK
+            response.mid = request.mid
+        else:
+            response.mtype = coap.NON
+            response.mid = self._next_mid()
+        response.token = request.token
+
+        encoded = response.encode()
+        self.responses[(address, request.mid)] = (time.monotonic(), encoded)
+        self.sock.sendto(encoded, address)
+
+    def _handle_reply(self, message):
+        observer = self.pending_notifications.pop(message.mid, None)
+        if observer is not None and message.mtype == coap.RST:
+            LOGGER.info("Observer %s went away", observer[0])
+            self.observers.pop(observer, None)
+
+    def _handle_request(self, request, multicast):
+        path = request.uri_path
+
+        if path == coap.DISCOVERY_PATH:
+            return self._discovery(request)
+
+        if multicast:
+            # Only discovery is answered over multicast
+            return None
+
+        if path != AIR_QUALITY_PATH:
+            return coap.Message(code=coap.NOT_FOUND)
+        if request.code != coap.GET:
+            return coap.Message(code=coap.METHOD_NOT_ALLOWED)
+
+        return self._air_quality(request)
+
+    def _discovery(self, request):
+        payload = '</{}>;</name={}>;</type={}>;'.format(AIR_QUALITY_PATH,
+                                                        self.name,
+                                                        self.sensor_type)
+        return coap.Message(code=coap.CONTENT,
+                            options=[(coap.CONTENT_FORMAT, coap.LINK_FORMAT)],
+                            payload=payload.encode())
+
+    def _air_quality(self, request):
+        block2 = request.option(coap.BLOCK2)
+        num, _, size = coap.decode_block(block2) if block2 is not None else \
+            (0, False, self.block_size)
+        size = min(size, self.block_size)
+
+        key = (request.source, request.uri_path)
+        if num > 0 and key in self.bodies:
+            # Continuation of a block-wise transfer
+            _, etag, body = self.bodies[key]
+            return self._block(body, etag, num, size)
+
+        try:
+            acks, count = ACK_REQUEST.unpack(request.payload)
+        except struct.error:
+            return coap.Message(code=coap.BAD_REQUEST,
+                                payload=b'Payload must be two unsigned shorts')
+
+        if num == 0:
+            self._acknowledge(acks)
+
+        body = self._batch(count)
+        etag = struct.pack('!I', zlib.crc32(body))
+        self.bodies[key] = (time.monotonic(), etag, body)
+
+        response = self._block(body, etag, num, size)
+
+        observe = request.option(coap.OBSERVE)
+        observer_key = (request.source, request.token)
+        if observe == 0:
+            LOGGER.info("Registering observer %s", request.source)
+            self.observers[observer_key] = Observer(request.source,
+                                                    request.token, count)
+            response.add_option(coap.OBSERVE, self._next_observe())
+        elif observe == 1:
+            self.observers.pop(observer_key, None)
+
+        return response
+
+    def _acknowledge(self, acks):
+        with self.lock:
+            acks = min(acks, self.unacknowledged)
+            if acks == 0:
+                return
+
+            LOGGER.info("Deleting %s acknowledged samples from queue", acks)
+            self.queue.delete(acks)
+            self.queue.flush()
+            self.unacknowledged -= acks
+            self.queue_length = len(self.queue)
+
+    def _batch(self, count):
+        with self.lock:
+            if count == 0:
+                samples = []
+            else:
+                samples = self.queue.peek(count)
+                if count == 1:
+                    samples = [] if samples is None else [samples]
+
+            self.unacknowledged = max(self.unacknowledged, len(samples))
+
+        return json.dumps([self.prepare(sample) for sample in samples]).encode()
+
+    def _block(self, body, etag, num, size):
+        response = coap.Message(code=coap.CONTENT,
+                                options=[(coap.CONTENT_FORMAT, coap.JSON),
+                                         (coap.ETAG, etag)])
+
+        if len(body) <= size and num == 0:
+            response.payload = body
+            return response
+
+        start = num * size
+        if start >= len(body) and start > 0:
+            return coap.Message(code=coap.BAD_REQUEST,
+                                payload=b'Block out of range')
+
+        more = start + size < len(body)
+        response.payload = body[start:start + size]
+        response.add_option(coap.BLOCK2, coap.encode_block(num, more, size))
+        if num == 0:
+            response.add_option(coap.SIZE2, len(body))
+        return response
+
+    def _next_observe(self):
+        self.observe_sequence = (self.observe_sequence + 1) & 0xFFFFFF
+        return self.observe_sequence
+
+    def _notify_observers(self):
+        if not self.observers:
+            return
+
+        sequence = self._next_observe()
+        for key, observer in list(self.observers.items()):
+            body = self._batch(observer.size)
+            etag = struct.pack('!I', zlib.crc32(body))
+            self.bodies[(observer.address, AIR_QUALITY_PATH)] = \
+                (time.monotonic(), etag, body)
+
+            notification = self._block(body, etag, 0, self.block_size)
+            notification.token = observer.token
+            notification.mid = self._next_mid()
+            notification.add_option(coap.OBSERVE, sequence)
+
+            if sequence % CON_NOTIFICATION_INTERVAL == 0:
+                notification.mtype = coap.CON
+                self.pending_notifications[notification.mid] = key
+            else:
+                notification.mtype = coap.NON
+
+            if not self._send(notification, observer.address):
+                self.observers.pop(key, None)
+
+    def _expire(self):
+        now = time.monotonic()
+
+        for key, (created, _) in list(self.responses.items()):
+            if now - created > EXCHANGE_LIFETIME:
+                del self.responses[key]
+
+        for key, (created, _, _) in list(self.bodies.items()):
+            if now - created > BLOCK_CACHE_LIFETIME:
+                del self.bodies[key]
+
+        if len(self.pending_notifications) > 100:
+            self.pending_notifications.clear()
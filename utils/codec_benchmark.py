@@ -0,0 +1,149 @@
+"""
+Compares the block codec with JSON and gzip'd JSON.
+
+Uses the samples in a queue file, or generated samples that look like a Dylos
+unit's if no queue is given. Sizes are per sample, and ratios are relative to
+publishing each sample as its own JSON message (what the MQTT publisher does).
+
+    python -m utils.codec_benchmark sensor.queue --block-sizes 10,100,500
+"""
+import argparse
+import gzip
+from itertools import islice
+import json
+import math
+import random
+import time
+
+from tabulate import tabulate
+
+from utils import block_codec
+from utils.queue_reader import QueueReader
+
+
+def generate_samples(count, seed=0):
+    rng = random.Random(seed)
+    sample_time = 1488369600000000
+    samples = []
+
+    for i in range(count):
+        sample_time += 60000000 + rng.randint(-2000, 2000)
+        data = {"sequence": i + 1,
+                "queue_length": 1,
+                "pm_small": int(120 + 40 * math.sin(i / 90) + rng.randint(-5, 5)),
+                "pm_large": max(0, int(8 + 4 * math.sin(i / 60) + rng.randint(-2, 2))),
+                "temperature": round(21 + 3 * math.sin(i / 720), 2),
+                "humidity": round(35 + 10 * math.cos(i / 720), 2),
+                "ip_address": "10.0.0.42",
+                "associated": 1,
+                "data_rate": 65,
+                "link_quality": 60 + rng.randint(-2, 2),
+                "signal_level": -50 + rng.randint(-2, 2),
+                "noise_level": -256,
+                "rx_invalid_nwid": 0,
+                "rx_invalid_crypt": 0,
+                "rx_invalid_frag": 0,
+                "tx_retires": 12 + i // 30,
+                "invalid_misc": 3 + i // 120,
+                "missed_beacon": 0}
+        for prefix in ('local_', 'remote_'):
+            data.update({prefix + "ping_errors": 0,
+                         prefix + "ping_latency": rng.uniform(1, 40),
+                         prefix + "ping_packet_loss": 0,
+                         prefix + "ping_total": 12})
+
+        samples.append({"sample_time": sample_time,
+                        "data": data,
+                        "metadata": {"firmware": "v2.1.0-14-g3b2a9c1",
+                                     "clock_synced": True}})
+    return samples
+
+
+def measure(function, blocks, repeat):
+    """Returns (seconds per call over all blocks, last results)."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [function(block) for block in blocks]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+def json_messages(block):
+    return [json.dumps(sample).encode() for sample in block]
+
+
+def gzip_json(block):
+    return gzip.compress(json.dumps(block).encode())
+
+
+def gzip_block(block):
+    return gzip.compress(block_codec.encode(block))
+
+
+ENCODINGS = [
+    ('json per sample', json_messages,
+     lambda messages: [json.loads(message) for message in messages]),
+    ('gzip json', gzip_json, lambda data: json.loads(gzip.decompress(data))),
+    ('block', block_codec.encode, block_codec.decode),
+    ('gzip block', gzip_block, lambda data: block_codec.decode(gzip.decompress(data))),
+]
+
+
+def size_of(encoded):
+    if isinstance(encoded, list):
+        return sum(len(message) for message in encoded)
+    return len(encoded)
+
+
+def run(samples, block_sizes, repeat):
+    rows = []
+    baseline = sum(len(json.dumps(sample)) for sample in samples)
+
+    for block_size in block_sizes:
+        blocks = [samples[i:i + block_size] for i in range(0, len(samples), block_size)]
+
+        for name, encode, decode in ENCODINGS:
+            encode_time, encoded = measure(encode, blocks, repeat)
+            decode_time, decoded = measure(decode, encoded, repeat)
+            size = sum(size_of(data) for data in encoded)
+
+            rows.append([block_size, name,
+                         size / len(samples),
+                         baseline / size,
+                         encode_time / len(samples) * 1e6,
+                         decode_time / len(samples) * 1e6])
+
+    return rows
+
+
+def main(args):
+    if args.queue:
+        samples = list(islice(QueueReader(args.queue), args.count))
+    else:
+        samples = generate_samples(args.count)
+
+    if not samples:
+        print("No samples")
+        return
+
+    block_sizes = [int(size) for size in args.block_sizes.split(',')]
+    rows = run(samples, block_sizes, args.repeat)
+    print("{} samples".format(len(samples)))
+    print(tabulate(rows, headers=['block', 'encoding', 'bytes/sample', 'ratio',
+                                  'encode us/sample', 'decode us/sample'],
+                   floatfmt='.1f'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark sample encodings')
+    parser.add_argument('queue', nargs='?',
+                        help='Queue file to take samples from (generated '
+                             'samples are used if not given)')
+    parser.add_argument('-n', '--count', type=int, default=2000,
+                        help='Number of samples to use')
+    parser.add_argument('-b', '--block-sizes', default='10,100,500',
+                        help='Comma separated number of samples per block')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Runs of each measurement (the fastest is used)')
+    main(parser.parse_args())
@@ -0,0 +1,241 @@
+"""
+Compacts the aged part of the sample queue into columnar blocks.
+
+When a unit is offline for days the queue fills with thousands of samples that
+each repeat every field name. Samples older than max_age are rewritten into
+blocks of block_size samples encoded with utils.block_codec (one column per
+field, with bitmaps for missing values), which the publisher sends as a single
+message. A block takes the place of its samples in the queue, so the order in
+which samples are sent doesn't change. Samples queued before calibration was
+set up are calibrated on the way.
+
+The queue file is rewritten to a temporary file and renamed over the old one,
+like PersistentQueue.flush(), so a crash leaves either the old or the new
+queue. The first `skip` items are never touched because the publisher may be
+sending them (it publishes in batches). Only use this with the MQTT
+publisher: the CoAP server acknowledges samples by count after the fact.
+"""
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+import uuid
+
+from utils import block_codec
+from utils.queue_reader import HEADER_STRUCT, LENGTH_STRUCT, block_of, decode, \
+    iter_records
+
+LOGGER = logging.getLogger(__name__)
+
+COPY_CHUNK = 64 * 1024
+
+
+def make_block(samples):
+    """A queue item holding samples (decoded, oldest first)."""
+    return {"sample_time": samples[0]['sample_time'],
+            "last_sample_time": samples[-1]['sample_time'],
+            "count": len(samples),
+            "block": block_codec.encode(samples)}
+
+
+class Compactor:
+    def __init__(self, queue, clock, max_age=3600, block_size=256,
+                 interval=600, skip=1, calibration=None):
+        self.queue = queue
+        self.skip = skip
+        self.calibration = calibration
+        self.clock = clock
+        self.max_age = max_age
+        self.block_size = block_size
+        self.interval = interval
+        self.running = True
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="CompactorThread", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _sleep(self, amount):
+        while amount > 0 and self.running:
+            time.sleep(min(amount, 1))
+            amount -= 1
+
+    def _run(self):
+        while self.running:
+            self._sleep(self.interval)
+            if not self.running:
+                break
+
+            try:
+                self.compact()
+            except Exception:
+                LOGGER.exception("Exception occurred while compacting the queue")
+
+    def compact(self):
+        """Returns the number of samples that were put into blocks."""
+        with queue_locks(self.queue) as locked:
+            if not locked:
+                LOGGER.debug("Queue is busy, compacting later")
+                return 0
+
+            self.compacted = 0
+            self.blocks = 0
+            cutoff = int((self.clock.now() - self.max_age) * 1e6)
+            rewrite_queue(self.queue, self.skip,
+                          lambda records: self._blocks(records, cutoff))
+
+        if self.compacted:
+            LOGGER.info("Compacted %d samples into %d blocks", self.compacted, self.blocks)
+        return self.compacted
+
+    def _blocks(self, records, cutoff):
+        pending = []  # (raw record, decoded sample) not in a block yet
+
+        for data, item in records:
+            if block_of(item) is not None:
+                yield from (raw for raw, _ in pending)
+                pending = []
+                yield data
+                continue
+
+            sample = self.clock.correct(decode(item))
+            if sample.get('sample_time') is None or sample['sample_time'] >= cutoff:
+                # Everything from here on is new enough to stay as it is
+                break
+
+            pending.append((data, sample))
+            if len(pending) == self.block_size:
+                samples = [sample for _, sample in pending]
+                if self.calibration is not None:
+                    # Samples queued before calibration was set up
+                    self.calibration.apply_batch(samples)
+                yield self.queue.dumps(make_block(samples))
+                self.compacted += len(pending)
+                self.blocks += 1
+                pending = []
+        else:
+            data = None
+
+        # Too few aged samples left for a block; they can join the next one
+        yield from (raw for raw, _ in pending)
+        if data is not None:
+            yield data
+
+
+@contextmanager
+def queue_locks(queue, timeout=5):
+    """
+    Takes the queue's locks in the order peek() does, yielding whether they
+    were acquired. Flush takes them in the opposite order, so give up rather
+    than wait forever on the second one.
+    """
+    if not queue.pop_lock.acquire(timeout=timeout):
+        yield False
+        return
+
+    try:
+        if not queue.file_lock.acquire(timeout=timeout):
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            queue.file_lock.release()
+    finally:
+        queue.pop_lock.release()
+
+
+class Records:
+    """(raw record, item) for the items of a queue file, remembering how far it got."""
+    def __init__(self, f, offset, count, loads):
+        self.f = f
+        self.offset = offset  # Where the first record that wasn't read starts
+        self.count = count
+        self.loads = loads
+        self.consumed = 0
+
+    def __iter__(self):
+        for offset, data in iter_records(self.f, self.offset):
+            if self.consumed >= self.count:
+                break
+
+            self.offset = offset + LENGTH_STRUCT.size + len(data)
+            self.consumed += 1
+            yield data, self.loads(data)
+
+
+def rewrite_queue(queue, skip, transform):
+    """
+    Rewrites a queue whose locks are held. transform gets an iterator of
+    (raw record, item) for the items after the first skip and yields the raw
+    records to put in their place. Items it doesn't read are kept as they
+    are. The file is only replaced if the number of items changed, and the
+    number of records transform wrote is returned.
+    """
+    filename = os.path.join(queue.path, queue.filename)
+
+    queue.file.flush()
+    os.fsync(queue.file.fileno())
+    top = queue._get_queue_top()
+
+    temp_filename = '{}-{}'.format(filename, uuid.uuid4().hex)
+    try:
+        return _rewrite(queue, skip, transform, filename, top, temp_filename)
+    except BaseException:
+        # Don't leave a partial copy behind (e.g. when the disk is full)
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
+def _rewrite(queue, skip, transform, filename, top, temp_filename):
+    written = 0
+
+    with open(filename, 'rb') as f, open(temp_filename, 'w+b') as out:
+        out.write(HEADER_STRUCT.pack(0, HEADER_STRUCT.size))
+
+        def write(data):
+            out.write(LENGTH_STRUCT.pack(len(data)) + data)
+
+        # Might be being published right now
+        kept = Records(f, top, min(skip, queue.count()), queue.loads)
+        for data, _ in kept:
+            write(data)
+
+        records = Records(f, kept.offset, queue.count() - kept.consumed, queue.loads)
+        for data in transform(records):
+            write(data)
+            written += 1
+
+        if written == records.consumed:
+            out.close()
+            os.remove(temp_filename)
+            return written
+
+        # Copy the rest of the queue as it is
+        f.seek(records.offset)
+        while True:
+            chunk = f.read(COPY_CHUNK)
+            if not chunk:
+                break
+            out.write(chunk)
+
+        length = queue.count() - records.consumed + written
+        out.seek(0)
+        out.write(HEADER_STRUCT.pack(length, HEADER_STRUCT.size))
+        out.flush()
+        os.fsync(out.fileno())
+
+    queue.file.close()
+    os.replace(temp_filename, filename)
+    queue.file = queue._open_file()
+    queue.length = length
+
+    if hasattr(queue, 'reindex'):
+        queue.reindex()
+
+    return written
@@ -0,0 +1,202 @@
+"""
+Cheaper reconnects for the MQTT client.
+
+On flaky WiFi a unit reconnects many times a day, and a full TLS handshake is
+slow on the Pi's ARM core. The SSLContext is built once and reused, and it
+remembers the TLS session of the last connection (a session ticket with TLS
+1.3, a session ID before that) and offers it on the next one, so the broker
+can resume the session instead of doing a full handshake.
+
+Reconnect attempts are spaced out with exponential backoff with jitter so a
+fleet that lost its access point doesn't hammer the broker in lockstep.
+
+ConnectionMetrics records how long each handshake took, whether the session
+was resumed, and how long it took from the start of a reconnect (the TLS
+handshake, or the CONNACK without TLS) to the first PUBACK.
+
+To check resumption against a broker, or any TLS server such as
+`openssl s_server -accept 8883 -cert cert.pem -key key.pem`:
+
+    python -m utils.connection localhost 8883 --ca-certs cert.pem -n 5
+"""
+import argparse
+import logging
+import random
+import socket
+import ssl
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Backoff:
+    """Exponential backoff; each delay is randomly between half and all of it."""
+    def __init__(self, initial=1, maximum=300, factor=2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class ConnectionMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_time = None  # Seconds the last handshake took
+        self.puback_latency = None  # Seconds from reconnecting to the first PUBACK
+
+        self.reconnect_started = None
+        self.awaiting_puback = False
+
+    def attempt(self):
+        with self.lock:
+            self.reconnect_started = time.monotonic()
+            self.awaiting_puback = False
+
+    def handshake(self, seconds, resumed):
+        with self.lock:
+            self.handshakes += 1
+            self.resumed += 1 if resumed else 0
+            self.handshake_time = seconds
+
+        LOGGER.info("TLS handshake took %.0f ms (%s, %d of %d resumed)",
+                    seconds * 1000, "resumed" if resumed else "full",
+                    self.resumed, self.handshakes)
+
+    def connected(self):
+        with self.lock:
+            if self.reconnect_started is None:
+                self.reconnect_started = time.monotonic()
+            self.awaiting_puback = True
+
+    def published(self):
+        with self.lock:
+            if not self.awaiting_puback:
+                return
+            self.awaiting_puback = False
+            self.puback_latency = time.monotonic() - self.reconnect_started
+            self.reconnect_started = None
+
+        LOGGER.info("First PUBACK %.0f ms after reconnecting",
+                    self.puback_latency * 1000)
+
+    def as_dict(self):
+        with self.lock:
+            return {'handshakes': self.handshakes,
+                    'resumed': self.resumed,
+                    'handshake_time': self.handshake_time,
+                    'puback_latency': self.puback_latency}
+
+
+class TimedSSLSocket(ssl.SSLSocket):
+    def do_handshake(self, *args, **kwargs):
+        context = self.context
+        if context.metrics is not None:
+            context.metrics.attempt()
+
+        start = time.monotonic()
+        super().do_handshake(*args, **kwargs)
+        elapsed = time.monotonic() - start
+
+        context.remember(self)
+        if context.metrics is not None:
+            context.metrics.handshake(elapsed, self.session_reused)
+
+
+class ResumingContext(ssl.SSLContext):
+    """An SSLContext that offers the last connection's session when connecting."""
+    sslsocket_class = TimedSSLSocket
+
+    def setup(self, metrics=None):
+        self.metrics = metrics
+        self.session = None
+        self.session_host = None
+        self.session_lock = threading.Lock()
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        with self.session_lock:
+            if self.session is not None and kwargs.get('session') is None and \
+               kwargs.get('server_hostname') == self.session_host:
+                kwargs['session'] = self.session
+        return super().wrap_socket(sock, *args, **kwargs)
+
+    def remember(self, sock):
+        """
+        Keeps the session of a connected socket. With TLS 1.3 the ticket only
+        arrives after the handshake, so this is called again once the
+        connection has been used.
+        """
+        if not isinstance(sock, ssl.SSLSocket):
+            return
+
+        session = sock.session
+        if session is None or not (session.has_ticket or session.id):
+            return
+
+        with self.session_lock:
+            self.session = session
+            self.session_host = sock.server_hostname
+
+
+def make_tls_context(ca_certs=None, metrics=None):
+    """Builds the context once, with the same checks as paho's tls_set()."""
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.setup(metrics)
+    if ca_certs is not None:
+        context.load_verify_locations(ca_certs)
+    else:
+        context.load_default_certs()
+    return context
+
+
+def probe(host, port, context, count):
+    """Connects count times and returns [(seconds, resumed)] per handshake."""
+    results = []
+    for _ in range(count):
+        with socket.create_connection((host, port)) as sock:
+            with context.wrap_socket(sock, server_hostname=host,
+                                     do_handshake_on_connect=False) as tls:
+                start = time.monotonic()
+                tls.do_handshake()
+                results.append((time.monotonic() - start, tls.session_reused))
+
+                # Give a TLS 1.3 server the chance to send its session ticket
+                tls.settimeout(0.2)
+                try:
+                    tls.recv(1)
+                except (socket.timeout, ssl.SSLError, OSError):
+                    pass
+                context.remember(tls)
+    return results
+
+
+def main(args):
+    context = make_tls_context(args.ca_certs)
+    if args.insecure:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    for seconds, resumed in probe(args.host, args.port, context, args.count):
+        print("{:8.1f} ms  {}".format(seconds * 1000, "resumed" if resumed else "full"))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure TLS handshakes and resumption')
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--ca-certs', help='CA certificates to verify the server with')
+    parser.add_argument('-n', '--count', type=int, default=5,
+                        help='Number of connections')
+    parser.add_argument('--insecure', action='store_true',
+                        help="Don't verify the server's certificate")
+    main(parser.parse_args())
@@ -0,0 +1,111 @@
+"""
+Structured dead letters for samples that couldn't be published.
+
+A dead letter keeps the queue item exactly as it was (its msgpack bytes), so
+it can be replayed, together with what went wrong:
+
+    {"raw": <msgpack bytes of the queue item>,
+     "topic": <topic it was being published to>,
+     "stage": "encode" | "publish" | "queue",
+     "error": <exception class>, "message": <str(exception)>,
+     "failed_at": <microseconds since the epoch>}
+
+Older units pushed {"message": ..., "data": str(item)} instead; those can't be
+replayed and are always treated as permanent failures.
+
+A dead letter is transient if the item is still a valid sample (or block) and
+encodes now, so sending it again should work, and permanent otherwise.
+utils.redrive republishes the transient ones in bulk.
+"""
+import json
+import logging
+import time
+
+from utils import block_codec
+from utils.queue_reader import block_of, decode
+
+LOGGER = logging.getLogger(__name__)
+
+ENCODE = 'encode'
+PUBLISH = 'publish'
+QUEUE = 'queue'
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+
+class InvalidItem(ValueError):
+    pass
+
+
+class DeadLetterStore:
+    def __init__(self, queue):
+        self.queue = queue
+
+    def add(self, item, error, stage, topic=None):
+        """Stores a queue item that failed at stage with error."""
+        self.queue.push({"raw": self.queue.dumps(item),
+                         "topic": topic,
+                         "stage": stage,
+                         "error": type(error).__name__,
+                         "message": str(error),
+                         "failed_at": int(time.time() * 1e6)})
+
+    def __len__(self):
+        return len(self.queue)
+
+
+def validate(item):
+    """
+    Checks that a queue item can be published and returns what would be sent:
+    ('block', bytes) or ('sample', JSON string). Raises InvalidItem otherwise.
+    """
+    block = block_of(item)
+    if block is not None:
+        try:
+            block_codec.decode(bytes(block))
+        except (block_codec.CodecError, ValueError, TypeError) as e:
+            raise InvalidItem("Corrupt block: {}".format(e))
+        return 'block', bytes(block)
+
+    if not isinstance(item, dict):
+        raise InvalidItem("Not a sample: {!r}".format(type(item).__name__))
+
+    sample = decode(item)
+    if not isinstance(sample.get('sample_time'), int):
+        raise InvalidItem("Missing sample_time")
+    if not isinstance(sample.get('data'), dict):
+        raise InvalidItem("Missing data")
+
+    try:
+        return 'sample', json.dumps(sample)
+    except (TypeError, ValueError) as e:
+        raise InvalidItem("Unable to encode: {}".format(e))
+
+
+def get(entry, key):
+    if not isinstance(entry, dict):
+        return None
+    value = entry.get(key, entry.get(key.encode()))
+    if isinstance(value, bytes) and key != 'raw':
+        return value.decode()
+    return value
+
+
+def classify(entry, loads):
+    """
+    Returns (TRANSIENT or PERMANENT, kind, payload, reason) for a dead letter.
+    kind and payload are what validate() returned, or None if permanent.
+    """
+    raw = get(entry, 'raw')
+    if raw is None:
+        return PERMANENT, None, None, "No original data"
+
+    try:
+        kind, payload = validate(loads(raw))
+    except InvalidItem as e:
+        return PERMANENT, None, None, str(e)
+    except Exception as e:
+        return PERMANENT, None, None, "Unable to unpack: {}".format(e)
+
+    return TRANSIENT, kind, payload, get(entry, 'error')
@@ -0,0 +1,97 @@
+"""
+Leaves fields that haven't changed out of samples.
+
+Most fields of a sample barely move from one minute to the next (wireless
+counters, the firmware, temperature and humidity), yet every sample carries
+all of them. A deadband rule for a field only reports it when it has moved by
+at least `absolute`, or by `relative` times its last reported value, since it
+was last reported; a rule with neither reports any change. Either way the
+field is reported again after `max_silence` seconds. Fields without a rule
+are always reported.
+
+Every keyframe_interval seconds (and after a restart) a sample has every
+field, so a consumer can rebuild the full state from the last keyframe and
+the samples after it: a field missing from a sample hasn't changed since it
+was last reported. Each sample says whether it is a keyframe in
+metadata.keyframe.
+
+Rules are named by field, or metadata.<field> for metadata.
+"""
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class Rule:
+    def __init__(self, absolute=None, relative=None, max_silence=None):
+        self.absolute = absolute
+        self.relative = relative
+        self.max_silence = max_silence
+
+    def changed(self, value, previous):
+        if not (is_number(value) and is_number(previous)):
+            return value != previous
+
+        delta = abs(value - previous)
+        if delta == 0:
+            return False
+        if self.absolute is None and self.relative is None:
+            return True
+        if self.absolute is not None and delta >= self.absolute:
+            return True
+        return self.relative is not None and delta >= self.relative * abs(previous)
+
+    def report(self, value, last, now):
+        """Whether to report value; last is (value, time) when it was last reported."""
+        if last is None:
+            return True
+
+        previous, reported_at = last
+        if self.max_silence is not None and now - reported_at >= self.max_silence:
+            return True
+        return self.changed(value, previous)
+
+
+class Deadband:
+    def __init__(self, rules=None, keyframe_interval=3600):
+        self.keyframe_interval = keyframe_interval
+        self.rules = {}
+        for name, rule_cfg in (rules or {}).items():
+            section, _, field = name.rpartition('.')
+            self.rules[section or 'data', field] = Rule(**(rule_cfg or {}))
+
+        self.last = {}  # (section, field): (value, time it was reported)
+        self.last_keyframe = None
+
+    def filter(self, sample):
+        """Returns a copy of the sample without the fields that don't need reporting."""
+        now = time.monotonic()
+        keyframe = self.last_keyframe is None or \
+            now - self.last_keyframe >= self.keyframe_interval
+        if keyframe:
+            self.last_keyframe = now
+
+        sample = {key: dict(value) if isinstance(value, dict) else value
+                  for key, value in sample.items()}
+
+        omitted = 0
+        for (section, field), rule in self.rules.items():
+            values = sample.get(section)
+            if not isinstance(values, dict) or field not in values:
+                continue
+
+            value = values[field]
+            if keyframe or rule.report(value, self.last.get((section, field)), now):
+                self.last[section, field] = (value, now)
+            else:
+                del values[field]
+                omitted += 1
+
+        sample.setdefault('metadata', {})['keyframe'] = keyframe
+        LOGGER.debug("Left %d unchanged fields out of the sample", omitted)
+        return sample
@@ -0,0 +1,201 @@
+"""
+Device metadata (firmware version, hostname, network interface, MAC and IP
+address) computed once and served from memory.
+
+Everything here used to be re-derived through subprocesses on every sample.
+The values are now refreshed only when something changes: on SIGHUP (see
+request_refresh), when the kernel reports an address or link change over
+netlink, or when .git/HEAD is modified.
+"""
+import fcntl
+import logging
+import os
+import socket
+import struct
+import subprocess
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+SIOCGIFADDR = 0x8915
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+POLL_INTERVAL = 30
+
+_DEVICE_INFO = None
+_DEVICE_INFO_LOCK = threading.Lock()
+
+
+def get_device_info():
+    """Returns the device information shared by main and the sensors."""
+    global _DEVICE_INFO
+
+    with _DEVICE_INFO_LOCK:
+        if _DEVICE_INFO is None:
+            _DEVICE_INFO = DeviceInfo()
+        return _DEVICE_INFO
+
+
+def get_firmware_version(repo_dir='.'):
+    try:
+        return subprocess.check_output(["git", "describe"], cwd=repo_dir,
+                                       stderr=subprocess.DEVNULL,
+                                       timeout=10).strip().decode()
+    except (OSError, subprocess.SubprocessError):
+        LOGGER.warning("Unable to get firmware version")
+        return ''
+
+
+def find_wireless_interface():
+    try:
+        interfaces = sorted(os.listdir('/sys/class/net'))
+    except OSError:
+        return None
+
+    for interface in interfaces:
+        if os.path.isdir(os.path.join('/sys/class/net', interface, 'wireless')):
+            return interface
+    return None
+
+
+def get_mac_address(interface):
+    try:
+        with open(os.path.join('/sys/class/net', interface, 'address')) as f:
+            return f.readline().strip()
+    except OSError:
+        return ''
+
+
+def get_ip_address(interface):
+    request = struct.pack('256s', interface[:15].encode())
+
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            result = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)
+        return socket.inet_ntoa(result[20:24])
+    except OSError:
+        # No address assigned
+        return ''
+
+
+class DeviceInfo:
+    def __init__(self, repo_dir='.', interface=None):
+        self.repo_dir = repo_dir
+        self.configured_interface = interface
+
+        self.lock = threading.Lock()
+        self.refresh_event = threading.Event()
+        self.running = False
+
+        self.firmware = ''
+        self.hostname = ''
+        self.interface = None
+        self.mac_address = ''
+        self.ip_address = ''
+
+        self.head_mtime = None
+        self.refresh()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+
+        self.thread = threading.Thread(target=self._run,
+                                       name="DeviceInfoThread", daemon=True)
+        self.thread.start()
+
+        self.netlink_thread = threading.Thread(target=self._watch_netlink,
+                                               name="NetlinkThread",
+                                               daemon=True)
+        self.netlink_thread.start()
+
+    def stop(self):
+        self.running = False
+        self.refresh_event.set()
+
+    def request_refresh(self, *args):
+        """Asks for everything to be refreshed. Safe to use as a signal handler."""
+        self.refresh_event.set()
+
+    def _head_mtime(self):
+        try:
+            return os.stat(os.path.join(self.repo_dir, '.git', 'HEAD')).st_mtime
+        except OSError:
+            return None
+
+    def _run(self):
+        while self.running:
+            refresh = self.refresh_event.wait(timeout=POLL_INTERVAL)
+            self.refresh_event.clear()
+
+            if not self.running:
+                break
+
+            if refresh:
+                self.refresh()
+            elif self._head_mtime() != self.head_mtime:
+                LOGGER.info("Firmware changed")
+                self.refresh_firmware()
+
+    def _watch_netlink(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 socket.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+        except (AttributeError, OSError):
+            LOGGER.warning("Netlink is not available, network information "
+                           "will only be refreshed on request")
+            return
+
+        with sock:
+            while self.running:
+                try:
+                    sock.recv(65535)
+                except OSError:
+                    LOGGER.exception("Error while reading from netlink")
+                    break
+
+                LOGGER.debug("Network configuration changed")
+                self.refresh_network()
+
+    def refresh(self):
+        self.refresh_firmware()
+        self.refresh_network()
+
+    def refresh_firmware(self):
+        head_mtime = self._head_mtime()
+        firmware = get_firmware_version(self.repo_dir)
+        hostname = socket.gethostname()
+
+        with self.lock:
+            self.head_mtime = head_mtime
+            self.firmware = firmware
+            self.hostname = hostname
+
+        LOGGER.info("Firmware: %s, hostname: %s", firmware, hostname)
+
+    def refresh_network(self):
+        interface = self.configured_interface or find_wireless_interface()
+
+        if interface is None:
+            mac_address = ip_address = ''
+        else:
+            mac_address = get_mac_address(interface)
+            ip_address = get_ip_address(interface)
+
+        with self.lock:
+            self.interface = interface
+            self.mac_address = mac_address
+            self.ip_address = ip_address
+
+        LOGGER.info("Interface: %s, MAC address: %s, IP address: %s",
+                    interface, mac_address, ip_address)
+
+    def as_dict(self):
+        with self.lock:
+            return {"firmware": self.firmware,
+                    "hostname": self.hostname,
+                    "interface": self.interface,
+                    "mac_address": self.mac_address,
+                    "ip_address": self.ip_address}
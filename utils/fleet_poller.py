@@ -0,0 +1,235 @@
+"""
+Pulls air_quality batches from many devices in parallel over CoAP.
+
+Devices are found with multicast discovery (or given on the command line) and
+are all polled concurrently through a single token-multiplexed client. Each
+device's acknowledgement count is only advanced once its batch has been
+written out, and is dropped when a request fails: the device may already have
+deleted the acknowledged samples and moved on to a batch that never arrived,
+which a repeated count would delete. A crash or lost response means samples
+are sent again (and deduplicated by sequence) rather than lost.
+
+    python -m utils.fleet_poller --discover --size 100 --output samples.jsonl
+"""
+import argparse
+import json
+import logging
+import struct
+import sys
+import threading
+import time
+
+from utils import coap
+from utils.coap_client import Client, parse_uri
+
+LOGGER = logging.getLogger(__name__)
+
+AIR_QUALITY_PATH = 'air_quality'
+ACK_REQUEST = struct.Struct('!HH')
+
+
+def parse_discovery(payload):
+    """Returns the attributes from a /.well-known/core response."""
+    attributes = {}
+    for link in payload.decode(errors='replace').split(';'):
+        link = link.strip().strip('<>/')
+        if '=' in link:
+            key, value = link.split('=', 1)
+            attributes[key] = value
+    return attributes
+
+
+class Device:
+    def __init__(self, address, name=None):
+        self.address = address
+        self.name = name or '{}:{}'.format(*address)
+
+        # Number of samples received in the last batch that haven't been
+        # acknowledged yet
+        self.acks = 0
+        self.drained = False
+        self.samples = 0
+        self.bytes = 0
+        self.errors = 0
+
+
+class FleetPoller:
+    def __init__(self, client, devices, size=100, concurrency=64,
+                 sink=None, max_errors=5):
+        self.client = client
+        self.devices = devices
+        self.size = size
+        self.max_errors = max_errors
+        self.sink = sink or (lambda device, samples: None)
+
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.in_flight = 0  # Devices that haven't finished yet
+
+        self.start_time = None
+        self.samples = 0
+        self.bytes = 0
+        self.requests = 0
+
+    @classmethod
+    def discover(cls, client, wait=3, **kwargs):
+        devices = []
+        for response in client.multicast_discover(wait=wait):
+            attributes = parse_discovery(response.payload)
+            devices.append(Device(response.source, attributes.get('name')))
+            LOGGER.info("Discovered %s at %s", devices[-1].name, response.source[0])
+
+        return cls(client, devices, **kwargs)
+
+    def run(self):
+        """Drains every device and returns the aggregate statistics."""
+        self.start_time = time.monotonic()
+
+        with self.lock:
+            self.in_flight = len(self.devices)
+            if self.in_flight == 0:
+                self.done.set()
+
+        for device in self.devices:
+            self._poll(device)
+        self.done.wait()
+
+        return self.stats()
+
+    def _poll(self, device):
+        self.slots.acquire()
+        with self.lock:
+            self.requests += 1
+
+        # Once the device is drained only the final acknowledgement is sent
+        size = 0 if device.drained else self.size
+        payload = ACK_REQUEST.pack(device.acks, size)
+
+        future = self.client.request(AIR_QUALITY_PATH, payload=payload,
+                                     destination=device.address)
+        future.add_done_callback(lambda f: self._received(device, size, f.result()))
+
+    def _received(self, device, size, response):
+        self.slots.release()
+
+        try:
+            more = self._process(device, size, response)
+        except Exception:
+            LOGGER.exception("Unable to process response from %s", device.name)
+            device.acks = 0
+            device.errors += 1
+            more = device.errors < self.max_errors
+
+        with self.lock:
+            if not more:
+                self.in_flight -= 1
+                if self.in_flight == 0:
+                    self.done.set()
+
+        if more:
+            # The client's receive thread must not block on the semaphore
+            threading.Thread(target=self._poll, args=(device,), daemon=True).start()
+
+    def _process(self, device, size, response):
+        if response is None or response.code != coap.CONTENT:
+            # The acknowledgement may have been applied already
+            device.acks = 0
+            device.errors += 1
+            LOGGER.warning("No data from %s (%s)", device.name,
+                           'timeout' if response is None else coap.code_string(response.code))
+            return device.errors < self.max_errors
+
+        if size == 0:
+            # Final acknowledgement was accepted
+            device.acks = 0
+            return False
+
+        samples = json.loads(response.payload.decode())
+        self.sink(device, samples)
+        device.errors = 0
+
+        # Only acknowledge what has been handed to the sink
+        device.acks = len(samples)
+        device.samples += len(samples)
+        device.bytes += len(response.payload)
+        device.drained = len(samples) < size
+
+        with self.lock:
+            self.samples += len(samples)
+            self.bytes += len(response.payload)
+
+        return True
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.start_time, 1e-9)
+        return {'devices': len(self.devices),
+                'requests': self.requests,
+                'samples': self.samples,
+                'bytes': self.bytes,
+                'elapsed': elapsed,
+                'samples_per_second': self.samples / elapsed,
+                'bytes_per_second': self.bytes / elapsed,
+                'failed_devices': [device.name for device in self.devices
+                                   if device.errors >= self.max_errors]}
+
+
+def main(args):
+    client = Client()
+
+    if args.output == '-':
+        output = sys.stdout
+    else:
+        output = open(args.output, 'a')
+    write_lock = threading.Lock()
+
+    def sink(device, samples):
+        with write_lock:
+            for sample in samples:
+                output.write(json.dumps({'device': device.name, 'sample': sample}) + '\n')
+            output.flush()
+
+    try:
+        kwargs = dict(size=args.size, concurrency=args.concurrency, sink=sink)
+        if args.discover:
+            poller = FleetPoller.discover(client, wait=args.wait, **kwargs)
+        else:
+            devices = []
+            for uri in args.devices:
+                host, port, _ = parse_uri(uri)
+                devices.append(Device((host, port)))
+            poller = FleetPoller(client, devices, **kwargs)
+
+        stats = poller.run()
+        print("Polled {devices} devices: {samples} samples, {bytes} bytes in "
+              "{elapsed:.1f} s ({samples_per_second:.1f} samples/s, "
+              "{bytes_per_second:.0f} B/s)".format(**stats), file=sys.stderr)
+        if stats['failed_devices']:
+            print("Failed: {}".format(', '.join(stats['failed_devices'])),
+                  file=sys.stderr)
+
+    except KeyboardInterrupt:
+        print("Stopping", file=sys.stderr)
+    finally:
+        client.stop()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Drain many CoAP sensors in parallel')
+    parser.add_argument('devices', nargs='*',
+                        help='Devices to poll (coap://host[:port])')
+    parser.add_argument('-d', '--discover', action='store_true',
+                        help='Discover devices with multicast')
+    parser.add_argument('-w', '--wait', type=float, default=3,
+                        help='Seconds to wait for discovery responses')
+    parser.add_argument('-s', '--size', type=int, default=100,
+                        help='Number of samples to request at a time')
+    parser.add_argument('-c', '--concurrency', type=int, default=64,
+                        help='Maximum number of requests in flight')
+    parser.add_argument('-o', '--output', default='-',
+                        help='File to append samples to as JSON lines')
+    main(parser.parse_args())
@@ -0,0 +1,161 @@
+"""
+Per-sensor circuit breakers.
+
+A sensor that is unplugged or broken fails the same way every cycle: a read
+that times out, a traceback in the log every minute, an LCD that isn't there.
+Every sensor is wrapped in a SupervisedSensor that counts its failures: a
+read(), data(), status() or transmitted_data() that raises, or a read() that
+returns nothing but None.
+
+After failures consecutive failures the circuit opens and the sensor isn't
+called at all. Once the backoff has passed (initial seconds, doubling up to
+maximum, with jitter) a single call is let through (half-open): if it
+succeeds the circuit closes again, otherwise it reopens for longer. Only the
+first failure, opening and recovering are logged, so a dead peripheral costs
+neither CPU nor log I/O. Input sensors are called from the sampling, network
+and MQTT threads, so the circuit is locked and other calls made while the
+probe is running are refused.
+
+While a sensor isn't read its fields are reported as None, so they don't
+disappear from the samples. They are the fields the sensor declares in its
+fields attribute, or the ones its last successful read returned.
+
+Each sample carries the state of every circuit in <sensor>_circuit (0 closed,
+1 half-open, 2 open) and the failures counted since startup in
+<sensor>_failures.
+"""
+import logging
+import threading
+import time
+
+from utils.connection import Backoff
+
+LOGGER = logging.getLogger(__name__)
+
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+
+class Circuit:
+    def __init__(self, name, failures=3, initial=60, maximum=3600):
+        self.name = name
+        self.threshold = failures
+        self.backoff = Backoff(initial, maximum)
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.consecutive = 0
+        self.failures = 0  # Since startup
+        self.retry_at = None
+
+    def allow(self):
+        """True if the sensor should be called now."""
+        with self.lock:
+            if self.state == HALF_OPEN:
+                # The probe is still running
+                return False
+            if self.state == OPEN:
+                if time.monotonic() < self.retry_at:
+                    return False
+                self.state = HALF_OPEN
+            return True
+
+    def success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                LOGGER.info("%s has recovered after %s failures",
+                            self.name, self.consecutive)
+            self.state = CLOSED
+            self.consecutive = 0
+            self.backoff.reset()
+
+    def failure(self):
+        with self.lock:
+            self.consecutive += 1
+            self.failures += 1
+
+            if self.state == HALF_OPEN or self.consecutive >= self.threshold:
+                delay = self.backoff.next()
+                if self.state == CLOSED:
+                    LOGGER.warning("%s failed %s times, not calling it for %.0f s",
+                                   self.name, self.consecutive, delay)
+                self.state = OPEN
+                self.retry_at = time.monotonic() + delay
+
+
+class SupervisedSensor:
+    """Stands in for a sensor, calling it only while its circuit allows."""
+    def __init__(self, sensor, circuit):
+        self.sensor = sensor
+        self.circuit = circuit
+        self.fields = list(getattr(sensor, 'fields', None) or [])
+
+    def __getattr__(self, name):
+        # name, type, min_interval, start, stop...
+        return getattr(self.sensor, name)
+
+    def _failed(self, method, exp):
+        if self.circuit.consecutive == 0:
+            LOGGER.warning("%s.%s failed: %s", self.circuit.name, method, exp,
+                           exc_info=True)
+        else:
+            LOGGER.debug("%s.%s failed again: %s", self.circuit.name, method, exp)
+        self.circuit.failure()
+
+    def read(self):
+        if not self.circuit.allow():
+            return {field: None for field in self.fields}
+
+        try:
+            values = self.sensor.read()
+        except Exception as exp:
+            self._failed('read', exp)
+            return {field: None for field in self.fields}
+
+        if any(value is not None for value in values.values()):
+            self.circuit.success()
+            self.fields = list(values)
+        else:
+            self.circuit.failure()
+        return values
+
+    def _call(self, method, *args):
+        if not self.circuit.allow():
+            return
+
+        try:
+            getattr(self.sensor, method)(*args)
+        except Exception as exp:
+            self._failed(method, exp)
+        else:
+            self.circuit.success()
+
+    def data(self, data):
+        self._call('data', data)
+
+    def status(self, message):
+        self._call('status', message)
+
+    def transmitted_data(self, queue_length):
+        self._call('transmitted_data', queue_length)
+
+
+class SensorHealth:
+    def __init__(self, failures=3, initial=60, maximum=3600):
+        self.failures = failures
+        self.initial = initial
+        self.maximum = maximum
+        self.circuits = []
+
+    def supervise(self, sensor):
+        circuit = Circuit(sensor.name, self.failures, self.initial, self.maximum)
+        self.circuits.append(circuit)
+        return SupervisedSensor(sensor, circuit)
+
+    def fields(self):
+        data = {}
+        for circuit in self.circuits:
+            data[circuit.name + '_circuit'] = circuit.state
+            data[circuit.name + '_failures'] = circuit.failures
+        return data
@@ -0,0 +1,98 @@
+"""
+Two publishing lanes so the newest samples don't wait behind the backlog.
+
+New samples go into a small live queue that is published right away. The live
+queue only keeps the newest live_size samples: when the broker is unreachable
+the older ones are moved, in order, to the backlog queue, which is drained
+separately (and throttled) once the connection is back. Each lane is a FIFO,
+so samples are sent in order within a lane.
+
+If the process dies while moving a sample from the live queue to the backlog,
+the sample is in both and is sent twice; (boot_id, sequence) identifies the
+duplicate.
+"""
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Limits a lane to rate bytes per second (None for no limit)."""
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Waits until amount bytes may be sent."""
+        if self.rate is None:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # A message larger than the burst is allowed but goes into debt
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+def split_bandwidth(total, live_share):
+    """Returns (live, backfill) rates from a total rate in bytes per second."""
+    if total is None:
+        return None, None
+    return total * live_share, total * (1 - live_share)
+
+
+class Lanes:
+    def __init__(self, live, backlog, live_size=10):
+        self.live = live
+        self.backlog = backlog
+        self.live_size = live_size
+
+        self.lock = threading.Lock()
+        self.publishing = False
+
+    def push(self, item):
+        self.live.push(item)
+        self.demote()
+
+    def __len__(self):
+        return len(self.live) + len(self.backlog)
+
+    def demote(self):
+        """Moves the oldest live samples to the backlog."""
+        with self.lock:
+            # Items the live lane is sending can't be moved
+            if self.publishing or len(self.live) <= self.live_size:
+                return
+
+            moved = 0
+            while len(self.live) > self.live_size:
+                self.backlog.push(self.live.peek())
+                self.live.delete()
+                moved += 1
+
+            self.live.flush()
+            LOGGER.debug("Moved %d samples to the backlog", moved)
+
+    @contextmanager
+    def sending(self):
+        """Held by the live lane while it has a batch in flight."""
+        with self.lock:
+            self.publishing = True
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.publishing = False
+            self.demote()
@@ -0,0 +1,178 @@
+"""
+Current readings for other processes on the device.
+
+The newest sample and a short history of every numeric field are kept in
+memory and served over HTTP, on localhost or on a Unix domain socket, so a
+kiosk display or local dashboard doesn't have to go through the cloud broker
+or open the sensors itself:
+
+    GET /latest                     the newest sample, with its version
+    GET /latest?after=N&timeout=30  waits (long-poll) for a sample newer than
+                                    version N, or returns 204 after timeout
+    GET /history                    [[sample_time, value], ...] of each field
+    GET /history/<field>?since=T    one field, from sample_time T on
+    GET /subscribe                  every new sample as server-sent events
+
+The sampling thread only stores the sample and wakes the waiting requests; all
+the encoding and socket work happens on the server's threads.
+
+    curl --unix-socket /run/epifi/api.sock http://localhost/latest
+"""
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import os
+import socketserver
+import threading
+from urllib.parse import parse_qs, urlparse
+
+LOGGER = logging.getLogger(__name__)
+
+KEEPALIVE_INTERVAL = 15
+MAX_TIMEOUT = 300
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class LastValueCache:
+    def __init__(self, history=360):
+        self.history_size = history
+        self.condition = threading.Condition()
+        self.latest = None
+        self.version = 0
+        self.history = {}  # Field: deque of (sample_time, value)
+
+    def update(self, sample):
+        """Called by the sampling thread with each new sample."""
+        sample_time = sample.get('sample_time')
+        with self.condition:
+            self.latest = sample
+            self.version += 1
+            for field, value in sample.get('data', {}).items():
+                if not is_number(value):
+                    continue
+                history = self.history.get(field)
+                if history is None:
+                    history = self.history[field] = deque(maxlen=self.history_size)
+                history.append((sample_time, value))
+            self.condition.notify_all()
+
+    def get(self, after=None, timeout=0):
+        """
+        Returns (version, sample), waiting up to timeout seconds for a sample
+        newer than version after. sample is None if there wasn't one.
+        """
+        with self.condition:
+            if after is not None:
+                self.condition.wait_for(lambda: self.version > after, timeout)
+                if self.version <= after:
+                    return self.version, None
+            return self.version, self.latest
+
+    def fields(self, field=None, since=None):
+        with self.condition:
+            names = list(self.history) if field is None else [field]
+            return {name: [list(reading) for reading in self.history.get(name, ())
+                           if since is None or reading[0] >= since]
+                    for name in names}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+    def send_json(self, value, status=200):
+        body = json.dumps(value, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+        cache = self.server.cache
+
+        try:
+            if parts == ['latest']:
+                after = int(query['after']) if 'after' in query else None
+                timeout = min(float(query.get('timeout', 30)), MAX_TIMEOUT)
+                version, sample = cache.get(after, timeout)
+                if sample is None:
+                    self.send_response(204)
+                    self.end_headers()
+                else:
+                    self.send_json({'version': version, 'sample': sample})
+            elif parts and parts[0] == 'history' and len(parts) <= 2:
+                since = int(query['since']) if 'since' in query else None
+                self.send_json(cache.fields(parts[1] if len(parts) == 2 else None, since))
+            elif parts == ['subscribe']:
+                self.subscribe(cache)
+            else:
+                self.send_json({'error': 'Not found'}, 404)
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 400)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def subscribe(self, cache):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        version = cache.version
+        while self.server.running:
+            version_now, sample = cache.get(version, KEEPALIVE_INTERVAL)
+            if sample is None:
+                self.wfile.write(b': keepalive\n\n')
+            else:
+                version = version_now
+                self.wfile.write('id: {}\ndata: {}\n\n'.format(
+                    version, json.dumps(sample, default=str)).encode())
+            self.wfile.flush()
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+class LocalApi:
+    def __init__(self, cache, host='127.0.0.1', port=8090, socket_path=None):
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)  # Left over from the last run
+            self.server = ThreadingUnixHTTPServer(socket_path, Handler)
+        else:
+            self.server = ThreadingHTTPServer((host, port), Handler)
+
+        self.server.cache = cache
+        self.server.running = True
+        self.address = socket_path or '{}:{}'.format(host, port)
+
+    def start(self):
+        LOGGER.info("Serving current readings on %s", self.address)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="LocalApiThread", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.running = False
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,129 @@
+"""
+Lazily reads the samples in a persistent queue file without loading it.
+
+PersistentQueue.peek() reads every requested record into a list, which
+doesn't work for a backlog of a million samples on a BeagleBone. This reads
+the file format of python-persistent-queue 1.3.0 directly: a header with the
+number of items and the offset of the first item, followed by records that
+are each a 4 byte length and a msgpack payload.
+"""
+import os
+import struct
+
+import msgpack
+
+LENGTH_STRUCT = struct.Struct('I')
+HEADER_STRUCT = struct.Struct('II')
+READ_BUFFER = 64 * 1024
+
+
+def iter_records(f, offset, count=None):
+    """
+    Yields (offset, raw bytes) for the items in an open queue file starting
+    at offset, until the end of the file or count items have been read.
+    """
+    f.seek(offset)
+    position = offset
+    index = 0
+
+    while count is None or index < count:
+        size = f.read(LENGTH_STRUCT.size)
+        if len(size) < LENGTH_STRUCT.size:
+            break
+        size, = LENGTH_STRUCT.unpack(size)
+
+        data = f.read(size)
+        if len(data) < size:
+            break  # Partially written item
+        yield position, data
+
+        position += LENGTH_STRUCT.size + size
+        index += 1
+
+
+def decode(value):
+    """Recursively converts bytes (from older versions of msgpack) to str."""
+    if isinstance(value, dict):
+        return {decode(k): decode(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [decode(v) for v in value]
+    elif isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def block_of(item):
+    """The encoded samples if the item is a compacted block, otherwise None."""
+    if isinstance(item, dict):
+        return item.get('block', item.get(b'block'))
+    return None
+
+
+def expand(item):
+    """Decoded samples in a queue item, which may be a compacted block."""
+    block = block_of(item)
+    if block is None:
+        return [decode(item)]
+
+    from utils import block_codec
+    return block_codec.decode(block)
+
+
+class QueueReader:
+    def __init__(self, filename, path='.', loads=msgpack.unpackb):
+        self.filename = os.path.join(path, filename)
+        self.loads = loads
+
+    def header(self):
+        """Returns (number of items, offset of the first item)."""
+        with open(self.filename, 'rb') as f:
+            return HEADER_STRUCT.unpack(f.read(HEADER_STRUCT.size))
+
+    def __len__(self):
+        return self.header()[0]
+
+    def records(self, start=0, offset=None, count=None):
+        """
+        Yields (offset, raw bytes) for each item, skipping the first start
+        items. Reading can begin at a known item offset instead of the top of
+        the queue, in which case start is relative to that offset.
+        """
+        with open(self.filename, 'rb', buffering=READ_BUFFER) as f:
+            length, top = HEADER_STRUCT.unpack(f.read(HEADER_STRUCT.size))
+            f.seek(top if offset is None else offset)
+            position = f.tell()
+
+            # Only items that were in the queue when we started are read; the
+            # queue may be pushed to while we are reading it
+            remaining = length if offset is None else None
+            index = 0
+            while remaining is None or index < remaining:
+                if count is not None and index >= start + count:
+                    break
+
+                size = f.read(LENGTH_STRUCT.size)
+                if len(size) < LENGTH_STRUCT.size:
+                    break
+                size, = LENGTH_STRUCT.unpack(size)
+
+                if index < start:
+                    f.seek(size, 1)
+                else:
+                    data = f.read(size)
+                    if len(data) < size:
+                        break  # Partially written item
+                    yield position, data
+
+                position += LENGTH_STRUCT.size + size
+                index += 1
+
+    def __iter__(self):
+        return self.samples()
+
+    def samples(self, start=0, offset=None, count=None):
+        """
+        Yields each sample in the queue decoded. start and count are in
+        queue items; a compacted block is one item.
+        """
+        for _, data in self.records(start, offset, count):
+            yield from expand(self.loads(data))
@@ -1,36 +1,170 @@
+"""
+View data from a queue.
+
+Samples are streamed from the queue file one at a time, so a unit with a huge
+backlog can be inspected without running out of memory. Run from the top of
+the repository:
+
+    python -m utils.queue_viewer sensor.queue --since 2017-03-01T12:00 \\
+        --fields sample_time,sequence,pm_small --format csv
+"""
 import argparse
-from datetime import datetime
+import csv
+from datetime import datetime, timezone
+from itertools import islice
+import json
+import sys
 
-import msgpack
-from persistent_queue import PersistentQueue
-import pytz
 from tabulate import tabulate
 
+from utils.queue_reader import QueueReader
+from utils.time_index import read_range
+
+
+def parse_time(value):
+    """Accepts seconds since the epoch or an ISO 8601 date (UTC if naive)."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def flatten(sample):
+    """
+    Flattens a sample into a single level. Fields in data keep their names,
+    everything else is prefixed with where it came from (metadata.firmware).
+    """
+    row = {}
+    for key, value in sample.items():
+        if key == 'data' and isinstance(value, dict):
+            row.update(value)
+        elif isinstance(value, dict):
+            for name, field in value.items():
+                row['{}.{}'.format(key, name)] = field
+        else:
+            row[key] = value
+    return row
+
+
+def format_time(sample_time):
+    if sample_time is None:
+        return None
+    return datetime.fromtimestamp(sample_time / 1e6, timezone.utc).isoformat()
+
+
+def select(reader, start, end, since, until):
+    count = None if end == 0 else max(end - start, 0)
+
+    if since is None and until is None:
+        samples = reader.samples(start=start, count=count)
+    else:
+        # Seek to the time range with the queue's index; start and end are
+        # then positions within the range
+        since = 0 if since is None else since
+        until = float('inf') if until is None else until
+        samples = read_range(reader.filename, int(since * 1e6),
+                             until * 1e6, reader.loads)
+        samples = islice(samples, start, None if count is None else start + count)
+
+    for sample in samples:
+        sample_time = sample.get('sample_time')
+        if sample_time is not None:
+            if since is not None and sample_time < since * 1e6:
+                continue
+            if until is not None and sample_time >= until * 1e6:
+                continue
+        yield flatten(sample)
+
+
+def project(rows, fields):
+    if fields is None:
+        # Use the columns of the first row for the whole stream
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return [], iter(())
+        fields = list(first)
+        rows = _chain(first, rows)
+
+    return fields, ([row.get(field) for field in fields] for row in rows)
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def write_table(fields, rows, page_size, out):
+    time_column = fields.index('sample_time') if 'sample_time' in fields else None
+
+    while True:
+        page = list(islice(rows, page_size))
+        if not page:
+            break
+
+        if time_column is not None:
+            for row in page:
+                row[time_column] = format_time(row[time_column])
+
+        out.write(tabulate(page, headers=fields) + '\n\n')
+
+
+def write_csv(fields, rows, out):
+    time_column = fields.index('sample_time') if 'sample_time' in fields else None
+
+    writer = csv.writer(out)
+    writer.writerow(fields)
+    for row in rows:
+        if time_column is not None:
+            row[time_column] = format_time(row[time_column])
+        writer.writerow(row)
+
 
-parser = argparse.ArgumentParser(description='View data from a queue')
-parser.add_argument('queue')
-parser.add_argument('start', type=int)
-parser.add_argument('end', type=int)
-args = parser.parse_args()
+def write_json_lines(fields, rows, out):
+    for row in rows:
+        out.write(json.dumps(dict(zip(fields, row))) + '\n')
 
-file = args.queue
-start = args.start
-end = args.end
 
-queue = PersistentQueue(file,
-                        dumps=msgpack.packb,
-                        loads=msgpack.unpackb)
+def main(args):
+    reader = QueueReader(args.queue)
+    since = None if args.since is None else parse_time(args.since)
+    until = None if args.until is None else parse_time(args.until)
+    fields = None if args.fields is None else args.fields.split(',')
 
-if end == 0:
-    data = queue.peek(len(queue))
-else:
-    data = queue.peek(end)
+    rows = select(reader, args.start, args.end, since, until)
+    fields, rows = project(rows, fields)
 
-data = data[start:]
+    try:
+        if args.format == 'csv':
+            write_csv(fields, rows, sys.stdout)
+        elif args.format == 'json':
+            write_json_lines(fields, rows, sys.stdout)
+        else:
+            write_table(fields, rows, args.page_size, sys.stdout)
+    except BrokenPipeError:
+        # Output was piped into head or less and closed early
+        pass
 
-data = [(humidity, large, datetime.utcfromtimestamp(sampletime).replace(tzinfo=pytz.utc), sequence, small, temperature)
-        for humidity, large, sampletime, sequence, small, temperature  in data]
 
-table = tabulate(data, headers=["Humidity", "Large", "Sample Time",
-                                "Sequence", "Small", "Temperature"])
-print(table)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='View data from a queue')
+    parser.add_argument('queue')
+    parser.add_argument('start', type=int, nargs='?', default=0,
+                        help='Index of the first sample to show')
+    parser.add_argument('end', type=int, nargs='?', default=0,
+                        help='Index to stop at (0 for the whole queue)')
+    parser.add_argument('--since', help='Only show samples taken at or after '
+                                        'this time (epoch seconds or ISO 8601)')
+    parser.add_argument('--until', help='Only show samples taken before this time')
+    parser.add_argument('--fields', help='Comma separated fields to show, e.g. '
+                                         'sample_time,pm_small,metadata.firmware')
+    parser.add_argument('--format', choices=['table', 'csv', 'json'],
+                        default='table', help='json writes one object per line')
+    parser.add_argument('--page-size', type=int, default=50,
+                        help='Rows per table page')
+    main(parser.parse_args())
@@ -0,0 +1,223 @@
+"""
+Keeps the on-device queues within a disk budget.
+
+Nothing else bounds the queues, so a unit that is offline for weeks would fill
+its SD card. The budget is max_bytes, or less if the disk doesn't have that
+much room: thinning writes a new copy of the queue before the old one is
+removed, so the budget leaves free space for a copy of the queue file plus
+min_free bytes. Once the queue files use more than thin_at of the budget, the
+oldest samples are thinned: consecutive samples are merged into 5 minute
+averages, then (if that isn't enough) hourly averages, until usage is back
+down to target. Dropping the oldest samples is the last resort, only when
+even hourly averages don't fit. The bad queue is only ever kept to its share
+of the budget by dropping its oldest entries.
+
+A merged sample is an ordinary sample: numeric fields are averaged (weighted
+by how many samples were already merged into each), other fields come from
+the newest sample, and its metadata records the interval and sample count in
+"thinned" and "thinned_count". It keeps the newest sample's sequence number
+and boot ID so it is still unique.
+"""
+import logging
+import os
+
+from utils.compactor import queue_locks, rewrite_queue
+from utils.queue_reader import block_of, decode
+
+LOGGER = logging.getLogger(__name__)
+
+THINNING_INTERVALS = [300, 3600]
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def merge(samples, interval):
+    """Merges decoded samples (oldest first) into one."""
+    weights = [sample['metadata'].get('thinned_count', 1) for sample in samples]
+    total = sum(weights)
+
+    data = {}
+    sums = {}
+    counts = {}
+    for sample, weight in zip(samples, weights):
+        for name, value in sample['data'].items():
+            if is_number(value) and name not in ('sequence', 'queue_length'):
+                sums[name] = sums.get(name, 0) + value * weight
+                counts[name] = counts.get(name, 0) + weight
+            else:
+                data[name] = value
+
+    for name in sums:
+        data[name] = sums[name] / counts[name]
+
+    metadata = dict(samples[-1]['metadata'])
+    metadata['thinned'] = interval
+    metadata['thinned_count'] = total
+
+    return {"sample_time": samples[0]['sample_time'],
+            "data": data,
+            "metadata": metadata}
+
+
+class DiskQuota:
+    def __init__(self, queue, bad_queue, max_bytes, thin_at=0.8, target=0.7,
+                 bad_queue_share=0.1, clock=None, skip=1, extra_files=(),
+                 min_free=16 * 1024 * 1024):
+        self.queue = queue
+        self.bad_queue = bad_queue
+        self.max_bytes = max_bytes
+        self.min_free = min_free
+        self.thin_at = thin_at
+        self.target = target
+        self.bad_queue_share = bad_queue_share
+        self.clock = clock
+        self.skip = skip
+        self.extra_files = list(extra_files)
+
+        # Coarsest thinning interval applied while usage was above target;
+        # -1 once samples had to be dropped
+        self.thinning = 0
+
+    @staticmethod
+    def _path(queue):
+        return os.path.join(queue.path, queue.filename)
+
+    def _size(self, filename):
+        try:
+            return os.path.getsize(filename)
+        except OSError:
+            return 0
+
+    def queue_bytes(self):
+        files = [self._path(self.queue), self._path(self.queue) + '.idx'] + \
+            self.extra_files
+        return sum(self._size(filename) for filename in files)
+
+    def usage(self):
+        """Bytes used by the queues."""
+        return self.queue_bytes() + self._size(self._path(self.bad_queue))
+
+    def budget(self, usage=None):
+        """max_bytes, or what the queues can grow to with room left to rewrite them."""
+        usage = self.usage() if usage is None else usage
+        try:
+            stat = os.statvfs(self.queue.path)
+        except OSError:
+            return self.max_bytes
+
+        available = stat.f_bavail * stat.f_frsize
+        room = usage + available - self._size(self._path(self.queue)) - self.min_free
+        return max(min(self.max_bytes, room), 0)
+
+    def check(self):
+        """Called after each push; thins the queue if it is getting full."""
+        usage = self.usage()
+        budget = self.budget(usage)
+        if usage > self.thin_at * budget:
+            self.enforce()
+        elif usage <= self.target * budget:
+            self.thinning = 0
+
+    def enforce(self):
+        """Thins the queues down to target. Returns the number of bytes freed."""
+        before = self.usage()
+        self._limit_bad_queue()
+
+        goal = self.target * self.budget()
+        with queue_locks(self.queue) as locked:
+            if not locked:
+                LOGGER.warning("Queue is busy, unable to make room")
+                return before - self.usage()
+
+            try:
+                for interval in THINNING_INTERVALS:
+                    need = self.usage() - goal
+                    if need <= 0:
+                        break
+
+                    LOGGER.warning("Queue uses %d bytes, thinning to %d s averages",
+                                   self.usage(), interval)
+                    rewrite_queue(self.queue, self.skip,
+                                  lambda records: self._thin(records, interval, need))
+                    self.thinning = max(self.thinning, interval)
+
+                need = self.usage() - goal
+                if need > 0:
+                    LOGGER.error("Queue still uses %d bytes, dropping the oldest samples",
+                                 self.usage())
+                    rewrite_queue(self.queue, self.skip,
+                                  lambda records: self._drop(records, need))
+                    self.thinning = -1
+            except OSError:
+                # Most likely no room for the copy
+                LOGGER.exception("Unable to rewrite the queue")
+
+        return before - self.usage()
+
+    def _limit_bad_queue(self):
+        limit = self.bad_queue_share * self.max_bytes
+        path = self._path(self.bad_queue)
+        if self._size(path) <= limit:
+            return
+
+        # Nothing reads the bad queue on the device, so drop from the top
+        count = len(self.bad_queue)
+        LOGGER.warning("Dropping the oldest half of the bad queue (%d items)", count)
+        self.bad_queue.delete(max(count // 2, 1))
+        self.bad_queue.flush()
+
+    def _thin(self, records, interval, need):
+        saved = 0
+        group = []  # (raw record, decoded sample) in the current interval
+        bucket = None
+
+        def close():
+            if len(group) == 1:
+                return group[0][0]
+            return self.queue.dumps(merge([sample for _, sample in group], interval))
+
+        for raw, item in records:
+            sample = None
+            if block_of(item) is None:
+                sample = decode(item)
+                if self.clock is not None:
+                    sample = self.clock.correct(sample)
+
+            mergeable = sample is not None and \
+                sample.get('sample_time') is not None and \
+                isinstance(sample.get('data'), dict) and \
+                isinstance(sample.get('metadata'), dict) and \
+                sample['metadata'].get('clock_synced', True) and \
+                sample['metadata'].get('thinned', 0) <= interval
+
+            this_bucket = sample['sample_time'] // (interval * 1000000) if mergeable else None
+            if group and this_bucket != bucket:
+                data = close()
+                saved += sum(len(record) for record, _ in group) - len(data)
+                yield data
+                group = []
+
+                if saved >= need:
+                    yield raw
+                    return
+
+            if not mergeable:
+                yield raw
+                continue
+
+            group.append((raw, sample))
+            bucket = this_bucket
+
+        if group:
+            yield close()
+
+    def _drop(self, records, need):
+        freed = 0
+        for raw, _ in records:
+            if freed >= need:
+                yield raw
+                return
+            freed += len(raw)
+
@@ -0,0 +1,203 @@
+"""
+Republishes the dead letters in the bad queue.
+
+Each dead letter is re-validated first. Transient ones (the sample is fine,
+sending it failed) are published again, many at a time with QoS 1, and only
+removed from the bad queue once the broker has acknowledged them. If the
+broker doesn't acknowledge a batch within the timeout or the connection
+drops, the acknowledged start of the batch is removed and the redrive stops.
+Permanent ones (legacy entries, or items that are no longer a valid sample)
+are moved to a separate queue so the bad queue can be emptied. A sample that
+is sent twice can be recognised by its (boot_id, sequence).
+
+Stop the sampling service first: a queue file can't be shared between
+processes. Uses the brokers of the given configuration file (the first one, by
+priority, that accepts a connection) and the MQTT_USERNAME and MQTT_PASSWORD
+environment variables, like main.py.
+
+    python -m utils.redrive dylos_configuration.yaml --dry-run
+    python -m utils.redrive dylos_configuration.yaml --batch-size 500
+"""
+import argparse
+from collections import Counter
+import os
+import sys
+import time
+
+import msgpack
+from persistent_queue import PersistentQueue
+from tabulate import tabulate
+import yaml
+
+from utils.brokers import acknowledged, brokers_from_config
+from utils.dead_letter import PERMANENT, TRANSIENT, classify, get
+from utils.queue_reader import QueueReader
+
+
+class PublishFailed(Exception):
+    pass
+
+
+def topic_for(entry, kind, base_topic):
+    """Blocks go to their own topic; samples are republished as JSON."""
+    if kind == 'block':
+        return base_topic + '/block'
+
+    topic = get(entry, 'topic') or base_topic
+    if topic.endswith('/compact'):
+        topic = topic[:-len('/compact')]
+    return topic
+
+
+def connect(mqtt_cfg, batch_size, timeout=30):
+    """Returns the first broker, by priority, that connects within timeout."""
+    mqtt_cfg = dict(mqtt_cfg, uname=os.environ['MQTT_USERNAME'],
+                    password=os.environ['MQTT_PASSWORD'])
+
+    brokers = sorted(brokers_from_config(mqtt_cfg), key=lambda broker: broker.priority)
+    for broker in brokers:
+        # Let a whole batch be in flight at once
+        broker.client.max_inflight_messages_set(batch_size)
+        broker.start()
+        if broker.connected.wait(timeout):
+            return broker
+
+        print("Unable to connect to {}".format(broker.name), file=sys.stderr)
+        broker.stop()
+
+    raise PublishFailed("Unable to connect to any broker")
+
+
+def summarize(reasons, out):
+    rows = [[status, reason, count]
+            for (status, reason), count in reasons.most_common()]
+    out.write(tabulate(rows, headers=['status', 'reason', 'count']) + '\n')
+
+
+def dry_run(filename, loads, out):
+    reasons = Counter()
+    for _, data in QueueReader(filename, loads=loads).records():
+        status, _, _, reason = classify(loads(data), loads)
+        reasons[status, reason] += 1
+    summarize(reasons, out)
+    return reasons
+
+
+def redrive(bad_queue, permanent_queue, client, base_topic, batch_size, out,
+            limit=None, timeout=60):
+    """
+    Returns a Counter of (status, reason) for the dead letters handled.
+    Raises PublishFailed if a batch isn't acknowledged within timeout seconds.
+    """
+    reasons = Counter()
+    handled = 0
+    published = 0
+    start = time.monotonic()
+
+    while len(bad_queue) and (limit is None or handled < limit):
+        count = min(len(bad_queue), batch_size)
+        if limit is not None:
+            count = min(count, limit - handled)
+
+        batch = bad_queue.peek(count)
+        if count == 1:
+            batch = [batch]
+
+        # (entry, status, reason, publish info or None) in queue order
+        results = []
+        for entry in batch:
+            status, kind, payload, reason = classify(entry, bad_queue.loads)
+            info = None
+            if status == TRANSIENT:
+                try:
+                    info = client.publish(topic_for(entry, kind, base_topic),
+                                          payload, qos=1)
+                except (RuntimeError, ValueError) as e:
+                    info = e
+            results.append((entry, status, reason, info))
+
+        # Only the start of the batch up to the first entry that wasn't
+        # acknowledged is removed; the rest is sent again next time
+        deadline = time.monotonic() + timeout
+        done = 0
+        for entry, status, reason, info in results:
+            if status == TRANSIENT and (isinstance(info, Exception) or not acknowledged(
+                    info, max(deadline - time.monotonic(), 0))):
+                break
+            done += 1
+
+        sent = 0
+        for entry, status, reason, info in results[:done]:
+            reasons[status, reason] += 1
+            if status == TRANSIENT:
+                sent += 1
+            else:
+                permanent_queue.push(entry)
+        if done:
+            bad_queue.delete(done)
+            bad_queue.flush()
+
+        handled += done
+        published += sent
+        if done < count:
+            raise PublishFailed("Stopped after {} dead letters: the broker didn't "
+                                "acknowledge within {} s".format(handled, timeout))
+        elapsed = time.monotonic() - start
+        out.write("{} handled, {} republished, {} permanent, {:.0f}/s\n".format(
+            handled, published, reasons_total(reasons, PERMANENT),
+            handled / elapsed if elapsed else 0))
+        out.flush()
+
+    return reasons
+
+
+def reasons_total(reasons, status):
+    return sum(count for (s, _), count in reasons.items() if s == status)
+
+
+def main(args):
+    loads = msgpack.unpackb
+    if args.dry_run:
+        dry_run(args.queue, loads, sys.stdout)
+        return
+
+    with open(args.config) as f:
+        cfg = yaml.safe_load(f)
+    mqtt_cfg = cfg.get('mqtt') or {}
+
+    try:
+        broker = connect(mqtt_cfg, args.batch_size)
+    except PublishFailed as e:
+        sys.exit(str(e))
+
+    bad_queue = PersistentQueue(args.queue, dumps=msgpack.packb, loads=loads)
+    permanent_queue = PersistentQueue(args.permanent, dumps=msgpack.packb, loads=loads)
+    base_topic = "epifi/v1/{}".format(os.environ['MQTT_USERNAME'])
+
+    try:
+        reasons = redrive(bad_queue, permanent_queue, broker.client, base_topic,
+                          args.batch_size, sys.stdout, args.limit, args.timeout)
+    except PublishFailed as e:
+        sys.exit(str(e))
+    finally:
+        broker.stop()
+
+    summarize(reasons, sys.stdout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Republish dead letters')
+    parser.add_argument('config', help='Configuration file with the mqtt section')
+    parser.add_argument('--queue', default='sensor.bad_queue',
+                        help='Queue with the dead letters')
+    parser.add_argument('--permanent', default='sensor.dead_queue',
+                        help='Queue permanent failures are moved to')
+    parser.add_argument('-b', '--batch-size', type=int, default=500,
+                        help='Messages in flight at once')
+    parser.add_argument('-n', '--limit', type=int,
+                        help='Stop after this many dead letters')
+    parser.add_argument('-t', '--timeout', type=float, default=60,
+                        help='Seconds to wait for a batch to be acknowledged')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only report what would be republished')
+    main(parser.parse_args())
@@ -0,0 +1,330 @@
+"""
+Local history of samples that outlives the queue.
+
+Samples are deleted from the queue once the broker has them, so if the broker
+later loses data it is gone. This keeps its own copy in tiers under a history
+directory: the full resolution samples for a few days, and rollups (mean, min,
+max and count of each numeric field) over longer intervals for much longer.
+
+Each tier is stored as one file per UTC day of msgpack records, so expiring old
+data is just deleting files. Rollups are updated incrementally as samples are
+added and written when their interval is over; after a restart the interval in
+progress is rebuilt from the newest full resolution file. If the history grows
+past its disk budget, the oldest files of the finest tier are removed first.
+
+Samples taken before the clock was synchronized can't be filed by their
+sample_time, so they are kept in a separate unsynced tier that only the disk
+budget removes files from. Once the clock is synchronized, the ones from the
+current boot are corrected and moved to the full resolution files; the ones
+from earlier boots stay where they are, with the metadata needed to place
+them. Corrected samples are left out of the rollups, which have moved on by
+then. Files expire by the synchronized clock, and not at all before it is.
+"""
+from datetime import datetime, timedelta, timezone
+import logging
+import os
+
+import msgpack
+
+from utils.queue_reader import decode
+
+LOGGER = logging.getLogger(__name__)
+
+RAW = 'raw'
+UNSYNCED = 'unsynced'
+DAY = 86400
+SUFFIX = '.mpk'
+DEFAULT_ROLLUPS = {'15m': {'interval': 900, 'days': 90},
+                   '1h': {'interval': 3600, 'days': 730}}
+# Numeric fields that are counters rather than measurements
+SKIP_FIELDS = {'sequence', 'queue_length'}
+
+
+def day_of(sample_time):
+    """Name of the day file for a sample_time in microseconds."""
+    moment = datetime.fromtimestamp(sample_time / 1e6, timezone.utc)
+    return moment.strftime('%Y%m%d')
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class Rollup:
+    """Running statistics for one interval of one tier."""
+    def __init__(self, start):
+        self.start = start
+        self.fields = {}  # name -> [total, minimum, maximum, count]
+
+    def add(self, data):
+        for name, value in data.items():
+            if name in SKIP_FIELDS or not is_number(value):
+                continue
+
+            stats = self.fields.get(name)
+            if stats is None:
+                self.fields[name] = [value, value, value, 1]
+            else:
+                stats[0] += value
+                stats[1] = min(stats[1], value)
+                stats[2] = max(stats[2], value)
+                stats[3] += 1
+
+    def record(self, interval):
+        return {"sample_time": self.start,
+                "interval": interval,
+                "data": {name: {"mean": total / count, "min": minimum,
+                                "max": maximum, "count": count}
+                         for name, (total, minimum, maximum, count)
+                         in self.fields.items()}}
+
+
+class Tier:
+    def __init__(self, path, name, days, interval=None):
+        if interval is not None and DAY % interval != 0:
+            raise ValueError("Rollup interval must divide a day: {}".format(interval))
+
+        self.name = name
+        self.path = os.path.join(path, name)
+        self.days = days
+        self.interval = interval
+        self.rollup = None
+
+        self.file = None
+        self.day = None
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def bucket(self, sample_time):
+        step = self.interval * 1000000
+        return sample_time - sample_time % step
+
+    def files(self):
+        """Day file names of this tier, oldest first."""
+        return sorted(name[:-len(SUFFIX)] for name in os.listdir(self.path)
+                      if name.endswith(SUFFIX))
+
+    def filename(self, day):
+        return os.path.join(self.path, day + SUFFIX)
+
+    def write(self, record):
+        """Appends a record and returns how many bytes were written."""
+        day = day_of(record['sample_time'])
+        if day != self.day:
+            self.close()
+            self.file = open(self.filename(day), 'ab')
+            self.day = day
+
+        data = msgpack.packb(record)
+        self.file.write(data)
+        self.file.flush()
+        return len(data)
+
+    def read(self, day):
+        try:
+            with open(self.filename(day), 'rb') as f:
+                # A record cut short by a power failure ends the file
+                unpacker = msgpack.Unpacker(f)
+                while True:
+                    try:
+                        yield decode(next(unpacker))
+                    except StopIteration:
+                        break
+                    except (ValueError, msgpack.exceptions.UnpackException):
+                        LOGGER.warning("Truncated history file %s", self.filename(day))
+                        break
+        except FileNotFoundError:
+            return
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.day = None
+
+
+class Retention:
+    def __init__(self, path='history', raw_days=7, rollups=None,
+                 max_bytes=64 * 1024 * 1024, clock=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.clock = clock
+
+        self.raw = Tier(path, RAW, raw_days)
+        # Never expires, sample_time doesn't say how old they are
+        self.unsynced = Tier(path, UNSYNCED, None)
+        self.rollups = [Tier(path, name, cfg.get('days', 365), cfg['interval'])
+                        for name, cfg in (rollups or DEFAULT_ROLLUPS).items()]
+        self.rollups.sort(key=lambda tier: tier.interval)
+        self.tiers = [self.raw, self.unsynced] + self.rollups
+
+        # Sizes of every file, so the budget can be checked on each write
+        self.sizes = {}
+        for tier in self.tiers:
+            for day in tier.files():
+                self.sizes[(tier, day)] = os.path.getsize(tier.filename(day))
+
+        # Whether the unsynced tier may have samples that can be corrected
+        self.uncorrected = bool(self.unsynced.files())
+
+        self._recover()
+        self.expire()
+
+    def _recover(self):
+        """Rebuilds the rollups in progress from the newest raw samples."""
+        days = self.raw.files()
+        if not days:
+            return
+
+        samples = [sample for sample in self.raw.read(days[-1])
+                   if self._synced(sample)]
+        if not samples:
+            return
+
+        latest = samples[-1]['sample_time']
+        for tier in self.rollups:
+            start = tier.bucket(latest)
+            tier.rollup = Rollup(start)
+            for sample in samples:
+                if tier.bucket(sample['sample_time']) == start:
+                    tier.rollup.add(sample.get('data', {}))
+
+    @staticmethod
+    def _synced(sample):
+        return sample.get('metadata', {}).get('clock_synced', True)
+
+    def add(self, sample):
+        """Stores a sample and updates the rollups."""
+        sample = decode(sample)
+        if self.clock is not None:
+            self.clock.correct(sample)
+
+        if not self._synced(sample):
+            self._write(self.unsynced, sample)
+            self.uncorrected = True
+            return
+
+        if self.uncorrected and self._clock_synced():
+            self._correct_unsynced()
+
+        self._write(self.raw, sample)
+
+        for tier in self.rollups:
+            start = tier.bucket(sample['sample_time'])
+            if tier.rollup is not None and tier.rollup.start != start:
+                self._write(tier, tier.rollup.record(tier.interval))
+                tier.rollup = None
+
+            if tier.rollup is None:
+                tier.rollup = Rollup(start)
+            tier.rollup.add(sample.get('data', {}))
+
+    def _write(self, tier, record):
+        new_day = day_of(record['sample_time']) != tier.day
+
+        size = tier.write(record)
+        key = (tier, tier.day)
+        self.sizes[key] = self.sizes.get(key, 0) + size
+
+        if new_day:
+            self.expire()
+        elif self.used() > self.max_bytes:
+            self._enforce_budget()
+
+    def _clock_synced(self):
+        return self.clock is not None and self.clock.synced.is_set()
+
+    def _correct_unsynced(self):
+        """Moves the unsynced samples that can be corrected now to the raw tier."""
+        kept = []
+        moved = 0
+        for day in self.unsynced.files():
+            for sample in self.unsynced.read(day):
+                self.clock.correct(sample)
+                if self._synced(sample):
+                    self._write(self.raw, sample)
+                    moved += 1
+                else:
+                    kept.append(sample)
+            self._remove(self.unsynced, day)
+
+        # From earlier boots: they can't ever be corrected
+        for sample in kept:
+            self._write(self.unsynced, sample)
+        self.unsynced.close()
+        self.uncorrected = False
+
+        if moved:
+            LOGGER.info("Corrected %d samples taken before the clock was synchronized",
+                        moved)
+
+    def used(self):
+        return sum(self.sizes.values())
+
+    def expire(self, now=None):
+        """Drops day files that are older than their tier keeps data for."""
+        if now is None and self._clock_synced():
+            now = datetime.fromtimestamp(self.clock.now(), timezone.utc)
+
+        for tier in self.tiers:
+            if now is None or tier.days is None:
+                continue
+            oldest = (now - timedelta(days=tier.days)).strftime('%Y%m%d')
+            for day in tier.files():
+                if day >= oldest:
+                    break
+                if day != tier.day:
+                    self._remove(tier, day)
+
+        self._enforce_budget()
+
+    def _enforce_budget(self):
+        for tier in self.tiers:
+            days = tier.files()
+            # The file being written is never removed
+            while self.used() > self.max_bytes and len(days) > 1:
+                self._remove(tier, days.pop(0))
+
+        if self.used() > self.max_bytes:
+            LOGGER.warning("History uses %d bytes, more than its budget of %d",
+                           self.used(), self.max_bytes)
+
+    def _remove(self, tier, day):
+        LOGGER.info("Removing %s history for %s", tier.name, day)
+        if tier.day == day:
+            tier.close()
+        try:
+            os.remove(tier.filename(day))
+        except FileNotFoundError:
+            pass
+        self.sizes.pop((tier, day), None)
+
+    def read(self, tier_name=RAW, since=None, until=None):
+        """
+        Yields the records of a tier with since <= sample_time < until (in
+        microseconds), oldest first.
+        """
+        tier = next(tier for tier in self.tiers if tier.name == tier_name)
+        first = None if since is None else day_of(since)
+        last = None if until is None else day_of(until)
+
+        for day in tier.files():
+            if (first is not None and day < first) or \
+               (last is not None and day > last):
+                continue
+
+            for record in tier.read(day):
+                sample_time = record['sample_time']
+                if since is not None and sample_time < since:
+                    continue
+                if until is not None and sample_time >= until:
+                    continue
+                yield record
+
+    def close(self):
+        """
+        Closes the files. Rollups in progress are rebuilt from the raw
+        samples on the next start.
+        """
+        for tier in self.tiers:
+            tier.close()
@@ -0,0 +1,290 @@
+"""
+Compact positional encoding for samples.
+
+Every sample has the same ~25 fields, so spelling out their names in every
+message is mostly overhead. The registry gives each field a numeric ID, in the
+order the sensors produce them: the fields every sample has first, then each
+sensor's fields (sorted) the first time it returns them. IDs are only ever
+appended, never reused or reordered, and every change bumps the schema
+version, so the latest schema can decode a record written with any earlier
+version. The schema is kept in schema.json so IDs survive restarts, and is
+published once (retained) for the ingestion side.
+
+A record is the schema version, a bitmap of which fields are present, and a
+tagged value for each present field:
+
+    varint version | bitmap | (tag value)*
+
+Records are built straight from the dict read out of the queue (keys may be
+str or, with older msgpack, bytes) so nothing has to be decoded or turned into
+JSON first.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+
+import msgpack
+
+from utils.block_codec import CodecError, read_varint, write_varint
+from utils.queue_reader import decode
+
+LOGGER = logging.getLogger(__name__)
+
+# Fields every sample has, before any sensor's fields
+BASE_FIELDS = [('sample_time',),
+               ('data', 'sequence'),
+               ('data', 'queue_length'),
+               ('metadata', 'firmware'),
+               ('metadata', 'clock_synced'),
+               ('metadata', 'clock_corrected'),
+               ('metadata', 'monotonic_time'),
+               ('metadata', 'boot_id')]
+
+NONE = 0
+FALSE = 1
+TRUE = 2
+INT = 3
+FLOAT = 4
+STRING = 5
+PACKED = 6  # Anything else, as msgpack
+
+DOUBLE = struct.Struct('<d')
+MISSING = object()
+
+
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def encode_value(out, value):
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int) and -(1 << 63) <= value < 1 << 63:
+        out.append(INT)
+        write_varint(out, zigzag(value))
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += DOUBLE.pack(value)
+    elif isinstance(value, (str, bytes)):
+        if isinstance(value, str):
+            value = value.encode()
+        out.append(STRING)
+        write_varint(out, len(value))
+        out += value
+    else:
+        data = msgpack.packb(value, use_bin_type=True)
+        out.append(PACKED)
+        write_varint(out, len(data))
+        out += data
+
+
+def decode_value(data, offset):
+    tag = data[offset]
+    offset += 1
+
+    if tag == NONE:
+        return None, offset
+    elif tag == FALSE:
+        return False, offset
+    elif tag == TRUE:
+        return True, offset
+    elif tag == INT:
+        value, offset = read_varint(data, offset)
+        return unzigzag(value), offset
+    elif tag == FLOAT:
+        return DOUBLE.unpack_from(data, offset)[0], offset + DOUBLE.size
+    elif tag in (STRING, PACKED):
+        size, offset = read_varint(data, offset)
+        value = bytes(data[offset:offset + size])
+        if len(value) < size:
+            raise CodecError("Truncated value")
+        if tag == STRING:
+            return value.decode(), offset + size
+        return decode(msgpack.unpackb(value)), offset + size
+
+    raise CodecError("Unknown value tag: {}".format(tag))
+
+
+class Schema:
+    """One version of the field layout. Schemas are never modified."""
+    def __init__(self, version, fields):
+        self.version = version
+        self.fields = fields  # [{'id', 'path', 'sensor', 'since'}]
+        self.paths = {tuple(field['path']): field['id'] for field in fields}
+
+        # Every field can be looked up with str or bytes keys
+        self.lookups = []
+        for field in fields:
+            self.lookups.append([(key, key.encode()) for key in field['path']])
+
+        self.bitmap_size = (len(fields) + 7) // 8
+
+    def fields_at(self, version):
+        """Number of fields a record of an older version has."""
+        return sum(1 for field in self.fields if field['since'] <= version)
+
+    def values(self, sample):
+        """Field values in ID order (MISSING for absent fields)."""
+        values = []
+        for lookup in self.lookups:
+            value = sample
+            for key, raw_key in lookup:
+                if not isinstance(value, dict):
+                    value = MISSING
+                elif key in value:
+                    value = value[key]
+                elif raw_key in value:
+                    value = value[raw_key]
+                else:
+                    value = MISSING
+
+                if value is MISSING:
+                    break
+            values.append(value)
+        return values
+
+    def covers(self, sample, values):
+        """Whether every field of the sample has an ID in this schema."""
+        present = sum(1 for value in values if value is not MISSING)
+        total = 0
+        for key, value in sample.items():
+            if isinstance(value, dict) and value:
+                total += len(value)
+            else:
+                total += 1
+        return present >= total
+
+    def pack(self, values):
+        out = bytearray()
+        write_varint(out, self.version)
+
+        bitmap = bytearray(self.bitmap_size)
+        body = bytearray()
+        for i, value in enumerate(values):
+            if value is MISSING:
+                continue
+            bitmap[i // 8] |= 0x80 >> (i % 8)
+            encode_value(body, value)
+
+        return bytes(out + bitmap + body)
+
+    def encode(self, sample):
+        return self.pack(self.values(sample))
+
+    def decode(self, record):
+        """Decodes a record written with this or any earlier version."""
+        version, offset = read_varint(record, 0)
+        if version > self.version:
+            raise CodecError("Record version {} is newer than schema version {}".format(
+                version, self.version))
+
+        count = self.fields_at(version)
+        bitmap = record[offset:offset + (count + 7) // 8]
+        offset += (count + 7) // 8
+
+        sample = {}
+        for field in self.fields[:count]:
+            i = field['id']
+            if not bitmap[i // 8] & (0x80 >> (i % 8)):
+                continue
+
+            value, offset = decode_value(record, offset)
+            target = sample
+            for key in field['path'][:-1]:
+                target = target.setdefault(key, {})
+            target[field['path'][-1]] = value
+
+        return sample
+
+    def as_dict(self):
+        return {'version': self.version, 'fields': self.fields}
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value['version'], value['fields'])
+
+
+class SchemaRegistry:
+    def __init__(self, filename='schema.json'):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+        try:
+            with open(filename) as f:
+                self.schema = Schema.from_dict(json.load(f))
+        except FileNotFoundError:
+            self.schema = Schema(1, [{'id': i, 'path': list(path),
+                                      'sensor': None, 'since': 1}
+                                     for i, path in enumerate(BASE_FIELDS)])
+            self.save()
+        except (ValueError, KeyError):
+            LOGGER.exception("Unable to load %s", filename)
+            raise
+
+    def save(self):
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(self.schema.as_dict(), f, indent=2)
+        os.replace(temp_filename, self.filename)
+
+    def _extend(self, paths, sensor=None):
+        """Adds fields that don't have an ID yet. Returns the current schema."""
+        with self.lock:
+            schema = self.schema
+            new = [path for path in paths if path not in schema.paths]
+            if not new:
+                return schema
+
+            version = schema.version + 1
+            fields = list(schema.fields)
+            for path in new:
+                fields.append({'id': len(fields), 'path': list(path),
+                               'sensor': sensor, 'since': version})
+
+            LOGGER.info("Schema version %d adds %s", version,
+                        ', '.join('.'.join(path) for path in new))
+            self.schema = Schema(version, fields)
+            self.save()
+            return self.schema
+
+    def observe(self, sensor, data):
+        """Registers the fields a sensor's read() returned."""
+        if all(('data', key) in self.schema.paths for key in data):
+            return
+        self._extend([('data', key) for key in sorted(data)], sensor)
+
+    def encode(self, sample, prepare=None):
+        """
+        Encodes a sample from the queue, adding any fields the schema doesn't
+        have yet. prepare can adjust the values (in ID order) first.
+        """
+        schema = self.schema
+        values = schema.values(sample)
+
+        if not schema.covers(sample, values):
+            schema = self._extend(sorted(self._paths(sample)))
+            values = schema.values(sample)
+
+        if prepare is not None:
+            prepare(schema, values)
+        return schema.pack(values)
+
+    @staticmethod
+    def _paths(sample):
+        for key, value in sample.items():
+            key = key.decode() if isinstance(key, bytes) else key
+            if isinstance(value, dict) and value:
+                for name in value:
+                    yield key, name.decode() if isinstance(name, bytes) else name
+            else:
+                yield (key,)
@@ -0,0 +1,323 @@
+"""
+Runs an output sensor in its own supervised process.
+
+A sensor that hangs in a C extension (Adafruit_DHT, GPIO, serial) or holds the
+GIL would otherwise stall sampling and publishing together. SensorWorker is a
+drop-in replacement for the sensor object in the main process: read() asks the
+child for a reading, which comes back through a preallocated shared memory
+ring buffer of fixed-layout records instead of a pickled dict. A child that
+stops heartbeating or doesn't answer within the watchdog timeout is killed
+and restarted. Restarting takes a while (the child has to be stopped and the
+new one has to set up the sensor), so it happens in the background and the
+sensor's fields read as None until the new child is up.
+"""
+import importlib
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import struct
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+CAPACITY = 16
+MAX_FIELDS = 32
+HANDSHAKE_TIMEOUT = 60
+
+# write_index, heartbeat (monotonic seconds)
+RING_HEADER = struct.Struct('<Qd')
+# sequence, sample time (monotonic seconds), number of fields
+RECORD_HEADER = struct.Struct('<QdH')
+# name, kind, value
+FIELD = struct.Struct('<32sB16s')
+RECORD_TRAILER = struct.Struct('<Q')
+RECORD_SIZE = RECORD_HEADER.size + MAX_FIELDS * FIELD.size + RECORD_TRAILER.size
+
+KIND_NONE = 0
+KIND_INT = 1
+KIND_FLOAT = 2
+KIND_STR = 3
+INT_VALUE = struct.Struct('<q')
+FLOAT_VALUE = struct.Struct('<d')
+
+
+class RingBuffer:
+    """
+    Single producer, single consumer ring of fixed size records. Every record
+    starts and ends with its sequence number so a reader can detect a record
+    that was overwritten while it was being read.
+    """
+    def __init__(self, shm, capacity=CAPACITY):
+        self.shm = shm
+        self.buf = shm.buf
+        self.capacity = capacity
+
+    @staticmethod
+    def size(capacity=CAPACITY):
+        return RING_HEADER.size + capacity * RECORD_SIZE
+
+    def _offset(self, index):
+        return RING_HEADER.size + (index % self.capacity) * RECORD_SIZE
+
+    @property
+    def write_index(self):
+        return RING_HEADER.unpack_from(self.buf, 0)[0]
+
+    @property
+    def heartbeat(self):
+        return RING_HEADER.unpack_from(self.buf, 0)[1]
+
+    def beat(self):
+        struct.pack_into('<d', self.buf, 8, time.monotonic())
+
+    def write(self, data):
+        index = self.write_index
+        offset = self._offset(index)
+
+        fields = list(data.items())
+        if len(fields) > MAX_FIELDS:
+            LOGGER.warning("Dropping %s fields that don't fit in a record",
+                           len(fields) - MAX_FIELDS)
+            fields = fields[:MAX_FIELDS]
+
+        RECORD_HEADER.pack_into(self.buf, offset, index, time.monotonic(),
+                                len(fields))
+        field_offset = offset + RECORD_HEADER.size
+        for name, value in fields:
+            kind, value = _encode_value(value)
+            FIELD.pack_into(self.buf, field_offset, name.encode(), kind, value)
+            field_offset += FIELD.size
+        RECORD_TRAILER.pack_into(self.buf, offset + RECORD_SIZE - RECORD_TRAILER.size,
+                                 index)
+
+        # Publish the record only after it has been completely written
+        struct.pack_into('<Q', self.buf, 0, index + 1)
+
+    def read(self, index):
+        """Returns the record at index or None if it has been overwritten."""
+        offset = self._offset(index)
+
+        sequence, sample_time, count = RECORD_HEADER.unpack_from(self.buf, offset)
+        data = {}
+        field_offset = offset + RECORD_HEADER.size
+        for _ in range(min(count, MAX_FIELDS)):
+            name, kind, value = FIELD.unpack_from(self.buf, field_offset)
+            data[name.rstrip(b'\0').decode()] = _decode_value(kind, value)
+            field_offset += FIELD.size
+        trailer, = RECORD_TRAILER.unpack_from(
+            self.buf, offset + RECORD_SIZE - RECORD_TRAILER.size)
+
+        if sequence != index or trailer != index:
+            return None
+        return data
+
+
+def _encode_value(value):
+    if value is None:
+        return KIND_NONE, b''
+    elif isinstance(value, (bool, int)):
+        return KIND_INT, INT_VALUE.pack(value)
+    elif isinstance(value, float):
+        return KIND_FLOAT, FLOAT_VALUE.pack(value)
+    else:
+        value = str(value).encode()
+        if len(value) > 16:
+            LOGGER.warning("Truncating %s to 16 bytes", value)
+        return KIND_STR, value[:16]
+
+
+def _decode_value(kind, value):
+    if kind == KIND_INT:
+        return INT_VALUE.unpack_from(value)[0]
+    elif kind == KIND_FLOAT:
+        return FLOAT_VALUE.unpack_from(value)[0]
+    elif kind == KIND_STR:
+        return value.rstrip(b'\0').decode()
+    return None
+
+
+def _run_worker(module_name, config, shm_name, conn, request, ready,
+                start_event, stop_event):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ring = RingBuffer(shm)
+    ring.beat()
+
+    module = importlib.import_module(module_name)
+    sensor = module.setup_sensor(config)
+    if sensor is None:
+        conn.send(None)
+        return
+
+    conn.send((sensor.name, sensor.type, getattr(sensor, 'min_interval', 0),
+               list(getattr(sensor, 'fields', None) or [])))
+    if sensor.type != 'output':
+        return
+
+    while not start_event.wait(timeout=1):
+        ring.beat()
+        if stop_event.is_set():
+            return
+
+    sensor.start()
+
+    try:
+        while not stop_event.is_set():
+            ring.beat()
+            if not request.wait(timeout=1):
+                continue
+            request.clear()
+
+            data = sensor.read()
+            ring.write(data)
+            ring.beat()
+            ready.set()
+    finally:
+        sensor.stop()
+        del ring
+        shm.close()
+
+
+class SensorWorker:
+    def __init__(self, module_name, config, timeout=30):
+        self.module_name = module_name
+        self.config = config
+        self.timeout = timeout
+
+        self.context = multiprocessing.get_context('spawn')
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=RingBuffer.size())
+        self.shm.buf[:RING_HEADER.size] = bytes(RING_HEADER.size)
+        self.ring = RingBuffer(self.shm)
+        self.read_index = 0
+
+        self.request = self.context.Event()
+        self.ready = self.context.Event()
+        self.start_event = self.context.Event()
+        self.stop_event = self.context.Event()
+
+        self.name = module_name
+        self.type = None
+        self.min_interval = 0
+        self.fields = []
+        self.restarts = 0
+        self.process = None
+        self.restarting = None  # Thread restarting the child
+
+        self._spawn()
+
+    def _spawn(self):
+        parent_conn, child_conn = self.context.Pipe(duplex=False)
+        self.request.clear()
+        self.ready.clear()
+
+        self.process = self.context.Process(
+            target=_run_worker,
+            args=(self.module_name, self.config, self.shm.name, child_conn,
+                  self.request, self.ready, self.start_event, self.stop_event),
+            name="{}Worker".format(self.module_name),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        if not parent_conn.poll(HANDSHAKE_TIMEOUT):
+            LOGGER.error("%s worker did not start in time", self.module_name)
+            self._kill()
+            return
+
+        try:
+            handshake = parent_conn.recv()
+        except EOFError:
+            handshake = None
+
+        if handshake is None:
+            LOGGER.error("%s worker failed to set up the sensor", self.module_name)
+            return
+
+        self.name, self.type, self.min_interval, fields = handshake
+        # What the sensor declares until it has been read
+        self.fields = self.fields or fields
+
+    def _kill(self):
+        if self.process is None:
+            return
+
+        self.process.terminate()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def restart(self):
+        """Replaces the child in the background, unless that is already happening."""
+        if self._restarting():
+            return
+
+        LOGGER.warning("Restarting %s worker", self.name)
+        self.restarts += 1
+        self.restarting = threading.Thread(target=self._restart,
+                                           name="{}Restart".format(self.module_name),
+                                           daemon=True)
+        self.restarting.start()
+
+    def _restart(self):
+        self._kill()
+        self._spawn()
+
+    def _restarting(self):
+        return self.restarting is not None and self.restarting.is_alive()
+
+    def alive(self):
+        """True if the child is running and has heartbeated recently."""
+        return self.process is not None and self.process.is_alive() and \
+            time.monotonic() - self.ring.heartbeat < self.timeout
+
+    def start(self):
+        self.start_event.set()
+
+    def read(self):
+        if self._restarting():
+            return self._missing()
+
+        if not self.alive():
+            self.restart()
+            return self._missing()
+
+        self.ready.clear()
+        self.request.set()
+
+        if not self.ready.wait(timeout=self.timeout):
+            LOGGER.error("%s worker didn't respond in %s seconds",
+                         self.name, self.timeout)
+            self.restart()
+            return self._missing()
+
+        write_index = self.ring.write_index
+        if write_index - self.read_index > self.ring.capacity:
+            self.read_index = write_index - self.ring.capacity
+
+        data = None
+        while self.read_index < write_index:
+            data = self.ring.read(self.read_index) or data
+            self.read_index += 1
+
+        if data is None:
+            return self._missing()
+
+        self.fields = list(data)
+        return data
+
+    def _missing(self):
+        return {field: None for field in self.fields}
+
+    def stop(self):
+        self.stop_event.set()
+        if self._restarting():
+            self.restarting.join()
+        if self.process is not None:
+            self.process.join(self.timeout)
+        self._kill()
+
+        self.ring = None
+        self.shm.close()
+        self.shm.unlink()
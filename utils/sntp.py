@@ -0,0 +1,192 @@
+"""
+A small SNTP (RFC 4330) client used to discipline the sample clock.
+
+Instead of stepping the system clock with ntpdate, the offset between the
+monotonic clock and true time is measured over UDP and handed to a
+SampleClock. Repeated measurements are used to estimate the drift of the local
+oscillator so sample times stay accurate between polls.
+"""
+from collections import deque
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+NTP_PORT = 123
+NTP_PACKET = struct.Struct('!BBBb11I')
+NTP_TIMESTAMP = struct.Struct('!II')
+NTP_EPOCH_OFFSET = 2208988800  # Seconds between 1900-01-01 and 1970-01-01
+CLIENT_MODE = 3
+SERVER_MODES = (4, 5)  # Server or broadcast
+VERSION = 4
+
+
+class SntpError(Exception):
+    pass
+
+
+def parse_server(server):
+    """Accepts "host", "host:port" or a (host, port) pair."""
+    if isinstance(server, (tuple, list)):
+        return server[0], int(server[1])
+
+    host, _, port = server.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return server, NTP_PORT
+
+
+def to_ntp(timestamp):
+    seconds = timestamp + NTP_EPOCH_OFFSET
+    return int(seconds), int((seconds % 1) * 2**32)
+
+
+def from_ntp(seconds, fraction):
+    return seconds - NTP_EPOCH_OFFSET + fraction / 2**32
+
+
+class SntpClient:
+    def __init__(self, servers, timeout=5):
+        self.servers = [parse_server(server) for server in servers]
+        self.timeout = timeout
+
+    def query(self, server):
+        """
+        Performs one exchange with a server. Returns (offset, delay,
+        monotonic) where offset is true time minus the monotonic clock and
+        monotonic is when the response arrived, all in seconds.
+        """
+        # The transmit timestamp is only echoed back, so a random nonce is
+        # used instead of leaking our (possibly wrong) time
+        nonce = os.urandom(8)
+
+        request = bytearray(NTP_PACKET.size)
+        request[0] = (VERSION << 3) | CLIENT_MODE
+        request[40:48] = nonce
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(server)
+
+            t1 = time.monotonic()
+            sock.send(request)
+
+            while True:
+                try:
+                    response = sock.recv(1024)
+                except socket.timeout:
+                    raise SntpError("No response from {}:{}".format(*server))
+                t4 = time.monotonic()
+
+                if len(response) >= NTP_PACKET.size and response[24:32] == nonce:
+                    break
+                LOGGER.debug("Ignoring unexpected packet from %s", server)
+
+        fields = NTP_PACKET.unpack(response[:NTP_PACKET.size])
+        mode = fields[0] & 0x7
+        leap = fields[0] >> 6
+        stratum = fields[1]
+
+        if mode not in SERVER_MODES:
+            raise SntpError("Unexpected mode {} from {}".format(mode, server))
+        if stratum == 0 or leap == 3:
+            raise SntpError("Server {} is not synchronized".format(server))
+
+        t2 = from_ntp(*NTP_TIMESTAMP.unpack(response[32:40]))
+        t3 = from_ntp(*NTP_TIMESTAMP.unpack(response[40:48]))
+
+        offset = ((t2 - t1) + (t3 - t4)) / 2
+        delay = (t4 - t1) - (t3 - t2)
+        return offset, delay, t4
+
+    def measure(self):
+        """
+        Queries every server and returns (offset, delay, monotonic) from the
+        one with the lowest round trip delay.
+        """
+        results = []
+        for server in self.servers:
+            try:
+                results.append(self.query(server))
+            except (OSError, SntpError) as e:
+                LOGGER.warning("SNTP query to %s failed: %s", server, e)
+
+        if len(results) == 0:
+            raise SntpError("No SNTP server responded")
+
+        return min(results, key=lambda result: result[1])
+
+
+class ClockSync:
+    def __init__(self, clock, client, interval=600, retry_interval=30,
+                 history=8, min_drift_span=300):
+        self.clock = clock
+        self.client = client
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.min_drift_span = min_drift_span
+
+        # (monotonic, offset) pairs used to estimate the drift
+        self.history = deque(maxlen=history)
+        self.running = True
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="ClockSyncThread", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _sleep(self, amount):
+        while amount > 0:
+            if not self.running:
+                break
+
+            if amount > 1:
+                time.sleep(1)
+                amount -= 1
+            else:
+                time.sleep(amount)
+                amount = 0
+
+    def _run(self):
+        while self.running:
+            try:
+                self.sync()
+                self._sleep(self.interval)
+            except SntpError as e:
+                LOGGER.warning("Unable to update time: %s", e)
+                self._sleep(self.retry_interval)
+            except Exception:
+                LOGGER.exception("Exception occurred while updating time")
+                self._sleep(self.retry_interval)
+
+    def sync(self):
+        offset, delay, monotonic = self.client.measure()
+        LOGGER.debug("SNTP offset %.6f s, delay %.6f s", offset, delay)
+
+        self.history.append((monotonic, offset))
+        drift = self.estimate_drift()
+
+        self.clock.discipline(monotonic, offset, drift)
+        LOGGER.info("Disciplined clock (drift %.2f ppm)", drift * 1e6)
+
+    def estimate_drift(self):
+        """Least squares slope of offset over monotonic time."""
+        if len(self.history) < 2:
+            return self.clock.drift
+
+        xs, ys = zip(*self.history)
+        if xs[-1] - xs[0] < self.min_drift_span:
+            return self.clock.drift
+
+        mean_x = sum(xs) / len(xs)
+        mean_y = sum(ys) / len(ys)
+        numerator = sum((x - mean_x) * (y - mean_y) for x, y in self.history)
+        denominator = sum((x - mean_x) ** 2 for x in xs)
+
+        return numerator / denominator
@@ -0,0 +1,398 @@
+"""
+Sparse time index over a persistent queue of samples.
+
+Every interval-th item pushed onto the queue gets an index entry with its
+sample_time, its offset in the queue file and the number of samples pushed
+before it. While sample_time only moves forward, a binary search over the
+entries finds where a time range starts, so range reads and counts only have
+to decode the items in at most three blocks instead of the whole queue.
+
+sample_time can go backwards: before the first clock sync samples are stamped
+from the system clock, which on a board without an RTC restarts in the past
+after a reboot. An item older than the one pushed just before it gets an
+entry marked out of order, and while such an item is in the queue behind the
+newer ones, reads and counts scan the whole queue instead of trusting the
+search.
+
+The index lives next to the queue (sensor.queue.idx). Entries are appended as
+items are pushed and the file is rewritten when the queue file is compacted by
+flush(). If the index doesn't match the queue (e.g. after a crash between the
+two) it is rebuilt by scanning the queue once.
+"""
+from bisect import bisect_left, bisect_right
+import logging
+import os
+import struct
+
+import msgpack
+from persistent_queue import PersistentQueue
+
+from utils.queue_reader import HEADER_STRUCT, LENGTH_STRUCT, READ_BUFFER, \
+    block_of, expand, iter_records
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'SIDX'
+VERSION = 2
+INDEX_HEADER = struct.Struct('<4sHH')  # magic, version, interval
+INDEX_ENTRY = struct.Struct('<qQQB')  # sample_time, offset, sample number, flags
+OUT_OF_ORDER = 1
+DEFAULT_INTERVAL = 64
+
+
+def get_sample_time(item):
+    if isinstance(item, dict):
+        return item.get('sample_time', item.get(b'sample_time'))
+    return None
+
+
+def get_sample_count(item):
+    """Number of samples in an item (a compacted block holds many)."""
+    if block_of(item) is not None:
+        return item.get('count', item.get(b'count'))
+    return 0 if get_sample_time(item) is None else 1
+
+
+class TimeIndex:
+    def __init__(self, queue_filename, interval=DEFAULT_INTERVAL):
+        self.queue_filename = queue_filename
+        self.filename = queue_filename + '.idx'
+        self.interval = interval
+
+        self.times = []
+        self.offsets = []
+        self.numbers = []
+        self.flags = []
+        self.load()
+
+    def load(self):
+        self.times, self.offsets, self.numbers, self.flags = [], [], [], []
+
+        try:
+            with open(self.filename, 'rb') as f:
+                header = f.read(INDEX_HEADER.size)
+                if len(header) < INDEX_HEADER.size:
+                    return
+                magic, version, interval = INDEX_HEADER.unpack(header)
+                if magic != MAGIC or version != VERSION:
+                    LOGGER.warning("Ignoring unknown index file %s", self.filename)
+                    return
+                self.interval = interval
+
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        # A partially written last entry is ignored
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        for sample_time, offset, number, flags in INDEX_ENTRY.iter_unpack(data[:usable]):
+            self.times.append(sample_time)
+            self.offsets.append(offset)
+            self.numbers.append(number)
+            self.flags.append(flags)
+
+    def save(self):
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(INDEX_HEADER.pack(MAGIC, VERSION, self.interval))
+            for entry in zip(self.times, self.offsets, self.numbers, self.flags):
+                f.write(INDEX_ENTRY.pack(*entry))
+        os.replace(temp_filename, self.filename)
+
+    def append(self, sample_time, offset, number, flags=0):
+        if not os.path.exists(self.filename):
+            self.save()
+
+        self.times.append(sample_time)
+        self.offsets.append(offset)
+        self.numbers.append(number)
+        self.flags.append(flags)
+
+        with open(self.filename, 'ab') as f:
+            f.write(INDEX_ENTRY.pack(sample_time, offset, number, flags))
+
+    def _first_live(self, top):
+        return bisect_left(self.offsets, top)
+
+    def reset(self):
+        self.times, self.offsets, self.numbers, self.flags = [], [], [], []
+        self.save()
+
+    def ordered(self, top):
+        """
+        False while an item pushed out of order is in the queue behind items
+        that are newer than it.
+        """
+        first = self._first_live(top)
+        return not any(flags & OUT_OF_ORDER and offset > top
+                       for flags, offset in zip(self.flags[first:], self.offsets[first:]))
+
+    def rebase(self, old_top, new_top):
+        """The queue file was compacted so items moved from old_top to new_top."""
+        first = self._first_live(old_top)
+        shift = old_top - new_top
+
+        self.times = self.times[first:]
+        self.offsets = [offset - shift for offset in self.offsets[first:]]
+        self.numbers = self.numbers[first:]
+        self.flags = self.flags[first:]
+        self.save()
+
+    def valid(self, f, top, loads=msgpack.unpackb):
+        """Checks that the first and last live entries point at their items."""
+        first = self._first_live(top)
+        if first == len(self.offsets):
+            # No index for a queue that isn't empty (e.g. it was deleted)
+            return next(iter_records(f, top, count=1), None) is None
+
+        for i in {first, len(self.offsets) - 1}:
+            if i < first or i >= len(self.offsets):
+                continue
+
+            try:
+                _, data = next(iter_records(f, self.offsets[i], count=1))
+                if get_sample_time(loads(data)) != self.times[i]:
+                    return False
+            except Exception:
+                return False
+        return True
+
+    def rebuild(self, f, top, loads=msgpack.unpackb):
+        """
+        Recreates the index by scanning the queue. Returns (next sample
+        number, items since the last entry, last sample_time).
+        """
+        LOGGER.info("Rebuilding index %s", self.filename)
+        self.times, self.offsets, self.numbers, self.flags = [], [], [], []
+
+        number = 0
+        since_entry = 0
+        last = None
+        for offset, data in iter_records(f, top):
+            item = loads(data)
+            sample_time = get_sample_time(item)
+            if sample_time is not None:
+                flags = OUT_OF_ORDER if last is not None and sample_time < last else 0
+                if flags or since_entry >= self.interval or not self.times:
+                    self.times.append(sample_time)
+                    self.offsets.append(offset)
+                    self.numbers.append(number)
+                    self.flags.append(flags)
+                    since_entry = 0
+                last = sample_time
+
+            since_entry += 1
+            number += get_sample_count(item)
+
+        self.save()
+        return number, since_entry, last
+
+    def tail(self, f, top, loads=msgpack.unpackb):
+        """
+        Returns (next sample number, items since the last entry, last
+        sample_time).
+        """
+        first = self._first_live(top)
+        if first == len(self.offsets):
+            return (self.numbers[-1] + 1 if self.numbers else 0), \
+                self.interval, None
+
+        items = 0
+        samples = 0
+        last = None
+        for _, data in iter_records(f, self.offsets[-1]):
+            item = loads(data)
+            items += 1
+            samples += get_sample_count(item)
+            sample_time = get_sample_time(item)
+            if sample_time is not None:
+                last = sample_time
+        return self.numbers[-1] + samples, items, last
+
+    def _scan(self, f, start, end, since, until, loads):
+        for offset, data in iter_records(f, start):
+            if end is not None and offset >= end:
+                break
+
+            for sample in expand(loads(data)):
+                sample_time = sample.get('sample_time')
+                if sample_time is not None and since <= sample_time < until:
+                    yield sample
+
+    def _blocks(self, top, since, until):
+        first = self._first_live(top)
+        times = self.times[first:]
+        offsets = self.offsets[first:]
+        numbers = self.numbers[first:]
+
+        # Block i starts at entry i; block -1 is the items before the first
+        # entry. Blocks i + 1 .. j - 2 are completely inside the range.
+        i = bisect_right(times, since) - 1
+        j = bisect_left(times, until)
+
+        return offsets, numbers, i, j
+
+    def samples(self, f, top, since, until, loads=msgpack.unpackb):
+        """Yields the decoded samples with since <= sample_time < until."""
+        if not self.ordered(top):
+            yield from self._scan(f, top, None, since, until, loads)
+            return
+
+        offsets, _, i, j = self._blocks(top, since, until)
+
+        start = top if i < 0 else offsets[i]
+        end = offsets[j] if j < len(offsets) else None
+        yield from self._scan(f, start, end, since, until, loads)
+
+    def count(self, f, top, since, until, loads=msgpack.unpackb):
+        """Number of samples with since <= sample_time < until."""
+        if not self.ordered(top):
+            return sum(1 for _ in self._scan(f, top, None, since, until, loads))
+
+        offsets, numbers, i, j = self._blocks(top, since, until)
+
+        def block(b):
+            start = top if b < 0 else offsets[b]
+            end = offsets[b + 1] if b + 1 < len(offsets) else None
+            return sum(1 for _ in self._scan(f, start, end, since, until, loads))
+
+        total = block(i)
+        if j - 1 > i:
+            total += block(j - 1)
+        if j - 2 > i:
+            total += numbers[j - 1] - numbers[i + 1]
+        return total
+
+
+class IndexedQueue(PersistentQueue):
+    """A PersistentQueue that maintains a TimeIndex as items are pushed."""
+    def __init__(self, filename, path='.', dumps=msgpack.packb,
+                 loads=msgpack.unpackb, flush_limit=1048576,
+                 index_interval=DEFAULT_INTERVAL):
+        super().__init__(filename, path=path, dumps=dumps, loads=loads,
+                         flush_limit=flush_limit)
+        self.queue_path = os.path.join(path, filename)
+        self.index = TimeIndex(self.queue_path, index_interval)
+
+        with self.file_lock, self._reader() as f:
+            top = self._get_queue_top()
+            if self.index.valid(f, top, loads):
+                self.next_number, self.since_entry, self.last_time = \
+                    self.index.tail(f, top, loads)
+            else:
+                self.next_number, self.since_entry, self.last_time = \
+                    self.index.rebuild(f, top, loads)
+
+    def _reader(self):
+        return open(self.queue_path, 'rb', buffering=READ_BUFFER)
+
+    def push(self, items):
+        """Add items to the queue, indexing every interval-th one."""
+        if not isinstance(items, list):
+            items = [items]
+
+        if len(items) == 0:
+            return
+
+        with self.file_lock:
+            start = offset = self.file.seek(0, 2)  # Go to end of file
+            offsets = []
+
+            try:
+                for item in items:
+                    data = self.dumps(item)
+                    self.file.write(LENGTH_STRUCT.pack(len(data)) + data)
+                    offsets.append(offset)
+                    offset += LENGTH_STRUCT.size + len(data)
+
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError:
+                # Don't leave part of an item (e.g. when the disk is full)
+                # where the next push would append after it
+                self.file.truncate(start)
+                raise
+
+            for item, offset in zip(items, offsets):
+                self._index(item, offset)
+
+            self._update_length(self.count() + len(items))
+
+        self.pushed_event.set()
+
+    def _index(self, item, offset):
+        sample_time = get_sample_time(item)
+
+        if sample_time is not None:
+            if self.last_time is not None and sample_time < self.last_time:
+                LOGGER.warning("sample_time went backwards, scanning the queue "
+                               "until the older samples are gone")
+                self.index.append(sample_time, offset, self.next_number, OUT_OF_ORDER)
+                self.since_entry = 0
+            elif self.since_entry >= self.index.interval:
+                self.index.append(sample_time, offset, self.next_number)
+                self.since_entry = 0
+            self.last_time = sample_time
+
+        self.since_entry += 1
+        self.next_number += get_sample_count(item)
+
+    def flush(self):
+        with self.file_lock, self.pop_lock:
+            old_top = self._get_queue_top()
+            super().flush()
+            new_top = self._get_queue_top()
+
+            if new_top != old_top:
+                self.index.rebase(old_top, new_top)
+
+    def reindex(self):
+        """Rebuilds the index after the queue file was rewritten."""
+        with self.file_lock, self._reader() as f:
+            self.next_number, self.since_entry, self.last_time = self.index.rebuild(
+                f, self._get_queue_top(), self.loads)
+
+    def clear(self):
+        with self.file_lock, self.pop_lock:
+            super().clear()
+            self.index.reset()
+            self.since_entry = self.index.interval
+            self.last_time = None
+
+    def samples_between(self, since, until):
+        """
+        Yields the decoded samples with since <= sample_time < until (in
+        microseconds, like sample_time).
+        """
+        with self.file_lock:
+            top = self._get_queue_top()
+            f = self._reader()
+
+        with f:
+            yield from self.index.samples(f, top, since, until, self.loads)
+
+    def count_between(self, since, until):
+        with self.file_lock:
+            top = self._get_queue_top()
+            f = self._reader()
+
+        with f:
+            return self.index.count(f, top, since, until, self.loads)
+
+
+def read_range(queue_filename, since, until, loads=msgpack.unpackb):
+    """
+    Yields decoded samples in a time range from a queue file without opening
+    it as a PersistentQueue, e.g. from another process. Falls back to scanning
+    the whole queue if the index doesn't match it.
+    """
+    index = TimeIndex(queue_filename)
+
+    with open(queue_filename, 'rb', buffering=READ_BUFFER) as f:
+        _, top = HEADER_STRUCT.unpack(f.read(HEADER_STRUCT.size))
+
+        if not index.valid(f, top, loads):
+            LOGGER.warning("Index doesn't match the queue, scanning it all")
+            index.times, index.offsets, index.numbers, index.flags = [], [], [], []
+
+        yield from index.samples(f, top, since, until, loads)